@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Continuous Integration helper script.
+Checks that importing the toolchain module is fast, does not start any
+process (e.g. xcrun) and leaves the modules only some commands need to be
+imported when used, as the entry point is invoked many times per app build.
+"""
+import argparse
+import subprocess
+import sys
+
+# run in a fresh interpreter, prints the import time in seconds
+IMPORT_SCRIPT = """
+import sys, time
+spawned = []
+def hook(event, args):
+    if event in ("os.fork", "os.posix_spawn", "os.exec", "subprocess.Popen"):
+        spawned.append(event)
+sys.addaudithook(hook)
+start = time.perf_counter()
+import kivy_ios.toolchain
+duration = time.perf_counter() - start
+if spawned:
+    sys.exit("processes started at import time: {}".format(spawned))
+imported = [name for name in ("requests", "tarfile") if name in sys.modules]
+if imported:
+    sys.exit("modules imported at import time: {}".format(imported))
+print(duration)
+"""
+
+
+def import_time():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return float(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget", type=float, default=0.3,
+                        help="maximum import time in seconds")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="number of imports, the fastest one is kept")
+    args = parser.parse_args()
+    # the first import also compiles the bytecode
+    import_time()
+    duration = min(import_time() for _ in range(args.runs))
+    print("kivy_ios.toolchain imported in {:.1f} ms (budget {:.1f} ms)".format(
+        duration * 1000, args.budget * 1000))
+    if duration > args.budget:
+        sys.exit("Import time budget exceeded")
+
+
+if __name__ == "__main__":
+    main()
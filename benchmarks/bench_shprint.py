@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Benchmark of `shprint`.
+Compares the throughput of the execution engine of `kivy_ios.runner` with
+the former `sh` iteration on a command writing many lines, with the output
+of the commands logged at DEBUG level or not.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import sh
+
+from kivy_ios import toolchain
+
+# writes `lines` lines of `width` characters
+CHATTY_SCRIPT = """
+import sys
+line = "x" * {width} + "\\n"
+for _ in range({lines}):
+    sys.stdout.write(line)
+"""
+
+
+def run(engine, lines, width, debug):
+    os.environ["KIVYIOS_SHPRINT"] = engine
+    toolchain.logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    command = sh.Command(sys.executable)
+    script = CHATTY_SCRIPT.format(lines=lines, width=width)
+    start = time.perf_counter()
+    toolchain.shprint(command, "-c", script)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--width", type=int, default=80)
+    parser.add_argument("--runs", type=int, default=3,
+                        help="number of runs, the fastest one is kept")
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="kivy-ios-bench-")
+    os.chdir(workdir)
+    toolchain.initial_working_directory = workdir
+    # the logged lines go nowhere, only their handling is measured
+    logging.basicConfig(stream=open(os.devnull, "w"), level=logging.DEBUG)
+    size = args.lines * (args.width + 1)
+    results = []
+    for debug in (False, True):
+        for engine in ("sh", "runner"):
+            duration = min(run(engine, args.lines, args.width, debug)
+                           for _ in range(args.runs))
+            results.append({
+                "engine": engine,
+                "debug": debug,
+                "seconds": round(duration, 4),
+                "lines_per_second": int(args.lines / duration),
+                "mb_per_second": round(size / duration / 1e6, 2),
+            })
+    print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
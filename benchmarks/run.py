@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the toolchain itself: context creation, recipe graphs, builds,
+state store, shprint, archive extraction and Xcode project update.
+
+They run on any POSIX system: the Xcode tools are replaced by shims doing
+nothing and the recipes are synthetic (see `synthetic.py`), so the numbers
+only measure the toolchain. Each case runs in its own process and workspace;
+the results, with the peak memory of each case, are saved as JSON and can be
+compared with the results of another commit:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, join
+
+import shims
+import synthetic
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+RESULTS_VERSION = 1
+
+
+class Timer:
+    """Durations of the named steps of a case, in seconds"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def measure(self, name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.metrics[name] = round(time.perf_counter() - start, 6)
+        return result
+
+
+# cases, run in the child processes from the workspace
+def new_context(params):
+    from kivy_ios import toolchain
+    ctx = toolchain.Context()
+    ctx.artifact_cache = None
+    if "size" in params:
+        ctx.custom_recipes_paths.extend(recipe_paths(params))
+    return ctx
+
+
+def recipe_paths(params):
+    graph = synthetic.make_graph(params["size"], params["shape"])
+    return [join(os.getcwd(), "recipes", name) for name in graph]
+
+
+def wanted(params):
+    return synthetic.wanted_recipes(
+        synthetic.make_graph(params["size"], params["shape"]))
+
+
+def case_context(params, timer):
+    from kivy_ios import probe, toolchain
+    timer.measure("cold_s", toolchain.Context)
+    probe._results.clear()
+    timer.measure("disk_cache_s", toolchain.Context)
+    timer.measure("memory_cache_s", toolchain.Context)
+
+
+def case_graph(params, timer):
+    from kivy_ios import toolchain
+    ctx = new_context(params)
+    timer.measure("index_s", lambda: ctx.recipe_index)
+    graph = timer.measure(
+        "load_s", toolchain.get_recipes_graph, wanted(params), ctx)
+    timer.measure("order_s", lambda: list(graph.find_order()))
+    durations = {name: 1. for name in graph.graph}
+    timer.measure("critical_path_s", graph.critical_paths, durations)
+    timer.measure("simulate_s", graph.simulate, durations, 4)
+
+
+def case_build(params, timer):
+    from kivy_ios import toolchain
+    ctx = new_context(params)
+    names = wanted(params)
+    stamp_key = toolchain.get_build_stamp_key(
+        names, None, ctx.custom_recipes_paths)
+    timer.measure("cold_s", toolchain.build_recipes, list(names), ctx,
+                  jobs=params["jobs"])
+    timer.metrics["per_recipe_ms"] = round(
+        timer.metrics["cold_s"] / params["size"] * 1000, 3)
+    timer.measure("noop_s", toolchain.build_recipes, list(names), ctx,
+                  jobs=params["jobs"], stamp_key=stamp_key)
+    timer.measure("stamp_check_s", toolchain.is_build_up_to_date, stamp_key)
+
+
+class JsonStore:
+    """The former state store: a JSON document rewritten on each write"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {}
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        with open(self.filename, "w") as fd:
+            json.dump(self.data, fd, ensure_ascii=False)
+
+
+def case_state(params, timer):
+    from kivy_ios.state import StateStore
+    count = params["keys"]
+    store = StateStore(join(os.getcwd(), "state.db"))
+
+    def write(store, count):
+        for index in range(count):
+            store["recipe{}.build_all".format(index)] = "fingerprint"
+
+    def write_batch():
+        with store.transaction():
+            write(store, count)
+
+    def read():
+        for index in range(count):
+            store.get("recipe{}.build_all".format(index))
+
+    timer.measure("state_write_s", write, store, count)
+    timer.measure("state_batch_write_s", write_batch)
+    timer.measure("state_read_s", read)
+    timer.measure("state_remove_all_s", store.remove_all, "recipe1")
+    # the former store rewrites the whole file on each write
+    json_count = min(count, 2000)
+    timer.measure("json_write_s", write,
+                  JsonStore(join(os.getcwd(), "state.json")), json_count)
+    timer.metrics["json_keys"] = json_count
+
+
+def case_shprint(params, timer):
+    import bench_shprint
+    from kivy_ios import toolchain
+    toolchain.initial_working_directory = os.getcwd()
+    for engine in ("sh", "runner"):
+        timer.measure("{}_s".format(engine), bench_shprint.run, engine,
+                      params["lines"], 80, False)
+
+
+def case_extract(params, timer):
+    import sh
+    import tarfile
+    from kivy_ios import extract, toolchain
+    toolchain.initial_working_directory = os.getcwd()
+    src_dir = join(os.getcwd(), "src", "archive-1.0")
+    os.makedirs(src_dir)
+    for index in range(params["members"]):
+        with open(join(src_dir, "file{}.c".format(index)), "w") as fd:
+            fd.write("int value{} = {};\n".format(index, index) * 20)
+    filename = join(os.getcwd(), "archive-1.0.tar.gz")
+    with tarfile.open(filename, "w:gz") as archive:
+        archive.add(src_dir, "archive-1.0")
+    for engine in ("tar", "extract"):
+        dest_dir = join(os.getcwd(), engine)
+        os.makedirs(dest_dir)
+        if engine == "tar":
+            # what Recipe.extract_file did before
+            timer.measure("tar_xv_s", toolchain.shprint, sh.tar, "-C", dest_dir,
+                          "-xv", "-z", "-f", filename)
+        else:
+            timer.measure("extract_s", extract.extract_archive, filename, dest_dir)
+
+
+def case_pbxproj(params, timer):
+    from kivy_ios import toolchain
+    ctx = new_context(params)
+    ctx.recipe_index
+    # pretend every recipe is built
+    lib_dir = join(ctx.dist_dir, "lib")
+    os.makedirs(lib_dir, exist_ok=True)
+    with ctx.state.transaction():
+        for name in synthetic.make_graph(params["size"], params["shape"]):
+            ctx.state["{}.build_all".format(name)] = True
+            open(join(lib_dir, "lib{}.a".format(name)), "w").close()
+    project_fn = render_project(join(os.getcwd(), "project"), ctx.dist_dir)
+    timer.measure("first_update_s", toolchain._update_pbxproj,
+                  ctx, project_fn, None)
+    timer.measure("noop_update_s", toolchain._update_pbxproj,
+                  ctx, project_fn, None)
+
+
+def render_project(directory, dist_dir):
+    """Write the project.pbxproj of the app template, return its path"""
+    template_dir = join(
+        ROOT_DIR, "kivy_ios", "tools", "templates",
+        "{{ cookiecutter.project_name }}-ios",
+        "{{ cookiecutter.project_name }}.xcodeproj")
+    with open(join(template_dir, "project.pbxproj")) as fd:
+        content = fd.read()
+    for key, value in (("project_name", "bench"), ("dist_dir", dist_dir),
+                       ("project_dir", directory)):
+        content = content.replace("{{{{ cookiecutter.{} }}}}".format(key), value)
+    project_dir = join(directory, "bench.xcodeproj")
+    os.makedirs(project_dir, exist_ok=True)
+    project_fn = join(project_dir, "project.pbxproj")
+    with open(project_fn, "w") as fd:
+        fd.write(content)
+    return project_fn
+
+
+CASES = {
+    "context": case_context,
+    "graph": case_graph,
+    "build": case_build,
+    "state": case_state,
+    "shprint": case_shprint,
+    "extract": case_extract,
+    "pbxproj": case_pbxproj,
+}
+
+
+def run_child(case, params):
+    from kivy_ios import toolchain
+    toolchain.setup_logging(logging.WARNING)
+    timer = Timer()
+    CASES[case](params, timer)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        max_rss *= 1024
+    print(json.dumps({"metrics": timer.metrics, "max_rss": max_rss}))
+
+
+# parent process
+def run_case(case, params, keep=False):
+    """Run the `case` in a new workspace and process, return its result"""
+    workspace = tempfile.mkdtemp(prefix="kivy-ios-bench-")
+    try:
+        bin_dir = join(workspace, "bin")
+        shims.install_shims(bin_dir)
+        if "size" in params:
+            synthetic.write_recipes(
+                join(workspace, "recipes"),
+                synthetic.make_graph(params["size"], params["shape"]))
+        env = dict(os.environ)
+        env["PATH"] = os.pathsep.join([bin_dir, env.get("PATH", "")])
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [ROOT_DIR, env.get("PYTHONPATH")]))
+        env.pop("KIVYIOS_REMOTE_CACHE", None)
+        env["KIVYIOS_CACHE_DIR"] = join(workspace, "shared-cache")
+        output = subprocess.run(
+            [sys.executable, abspath(__file__), "--child", case,
+             "--params", json.dumps(params)],
+            cwd=workspace, env=env, check=True, stdout=subprocess.PIPE,
+            universal_newlines=True).stdout
+        result = json.loads(output.splitlines()[-1])
+    finally:
+        if keep:
+            print("Workspace kept in {}".format(workspace))
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+    return dict(case=case, params=params, **result)
+
+
+def get_cases(args):
+    for case in args.cases:
+        if case == "context":
+            yield case, {}
+        elif case == "graph":
+            for size in args.sizes:
+                for shape in args.shapes:
+                    yield case, {"size": size, "shape": shape}
+        elif case == "build":
+            for size in args.sizes:
+                for shape in args.shapes:
+                    for jobs in args.jobs:
+                        yield case, {"size": size, "shape": shape, "jobs": jobs}
+        elif case == "state":
+            yield case, {"keys": max(args.sizes) * 20}
+        elif case == "shprint":
+            yield case, {"lines": 100000}
+        elif case == "extract":
+            yield case, {"members": 20000}
+        elif case == "pbxproj":
+            for size in args.sizes:
+                yield case, {"size": size, "shape": "wide"}
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print the metrics of `results` next to the ones of `baseline`"""
+    def key(result):
+        return result["case"], json.dumps(result["params"], sort_keys=True)
+
+    previous = {key(result): result for result in baseline["results"]}
+    print("Compared to {}:".format(baseline.get("commit") or "the baseline"))
+    for result in results["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        print("{} {}".format(result["case"], json.dumps(result["params"])))
+        values = dict(result["metrics"], max_rss=result["max_rss"])
+        old_values = dict(old["metrics"], max_rss=old["max_rss"])
+        for name, value in values.items():
+            old_value = old_values.get(name)
+            if not old_value:
+                continue
+            print("  {:<20} {:>12} -> {:>12} ({:+.1f}%)".format(
+                name, old_value, value, (value - old_value) / old_value * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES),
+                        default=list(CASES))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 500],
+                        help="number of recipes of the synthetic graphs")
+    parser.add_argument("--shapes", nargs="+", choices=synthetic.SHAPES,
+                        default=list(synthetic.SHAPES))
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4],
+                        help="recipes built at the same time")
+    parser.add_argument("--output", help="save the results in this file")
+    parser.add_argument("--compare", help="results to compare with")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the workspaces, for inspection")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--params", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args.child, json.loads(args.params))
+
+    results = {
+        "version": RESULTS_VERSION,
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+    for case, params in get_cases(args):
+        result = run_case(case, params, args.keep)
+        print("{:<8} {:<45} {}".format(
+            case, json.dumps(params), json.dumps(result["metrics"])))
+        results["results"].append(result)
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(results, fd, indent=1)
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(results, json.load(fd))
+
+
+if __name__ == "__main__":
+    main()
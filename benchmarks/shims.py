@@ -0,0 +1,74 @@
+"""
+Fake Xcode tools for the benchmarks, so the toolchain runs on any POSIX
+system. They answer the toolchain probe and produce empty outputs, instantly.
+"""
+import os
+import stat
+import sys
+from os.path import join
+
+SHIMS = {
+    "xcodebuild": """#!/bin/sh
+case "$1" in
+    -showsdks)
+        echo "iOS SDKs:"
+        echo "	iOS 14.5                      	-sdk iphoneos14.5"
+        echo "iOS Simulator SDKs:"
+        echo "	Simulator - iOS 14.5          	-sdk iphonesimulator14.5"
+        echo "macOS SDKs:"
+        echo "	macOS 11.3                    	-sdk macosx11.3";;
+    -version)
+        echo "Xcode 12.5";;
+esac
+""",
+    "xcode-select": """#!/bin/sh
+echo /Applications/Xcode.app/Contents/Developer
+""",
+    "xcrun": """#!/bin/sh
+sdk=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --sdk|-sdk) sdk=$2; shift 2;;
+        --show-sdk-path) echo "/fake/SDKs/$sdk.sdk"; exit 0;;
+        -find|--find) command -v "$2"; exit 0;;
+        *) exec "$@";;
+    esac
+done
+""",
+    "sysctl": """#!/bin/sh
+{python} -c "import os; print(os.cpu_count())"
+""",
+    # writes an empty output for -o
+    "clang": """#!/bin/sh
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then : > "$2"; fi
+    shift
+done
+""",
+    "lipo": """#!/bin/sh
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-output" ]; then : > "$2"; fi
+    shift
+done
+""",
+}
+
+# only looked for by the probe
+NOOP_TOOLS = ("pkg-config", "autoconf", "automake", "libtool", "cython")
+
+
+def install_shims(bin_dir):
+    """Write the shims into `bin_dir`, to put first in the PATH"""
+    os.makedirs(bin_dir, exist_ok=True)
+    scripts = dict(SHIMS)
+    for tool in NOOP_TOOLS:
+        scripts[tool] = "#!/bin/sh\n"
+    for name, script in scripts.items():
+        fn = join(bin_dir, name)
+        with open(fn, "w") as fd:
+            fd.write(script.replace("{python}", sys.executable))
+        os.chmod(fn, os.stat(fn).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    for name in ("clang++", "ar", "ld"):
+        dest = join(bin_dir, name)
+        if not os.path.exists(dest):
+            os.symlink(join(bin_dir, "clang"), dest)
@@ -0,0 +1,91 @@
+"""
+Synthetic recipe graphs for the benchmarks.
+
+Each recipe builds an empty static library per arch with the `clang` shim,
+so only the work of the toolchain itself is measured. As for the recipes of
+kivy-ios, about half of them have legacy steps, without `job` argument, which
+run one at a time from the build directory.
+"""
+import os
+import random
+from os.path import join
+
+SHAPES = ("deep", "wide", "random")
+
+# frameworks shared by the recipes, added to the Xcode project
+FRAMEWORKS = ["Synth{}".format(index) for index in range(20)]
+
+RECIPE_TEMPLATE = '''import sh
+from kivy_ios.toolchain import Recipe, shprint
+
+
+class SyntheticRecipe(Recipe):
+    version = "1.0"
+    url = "src"
+    library = "lib{name}.a"
+    depends = {depends!r}
+    pbx_frameworks = {frameworks!r}
+
+{build_arch}
+
+
+recipe = SyntheticRecipe()
+'''
+
+BUILD_ARCH = '''    def build_arch(self, arch, job):
+        job.run(sh.Command("clang"), "-c", "{name}.c", "-o", "lib{name}.a")'''
+
+LEGACY_BUILD_ARCH = '''    def build_arch(self, arch):
+        shprint(sh.Command("clang"), "-c", "{name}.c", "-o", "lib{name}.a")'''
+
+
+def make_graph(count, shape, seed=0):
+    """Return the dependencies of `count` recipes, as {name: [depends]}:
+
+    - deep: a long chain, each recipe depends on the two previous ones
+    - wide: one common dependency, then independent recipes
+    - random: each recipe depends on up to 3 random older ones
+    """
+    names = ["synth{:03d}".format(index) for index in range(count)]
+    rng = random.Random(seed)
+    graph = {}
+    for index, name in enumerate(names):
+        if shape == "deep":
+            depends = names[max(0, index - 2):index]
+        elif shape == "wide":
+            depends = names[:1] if index else []
+        elif shape == "random":
+            depends = sorted(set(rng.sample(
+                names[:index], min(index, rng.randint(0, 3)))))
+        else:
+            raise ValueError("Unknown shape {}".format(shape))
+        graph[name] = depends
+    return graph
+
+
+def wanted_recipes(graph):
+    """The recipes nothing depends on, building them builds everything"""
+    dependencies = {dep for depends in graph.values() for dep in depends}
+    return sorted(name for name in graph if name not in dependencies)
+
+
+def write_recipes(directory, graph, seed=0, legacy_ratio=0.5):
+    """Write the recipes of `graph` in `directory`, return their paths.
+    The `legacy_ratio` of them have a legacy `build_arch`, evenly spread.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for index, (name, depends) in enumerate(graph.items()):
+        legacy = int((index + 1) * legacy_ratio) > int(index * legacy_ratio)
+        recipe_dir = join(directory, name)
+        os.makedirs(join(recipe_dir, "src"), exist_ok=True)
+        with open(join(recipe_dir, "src", "{}.c".format(name)), "w") as fd:
+            fd.write("int {}(void) {{ return 0; }}\n".format(name))
+        with open(join(recipe_dir, "__init__.py"), "w") as fd:
+            build_arch = LEGACY_BUILD_ARCH if legacy else BUILD_ARCH
+            fd.write(RECIPE_TEMPLATE.format(
+                name=name, depends=depends,
+                build_arch=build_arch.format(name=name),
+                frameworks=rng.sample(FRAMEWORKS, 2)))
+        paths.append(recipe_dir)
+    return paths
@@ -0,0 +1,195 @@
+"""
+This module houses the build logs: each phase of a recipe (per arch when it
+has one) writes its log and the output of its commands to its own compressed
+file in `build/logs/<recipe>/`. The commands run outside of a phase have
+their own plain log in `build/logs/commands/<date>-<pid>/`, the logs of the
+last runs only being kept.
+
+The files are compressed and written by a single background thread, so the
+threads running the commands only queue the data. The last lines of each log
+are kept in memory and shown on the console when the phase fails.
+"""
+import atexit
+import gzip
+import logging
+import os
+import queue
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from logging import getLogger
+from os import makedirs
+from os.path import isdir, join, relpath
+
+from kivy_ios.runner import Tail
+
+
+logger = getLogger(__name__)
+
+# lines of a failed phase shown on the console
+DEFAULT_TAIL_LINES = 200
+
+# runs whose logs of the commands outside of a phase are kept
+KEEP_COMMAND_RUNS = 10
+
+_current = threading.local()
+_command_dirs = {}
+_command_dirs_lock = threading.Lock()
+
+
+class LogWriter(threading.Thread):
+    """Thread writing the queued data to the files of the logs"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        super().__init__(name="kivy-ios-log-writer", daemon=True)
+        self.queue = queue.Queue()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+                atexit.register(cls._instance.flush)
+            return cls._instance
+
+    def run(self):
+        # a file failing to be written is skipped, the others still are
+        failed = set()
+        while True:
+            fd, data = self.queue.get()
+            if isinstance(data, threading.Event):
+                data.set()
+                continue
+            try:
+                if data is None:
+                    failed.discard(fd)
+                    fd.close()
+                elif fd not in failed:
+                    fd.write(data)
+            except Exception as e:
+                if fd not in failed:
+                    logger.warning("Unable to write the log {}: {}".format(
+                        getattr(fd, "name", fd), e))
+                if data is not None:
+                    failed.add(fd)
+
+    def write(self, fd, data):
+        self.queue.put((fd, data))
+
+    def close(self, fd):
+        self.queue.put((fd, None))
+
+    def flush(self, poll_interval=1.):
+        """Wait until everything queued so far is written, return False if
+        the thread is not running anymore.
+        """
+        done = threading.Event()
+        self.queue.put((None, done))
+        while not done.wait(poll_interval):
+            if not self.is_alive():
+                return False
+        return True
+
+
+class BuildLog:
+    """Compressed log file `filename` of a phase of `recipe`, keeping its
+    last `tail_lines` lines in memory.
+    """
+
+    def __init__(self, filename, recipe, tail_lines=DEFAULT_TAIL_LINES):
+        self.filename = filename
+        self.recipe = recipe
+        self.tail = Tail(tail_lines)
+        self.writer = LogWriter.get()
+        self._fd = gzip.open(filename, "wb", compresslevel=3)
+
+    def write(self, data):
+        self.tail.feed(data)
+        self.writer.write(self._fd, data)
+
+    def write_line(self, line):
+        self.write((line + "\n").encode("utf-8", "replace"))
+
+    def close(self):
+        self.writer.close(self._fd)
+
+    def last_lines(self):
+        return self.tail.get().decode("utf-8", "replace")
+
+
+def current_log():
+    """Return the log of the phase run by the current thread, if any"""
+    return getattr(_current, "log", None)
+
+
+@contextmanager
+def open_log(log_dir, recipe, phase, arch=None, tail_lines=DEFAULT_TAIL_LINES):
+    """Make the log of the `phase` of `recipe` the current one of the thread
+    while in the context. On failure, its last lines are shown.
+    """
+    name = "{}-{}".format(phase, arch) if arch else phase
+    recipe_dir = join(log_dir, recipe)
+    makedirs(recipe_dir, exist_ok=True)
+    log = BuildLog(
+        join(recipe_dir, "{}.log.gz".format(name)), recipe, tail_lines)
+    previous = current_log()
+    _current.log = log
+    try:
+        yield log
+    except Exception as e:
+        # only the innermost phase shows its lines
+        if not getattr(e, "build_log_reported", False):
+            e.build_log_reported = True
+            logger.error("{} {} failed, last lines of {}:\n{}".format(
+                name.capitalize(), recipe, relpath(log.filename),
+                log.last_lines().rstrip("\n")))
+        raise
+    finally:
+        _current.log = previous
+        log.close()
+
+
+def command_log_dir(log_dir, keep=KEEP_COMMAND_RUNS):
+    """Return the directory of the logs of the commands run outside of a
+    phase by this process. It is created on first use, and the logs of the
+    runs before the last `keep` ones are removed.
+    """
+    with _command_dirs_lock:
+        run_dir = _command_dirs.get(log_dir)
+        if run_dir is None:
+            commands_dir = join(log_dir, "commands")
+            run_dir = join(commands_dir, "{}-{}".format(
+                datetime.now().strftime("%Y%m%d-%H%M%S"), os.getpid()))
+            makedirs(run_dir, exist_ok=True)
+            prune_command_logs(commands_dir, keep)
+            _command_dirs[log_dir] = run_dir
+        return run_dir
+
+
+def prune_command_logs(commands_dir, keep):
+    """Remove the logs of the runs before the last `keep` ones"""
+    # the names start with the date of the run
+    runs = sorted(name for name in os.listdir(commands_dir)
+                  if isdir(join(commands_dir, name)))
+    for name in runs[:-keep]:
+        shutil.rmtree(join(commands_dir, name), ignore_errors=True)
+
+
+class BuildLogHandler(logging.Handler):
+    """Write the records to the current log of the thread. The output of the
+    commands, already written as is, is skipped.
+    """
+
+    def emit(self, record):
+        log = current_log()
+        if log is None or getattr(record, "command_output", False):
+            return
+        try:
+            log.write_line(self.format(record))
+        except Exception:
+            self.handleError(record)
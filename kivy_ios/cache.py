@@ -0,0 +1,480 @@
+"""
+This module houses the caches shared between kivy-ios workspaces.
+
+The download cache is content-addressed: an archive is stored under its
+sha256 digest, and an index maps each url to the digest of its content. Files
+are written to a temporary name and renamed once complete and verified, so a
+cache can be shared by several workspaces, users or concurrent builds, via
+the `KIVYIOS_CACHE_DIR` environment variable.
+
+The artifact cache keeps the outputs of the built recipes, keyed by the
+fingerprint of everything they were built from, so a fresh workspace can
+restore them instead of building again. Its entries can also be pulled from
+and pushed to a remote cache shared between machines: an HTTP server
+answering GET and PUT, or a plain (e.g. network mounted) directory.
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from logging import getLogger
+from os.path import basename, dirname, exists, join
+from threading import Lock
+from urllib.parse import urlparse
+
+from kivy_ios.locks import FileLock
+
+
+logger = getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def sha256sum(filename, blocksize=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fd:
+        for block in iter(lambda: fd.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_atomic(filename, data):
+    """Write `data` (str) to `filename` through a temporary file and a
+    rename, so readers never see a partial content.
+    """
+    os.makedirs(dirname(filename), exist_ok=True)
+    fd, tmp_fn = tempfile.mkstemp(dir=dirname(filename), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(data)
+        os.replace(tmp_fn, filename)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_fn)
+        raise
+
+
+class DownloadCache:
+    """Content-addressed store of the downloaded archives::
+
+        objects/<ab>/<abcdef...>/<archive name>
+        urls/<url digest>  (contains the digest of the archive content)
+        tmp/               (downloads in progress)
+        locks/<url digest> (held while the url is downloaded)
+
+    The archive name is kept so the extension still tells how to extract it.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.tmp_dir = join(root_dir, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @staticmethod
+    def url_key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def object_fn(self, digest, url):
+        return join(self.root_dir, "objects", digest[:2], digest, basename(url))
+
+    def index_fn(self, url):
+        key = self.url_key(url)
+        return join(self.root_dir, "urls", key[:2], key)
+
+    def lookup(self, url, sha256=None):
+        """Return the archive of `url` if it is in the cache, or None. When
+        `sha256` is given, the url index is not needed.
+        """
+        digest = sha256.lower() if sha256 else None
+        if digest is None:
+            with suppress(FileNotFoundError):
+                with open(self.index_fn(url)) as fd:
+                    digest = fd.read().strip()
+        if not digest:
+            return
+        filename = self.object_fn(digest, url)
+        if exists(filename):
+            return filename
+
+    def add(self, filename, url, sha256=None):
+        """Move the archive `filename` of `url` into the cache, return its new
+        path. If `sha256` is given, it must match the content.
+        """
+        digest = sha256sum(filename)
+        if sha256 is not None and digest != sha256.lower():
+            os.unlink(filename)
+            raise ChecksumError(
+                "Checksum mismatch for {}: expected {}, got {}".format(
+                    url, sha256, digest))
+        object_fn = self.object_fn(digest, url)
+        os.makedirs(dirname(object_fn), exist_ok=True)
+        os.replace(filename, object_fn)
+        write_atomic(self.index_fn(url), digest)
+        return object_fn
+
+    def forget(self, url):
+        """Remove `url` from the index, for its archive to be downloaded
+        again unless its digest is known. The archive itself is kept, other
+        workspaces sharing the cache may use it.
+        """
+        with suppress(FileNotFoundError):
+            os.unlink(self.index_fn(url))
+
+    def fetch(self, url, download, sha256=None):
+        """Return the cached archive of `url`, downloading it first with
+        `download(url, filename)` if needed.
+        """
+        filename = self.lookup(url, sha256)
+        if filename:
+            logger.info("Using cached {}".format(filename))
+            return filename
+        key = self.url_key(url)
+        # one process or thread at a time downloads an url, in the shared
+        # temporary file, the others wait and use the archive it added
+        with FileLock.get(join(self.root_dir, "locks", key), url):
+            filename = self.lookup(url, sha256)
+            if filename:
+                logger.info("Using cached {}".format(filename))
+                return filename
+            # a stable name, so an interrupted download can be resumed
+            tmp_fn = join(self.tmp_dir, "{}-{}".format(key[:16], basename(url)))
+            download(url, tmp_fn)
+            return self.add(tmp_fn, url, sha256)
+
+    def verify(self, filenames, jobs=None):
+        """Check in parallel that the cached archives `filenames` still
+        match their digest, remove the ones that do not. Return the list of
+        removed files.
+        """
+        def check(filename):
+            expected = basename(dirname(filename))
+            if sha256sum(filename) == expected:
+                return
+            logger.warning("Removing corrupted {}".format(filename))
+            os.unlink(filename)
+            return filename
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(check, filenames))
+        return [filename for filename in results if filename]
+
+
+def snapshot(base_dir, exclude=()):
+    """Return the `{relative path: (size, mtime)}` of all the files (and
+    symlinks) under `base_dir`, skipping the top-level names in `exclude`.
+    """
+    result = {}
+    for root, dirnames, filenames in os.walk(base_dir):
+        rel_root = os.path.relpath(root, base_dir)
+        if rel_root == ".":
+            rel_root = ""
+            dirnames[:] = [d for d in dirnames if d not in exclude]
+            filenames = [f for f in filenames if f not in exclude]
+        # symlinks to directories are listed but not walked
+        names = filenames + [d for d in dirnames if os.path.islink(join(root, d))]
+        for name in names:
+            st = os.lstat(join(root, name))
+            result[join(rel_root, name)] = (st.st_size, st.st_mtime_ns)
+    return result
+
+
+def diff_snapshots(before, after):
+    """Return the files changed and removed between two snapshots"""
+    changed = sorted(fn for fn, stat in after.items() if before.get(fn) != stat)
+    removed = sorted(fn for fn in before if fn not in after)
+    return changed, removed
+
+
+class ArtifactCache:
+    """Store of the outputs of built recipes, keyed by the fingerprint of
+    their inputs::
+
+        <recipe name>/<fingerprint>.tar.gz
+
+    An entry holds the files a recipe added or changed in the dist directory,
+    and a manifest with the files it removed and some metadata.
+    """
+
+    def __init__(self, root_dir, remote=None, push=True):
+        self.root_dir = root_dir
+        self.remote = remote
+        self.push = push
+        self._misses = set()
+        self._lock = Lock()
+
+    @staticmethod
+    def entry_key(name, fingerprint):
+        return "{}/{}.tar.gz".format(name, fingerprint)
+
+    def entry_fn(self, name, fingerprint):
+        return join(self.root_dir, self.entry_key(name, fingerprint))
+
+    def lookup(self, name, fingerprint):
+        """Return the entry of the recipe `name` if it is in the cache,
+        pulling it from the remote cache when needed, or None.
+        """
+        filename = self.entry_fn(name, fingerprint)
+        if exists(filename) or self.pull(name, fingerprint):
+            return filename
+
+    def locate(self, name, fingerprint):
+        """Tell where the entry of the recipe `name` is, "local", "remote" or
+        None, without pulling it.
+        """
+        if exists(self.entry_fn(name, fingerprint)):
+            return "local"
+        if self.remote is None:
+            return None
+        key = self.entry_key(name, fingerprint)
+        try:
+            return "remote" if self.remote.exists(key) else None
+        except (OSError, RemoteError) as e:
+            logger.warning("Unable to query {} on {}: {}".format(
+                key, self.remote, e))
+            return None
+
+    def pull(self, name, fingerprint):
+        if self.remote is None:
+            return False
+        key = self.entry_key(name, fingerprint)
+        with self._lock:
+            if key in self._misses:
+                return False
+        filename = self.entry_fn(name, fingerprint)
+        os.makedirs(dirname(filename), exist_ok=True)
+        fd, tmp_fn = tempfile.mkstemp(dir=dirname(filename), prefix=".tmp-")
+        os.close(fd)
+        try:
+            found = self.remote.get(key, tmp_fn)
+            if found:
+                os.replace(tmp_fn, filename)
+                logger.info("Pulled {} from {}".format(key, self.remote))
+        except (OSError, RemoteError) as e:
+            logger.warning("Unable to pull {} from {}: {}".format(
+                key, self.remote, e))
+            found = False
+        finally:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp_fn)
+        if not found:
+            with self._lock:
+                self._misses.add(key)
+        return found
+
+    def store(self, name, fingerprint, base_dir, changed, removed, metadata):
+        import tarfile
+        filename = self.entry_fn(name, fingerprint)
+        os.makedirs(dirname(filename), exist_ok=True)
+        manifest = dict(metadata, name=name, fingerprint=fingerprint,
+                        removed=removed)
+        data = json.dumps(manifest, indent=2).encode("utf-8")
+        fd, tmp_fn = tempfile.mkstemp(dir=dirname(filename), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                with tarfile.open(fileobj=fp, mode="w:gz") as tar:
+                    info = tarfile.TarInfo("manifest.json")
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+                    for fn in changed:
+                        tar.add(join(base_dir, fn), arcname=join("files", fn),
+                                recursive=False)
+            os.replace(tmp_fn, filename)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp_fn)
+            raise
+        logger.info("Stored {} files of {} in the artifact cache".format(
+            len(changed), name))
+        if self.remote is not None and self.push:
+            key = self.entry_key(name, fingerprint)
+            try:
+                self.remote.put(key, filename)
+                logger.info("Pushed {} to {}".format(key, self.remote))
+            except (OSError, RemoteError) as e:
+                logger.warning("Unable to push {} to {}: {}".format(
+                    key, self.remote, e))
+        return filename
+
+    def restore(self, name, fingerprint, base_dir):
+        """Restore the entry into `base_dir`, return its manifest. Raise a
+        ValueError if the entry is invalid or has files outside `base_dir`.
+        """
+        import tarfile
+        filename = self.entry_fn(name, fingerprint)
+        manifest = None
+        try:
+            with tarfile.open(filename) as tar:
+                members = []
+                for member in tar:
+                    if member.name == "manifest.json":
+                        manifest = json.load(tar.extractfile(member))
+                        continue
+                    if not member.name.startswith("files/"):
+                        continue
+                    member.name = member.name[len("files/"):]
+                    if member.islnk():
+                        # hard links are relative to the root of the archive
+                        member.linkname = member.linkname[len("files/"):]
+                    check_member(base_dir, member, filename)
+                    members.append(member)
+                for member in members:
+                    target = join(base_dir, member.name)
+                    if os.path.lexists(target) and not os.path.isdir(target):
+                        os.unlink(target)
+                kwargs = {}
+                if hasattr(tarfile, "data_filter"):
+                    # also checks the symlinks already extracted
+                    kwargs["filter"] = "data"
+                tar.extractall(base_dir, members=members, **kwargs)
+        except tarfile.TarError as e:
+            raise ValueError("Invalid artifact cache entry {}: {}".format(
+                filename, e))
+        for fn in manifest["removed"]:
+            target = join(base_dir, fn)
+            if not is_within(base_dir, dirname(target)):
+                raise ValueError("Unsafe path {} in {}".format(fn, filename))
+            if os.path.isdir(target) and not os.path.islink(target):
+                continue
+            with suppress(FileNotFoundError):
+                os.unlink(target)
+        return manifest
+
+
+def is_within(base_dir, path):
+    """True if `path` is in `base_dir` once the symbolic links resolved"""
+    base_dir = os.path.realpath(base_dir)
+    return os.path.commonpath([base_dir, os.path.realpath(path)]) == base_dir
+
+
+def check_member(base_dir, member, filename):
+    """Raise a ValueError if extracting the tar `member` into `base_dir`
+    would write outside of it, directly or through a link.
+    """
+    parts = member.name.split("/")
+    if member.name.startswith("/") or ".." in parts:
+        raise ValueError("Unsafe path {} in {}".format(member.name, filename))
+    path = join(base_dir, member.name)
+    if not is_within(base_dir, dirname(path)):
+        raise ValueError("Unsafe path {} in {}".format(member.name, filename))
+    if member.issym():
+        target = join(dirname(path), member.linkname)
+    elif member.islnk():
+        target = join(base_dir, member.linkname)
+    else:
+        return
+    if os.path.isabs(member.linkname) or not is_within(base_dir, target):
+        raise ValueError("Unsafe link {} -> {} in {}".format(
+            member.name, member.linkname, filename))
+
+
+class RemoteError(Exception):
+    pass
+
+
+class DirectoryRemote:
+    """Remote cache stored in a directory, e.g. on a shared filesystem"""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def __str__(self):
+        return self.root_dir
+
+    def get(self, key, filename):
+        """Copy the entry `key` to `filename`, return False if missing"""
+        try:
+            with open(join(self.root_dir, key), "rb") as src:
+                with open(filename, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def exists(self, key):
+        return os.path.exists(join(self.root_dir, key))
+
+    def put(self, key, filename):
+        target = join(self.root_dir, key)
+        os.makedirs(dirname(target), exist_ok=True)
+        fd, tmp_fn = tempfile.mkstemp(dir=dirname(target), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as dst, open(filename, "rb") as src:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            os.replace(tmp_fn, target)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp_fn)
+            raise
+
+
+class HTTPRemote:
+    """Remote cache served over HTTP: entries are fetched with GET and
+    uploaded with PUT at `<base url>/<key>`. Both are streamed.
+    """
+
+    def __init__(self, base_url, timeout=60.):
+        import requests
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.errors = requests.RequestException
+
+    def __str__(self):
+        return self.base_url
+
+    def url(self, key):
+        return "{}/{}".format(self.base_url, key)
+
+    def get(self, key, filename):
+        try:
+            with self.session.get(self.url(key), stream=True,
+                                  timeout=self.timeout) as resp:
+                if resp.status_code == 404:
+                    return False
+                resp.raise_for_status()
+                with open(filename, "wb") as fd:
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        fd.write(chunk)
+        except self.errors as e:
+            raise RemoteError(e)
+        return True
+
+    def exists(self, key):
+        try:
+            resp = self.session.head(self.url(key), timeout=self.timeout)
+            if resp.status_code == 404:
+                return False
+            resp.raise_for_status()
+        except self.errors as e:
+            raise RemoteError(e)
+        return True
+
+    def put(self, key, filename):
+        headers = {"Content-Type": "application/gzip"}
+        try:
+            with open(filename, "rb") as fd:
+                resp = self.session.put(self.url(key), data=fd, headers=headers,
+                                        timeout=self.timeout)
+            resp.raise_for_status()
+        except self.errors as e:
+            raise RemoteError(e)
+
+
+def open_remote(location):
+    """Return the remote cache for `location`, an http(s) url or a
+    directory.
+    """
+    parsed = urlparse(location)
+    if parsed.scheme in ("http", "https"):
+        return HTTPRemote(location)
+    if parsed.scheme == "file":
+        return DirectoryRemote(parsed.path)
+    return DirectoryRemote(os.path.abspath(os.path.expanduser(location)))
@@ -0,0 +1,126 @@
+"""
+This module houses the download manager used to fetch the recipes archives.
+
+Connections are kept alive and pooled per host, interrupted downloads are
+resumed from their `.part` file with an HTTP Range request, and failures are
+retried with an exponential backoff. The manager is thread-safe, so several
+archives can be downloaded at the same time.
+"""
+import shutil
+import time
+from logging import getLogger
+from os import replace, unlink
+from os.path import basename, exists, getsize
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as TransferError
+
+
+logger = getLogger(__name__)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Downloader:
+    user_agent = (
+        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/28.0.1500.71 Safari/537.36')
+    chunk_size = 1024 * 1024
+
+    def __init__(self, max_attempts=5, backoff=1., max_backoff=60.,
+                 pool_size=10, timeout=60., progress_interval=5.):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = self.user_agent
+        # the archives are stored as sent, so the sizes and the Range offsets
+        # are those of the file, not of a compressed transfer
+        self.session.headers["Accept-Encoding"] = "identity"
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def download(self, url, filename):
+        """Download `url` into `filename`, resuming a previous partial
+        download if any. The file only appears once complete.
+        """
+        part_fn = "{}.part".format(filename)
+        attempts = 0
+        while True:
+            try:
+                self._fetch(url, part_fn)
+            except (requests.RequestException, TransferError, OSError,
+                    DownloadError) as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    logger.error('Max download attempts reached: {}'.format(attempts))
+                    raise
+                delay = min(self.max_backoff,
+                            self.backoff * 2 ** (attempts - 1))
+                logger.warning('Download of {} failed ({}). Retrying in {:.1f} seconds...'.format(
+                    url, e, delay))
+                time.sleep(delay)
+                continue
+            break
+        replace(part_fn, filename)
+        return filename
+
+    def _fetch(self, url, part_fn):
+        if urlparse(url).scheme not in ("http", "https"):
+            # e.g. ftp://, not handled by requests and without resume
+            with urlopen(url, timeout=self.timeout) as resp:
+                with open(part_fn, "wb") as fd:
+                    shutil.copyfileobj(resp, fd, self.chunk_size)
+            return
+        offset = getsize(part_fn) if exists(part_fn) else 0
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes={}-".format(offset)
+        with self.session.get(url, headers=headers, stream=True,
+                              timeout=self.timeout) as resp:
+            if resp.status_code == 416:
+                # the partial file is not usable, start over
+                unlink(part_fn)
+                raise DownloadError("invalid range for the partial file")
+            resp.raise_for_status()
+            if offset and resp.status_code != 206:
+                logger.info("Server does not support resuming, restarting {}".format(url))
+                offset = 0
+            elif offset:
+                logger.info("Resuming {} from {} bytes".format(url, offset))
+            size = resp.headers.get("Content-Length")
+            total = int(size) + offset if size else None
+
+            name = basename(url)
+            received = offset
+            last_report = time.monotonic()
+            with open(part_fn, "ab" if offset else "wb") as fd:
+                # not decoded, even if the server compresses anyway
+                for chunk in resp.raw.stream(self.chunk_size, decode_content=False):
+                    fd.write(chunk)
+                    received += len(chunk)
+                    now = time.monotonic()
+                    if now - last_report >= self.progress_interval:
+                        last_report = now
+                        self.report(name, received, total)
+
+        if total is not None and received != total:
+            raise DownloadError("incomplete download, got {} of {} bytes".format(
+                received, total))
+        self.report(name, received, total)
+
+    def report(self, name, received, total):
+        if total:
+            progression = '{0:.2f}%'.format(received * 100. / total)
+        else:
+            progression = '{0} bytes'.format(received)
+        logger.info('- Download {} {}'.format(name, progression))
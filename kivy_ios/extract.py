@@ -0,0 +1,273 @@
+"""
+This module houses the extraction of the recipe archives.
+
+The archives are extracted by tar and unzip without listing their members,
+as logging tens of thousands of names costs more than the extraction. The
+tarballs are decompressed by a multi-threaded program when one is available
+(pigz, pbzip2, xz -T0), piped into tar. Without tar or unzip, the archives
+are extracted in-process with tarfile and zipfile, the zip members being
+inflated by several threads.
+"""
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from os.path import basename, getsize, join
+
+
+logger = getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+# compression of the tarballs, by extension
+TAR_EXTENSIONS = {
+    ".tgz": "gz",
+    ".tar.gz": "gz",
+    ".tbz2": "bz2",
+    ".tar.bz2": "bz2",
+    ".tar.xz": "xz",
+}
+
+# tar options to decompress by itself, by compression
+TAR_OPTIONS = {
+    "gz": "-z",
+    "bz2": "-j",
+    "xz": "-J",
+}
+
+# arguments of the programs decompressing to stdout, by compression
+DECOMPRESS_ARGS = {
+    "gz": ["-dc"],
+    "bz2": ["-dc"],
+    "xz": ["-T0", "-dc"],
+}
+
+# zip archives with less members are extracted in-process by a single thread
+MIN_MEMBERS_PER_THREAD = 64
+
+
+class ExtractError(Exception):
+    pass
+
+
+class ExtractStats:
+    """What an extraction did, for the throughput report"""
+
+    def __init__(self, filename, backend):
+        self.filename = filename
+        self.backend = backend
+        self.size = getsize(filename)
+        self.duration = 0.
+
+    def __str__(self):
+        size = self.size / 1e6
+        return "{} ({:.1f} MB) in {:.1f}s, {:.1f} MB/s with {}".format(
+            basename(self.filename), size, self.duration,
+            size / max(self.duration, 1e-3), self.backend)
+
+
+def get_compression(filename):
+    """Return the compression of the archive `filename`, "zip" for a zip
+    archive, or None if the extension is unknown.
+    """
+    if filename.endswith(".zip"):
+        return "zip"
+    for extension, compression in TAR_EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+    return None
+
+
+def extract_archive(filename, dest_dir, programs=None, jobs=None):
+    """Extract the archive `filename` into `dest_dir`, decompressing with
+    the programs given as {compression: path} when set. Return the
+    `ExtractStats`.
+    """
+    compression = get_compression(filename)
+    if compression is None:
+        raise ExtractError("Cannot extract, unrecognized extension for {}".format(
+            filename))
+    start = time.monotonic()
+    if compression == "zip":
+        stats = extract_zip(filename, dest_dir, jobs or os.cpu_count() or 1)
+    else:
+        program = (programs or {}).get(compression)
+        stats = extract_tar(filename, dest_dir, compression, program)
+    stats.duration = time.monotonic() - start
+    logger.info("Extracted {}".format(stats))
+    return stats
+
+
+def extract_tar(filename, dest_dir, compression, program=None):
+    """Extract the tarball `filename` into `dest_dir`, decompressed by
+    `program` when set.
+    """
+    tar = shutil.which("tar")
+    if tar and program:
+        run_pipeline(filename, [
+            [program] + DECOMPRESS_ARGS[compression] + [filename],
+            [tar, "-x", "-f", "-", "-C", dest_dir]])
+        return ExtractStats(filename, "{} | tar".format(basename(program)))
+    if tar:
+        run_pipeline(filename, [
+            [tar, "-x", TAR_OPTIONS[compression], "-f", filename, "-C", dest_dir]])
+        return ExtractStats(filename, "tar")
+
+    if program:
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                [program] + DECOMPRESS_ARGS[compression] + [filename],
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr,
+                bufsize=CHUNK_SIZE)
+            try:
+                extract_stream(process.stdout, filename, dest_dir)
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            if returncode != 0:
+                stderr.seek(0)
+                raise ExtractError("Unable to extract {}, {} failed: {}".format(
+                    filename, basename(program),
+                    stderr.read().decode("utf-8", "replace").strip()))
+        return ExtractStats(filename, "{} | tarfile".format(basename(program)))
+
+    with open_decompressed(filename, compression) as stream:
+        extract_stream(stream, filename, dest_dir)
+    return ExtractStats(filename, "tarfile")
+
+
+def open_decompressed(filename, compression):
+    """Open the tarball `filename` for reading decompressed, in-process"""
+    # the fallbacks import their modules, not needed by most builds
+    if compression == "gz":
+        import gzip
+        return gzip.open(filename)
+    if compression == "bz2":
+        import bz2
+        return bz2.open(filename)
+    import lzma
+    return lzma.open(filename)
+
+
+def run_pipeline(filename, commands):
+    """Run the `commands`, each one reading the output of the previous one,
+    raise an ExtractError if one of them fails.
+    """
+    processes = []
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            stdin = subprocess.DEVNULL
+            for index, argv in enumerate(commands):
+                last = index == len(commands) - 1
+                process = subprocess.Popen(
+                    argv, stdin=stdin, stderr=stderr,
+                    stdout=subprocess.DEVNULL if last else subprocess.PIPE)
+                if processes:
+                    # the previous command gets SIGPIPE if this one fails
+                    processes[-1].stdout.close()
+                processes.append(process)
+                stdin = process.stdout
+            failed = [basename(argv[0]) for argv, process in zip(commands, processes)
+                      if process.wait() != 0]
+        except BaseException:
+            for process in processes:
+                process.kill()
+                process.wait()
+            raise
+        if failed:
+            stderr.seek(0)
+            raise ExtractError("Unable to extract {}, {} failed: {}".format(
+                filename, " and ".join(failed),
+                stderr.read().decode("utf-8", "replace").strip()))
+
+
+def extract_stream(stream, filename, dest_dir):
+    """Extract the uncompressed tar `stream` member by member"""
+    import tarfile
+    kwargs = {}
+    if hasattr(tarfile, "tar_filter"):
+        # what tar does: no members outside dest_dir, no setuid bits
+        kwargs["filter"] = "tar"
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as archive:
+            archive.extractall(dest_dir, **kwargs)
+        # up to the end of the data, for a truncated archive to fail and the
+        # program not to write into a closed pipe
+        while stream.read(CHUNK_SIZE):
+            pass
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise ExtractError("Unable to extract {}: {}".format(filename, e))
+
+
+def extract_zip(filename, dest_dir, jobs=1):
+    """Extract the zip archive `filename` into `dest_dir` with unzip, or
+    in-process with up to `jobs` threads.
+    """
+    unzip = shutil.which("unzip")
+    if unzip:
+        run_pipeline(filename, [[unzip, "-q", "-o", filename, "-d", dest_dir]])
+        return ExtractStats(filename, "unzip")
+
+    import zipfile
+    stats = ExtractStats(filename, "zipfile")
+    try:
+        with zipfile.ZipFile(filename) as archive:
+            members = archive.infolist()
+            threads = max(1, min(jobs, len(members) // MIN_MEMBERS_PER_THREAD))
+            if threads == 1:
+                extract_members(archive, members, dest_dir)
+                return stats
+        stats.backend = "zipfile, {} threads".format(threads)
+        # the threads would race to create the same directories
+        for directory in {member_dir(dest_dir, member.filename)
+                          for member in members}:
+            os.makedirs(directory, exist_ok=True)
+        with ThreadPoolExecutor(threads) as executor:
+            futures = [
+                executor.submit(extract_zip_members, filename,
+                                members[index::threads], dest_dir)
+                for index in range(threads)]
+            for future in futures:
+                future.result()
+    except (zipfile.BadZipFile, OSError) as e:
+        raise ExtractError("Unable to extract {}: {}".format(filename, e))
+    return stats
+
+
+def member_dir(dest_dir, name):
+    """Directory of the zip member `name` once extracted, as sanitized by
+    zipfile
+    """
+    parts = [part for part in name.split("/")[:-1] if part not in ("", ".", "..")]
+    return join(dest_dir, *parts)
+
+
+def extract_zip_members(filename, members, dest_dir):
+    # each thread reads through its own file
+    import zipfile
+    with zipfile.ZipFile(filename) as archive:
+        extract_members(archive, members, dest_dir)
+
+
+def extract_members(archive, members, dest_dir):
+    """Extract the `members` of the zip `archive`, with their permissions
+    and symbolic links, which zipfile ignores.
+    """
+    for member in members:
+        path = archive.extract(member, dest_dir)
+        mode = member.external_attr >> 16
+        if member.is_dir() or not mode:
+            continue
+        if stat.S_ISLNK(mode):
+            target = archive.read(member).decode("utf-8")
+            os.unlink(path)
+            os.symlink(target, path)
+        else:
+            os.chmod(path, stat.S_IMODE(mode) & 0o777)
@@ -0,0 +1,149 @@
+"""
+This module houses a GNU make compatible jobserver, shared by all the commands
+launched during a kivy-ios build.
+
+The tokens live in a named pipe. Every `make` (including the ones started by
+`cmake --build`) gets the pipe as file descriptors 3 and 4 and the matching
+`MAKEFLAGS`, so all of them draw from the same pool. Tools that cannot talk to
+a jobserver (ninja, xcodebuild) take some tokens before starting and get a
+matching slot count. Each recipe step running commands holds a token, which
+its commands use as their implicit one.
+"""
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from logging import getLogger
+from os.path import basename, join
+from threading import Lock, local
+
+import sh
+
+from kivy_ios.runner import command_argv
+
+logger = getLogger(__name__)
+
+# a `make` invoked with -jN ignores the jobserver, so these are removed
+RE_MAKE_JOBS = re.compile(r"^(-j\d*|--jobs(=\d+)?)$")
+RE_CMAKE_PARALLEL = re.compile(r"^(-j\d*|--parallel(=\d+)?)$")
+
+# opens the pipe as fd 3 and 4 before executing the real command, as `sh`
+# closes every inherited file descriptor
+LAUNCHER = 'fifo=$1; shift; exec 3<>"$fifo" 4<>"$fifo"; exec "$@"'
+
+
+class JobServer:
+    """Pool of `slots` job tokens. A running command owns an implicit token,
+    the one its recipe step holds (see `reserve`), so the commands of
+    several steps running at the same time share the `slots`.
+    """
+
+    #: jobserver used by `shprint`, see `start` and `stop`
+    instance = None
+
+    def __init__(self, slots):
+        self.slots = max(1, slots)
+        self.tmpdir = tempfile.mkdtemp(prefix="kivy-ios-jobserver-")
+        self.fifo = join(self.tmpdir, "jobserver")
+        os.mkfifo(self.fifo)
+        # keep the pipe open while the build runs, otherwise the tokens would
+        # be lost when no command holds it
+        self._fd = os.open(self.fifo, os.O_RDWR)
+        self._nonblock_fd = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+        self._lock = Lock()
+        self._reserved = local()
+        os.write(self._fd, b"+" * self.slots)
+
+    @classmethod
+    def start(cls, slots):
+        if cls.instance is None:
+            cls.instance = cls(slots)
+            logger.info("Jobserver started with {} slots".format(slots))
+        return cls.instance
+
+    @classmethod
+    def stop(cls):
+        if cls.instance is not None:
+            cls.instance.close()
+            cls.instance = None
+
+    def close(self):
+        os.close(self._nonblock_fd)
+        os.close(self._fd)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    @property
+    def makeflags(self):
+        # both spellings, older make only knows about --jobserver-fds and
+        # ignores unknown options coming from MAKEFLAGS
+        return "-j --jobserver-fds=3,4 --jobserver-auth=3,4"
+
+    def acquire(self, count):
+        """Take up to `count` tokens without waiting, return how many were
+        taken.
+        """
+        if count <= 0:
+            return 0
+        with self._lock:
+            try:
+                return len(os.read(self._nonblock_fd, count))
+            except BlockingIOError:
+                return 0
+
+    def release(self, count):
+        if count > 0:
+            os.write(self._fd, b"+" * count)
+
+    @contextmanager
+    def reserve(self):
+        """Hold a token while in the context, waiting for one if needed. A
+        thread already holding one keeps it.
+        """
+        if getattr(self._reserved, "token", False):
+            yield
+            return
+        os.read(self._fd, 1)
+        self._reserved.token = True
+        try:
+            yield
+        finally:
+            self._reserved.token = False
+            self.release(1)
+
+    @contextmanager
+    def command(self, command, args, kwargs):
+        """Adapt a `shprint` call to the jobserver, yield the new
+        `(command, args, kwargs)` to run.
+        """
+        name = basename(command_argv(command, [])[0])
+        args = list(args)
+        tokens = 0
+        if name in ("make", "gmake"):
+            args = [arg for arg in args if not RE_MAKE_JOBS.match(str(arg))]
+            command, args, kwargs = self._launch(command, args, kwargs)
+        elif name == "cmake" and "--build" in args:
+            args = [arg for arg in args if not RE_CMAKE_PARALLEL.match(str(arg))]
+            command, args, kwargs = self._launch(command, args, kwargs)
+        elif name == "ninja" and not any(str(arg).startswith("-j") for arg in args):
+            tokens = self.acquire(self.slots - 1)
+            args = ["-j{}".format(tokens + 1)] + args
+        elif name == "xcodebuild" and "-jobs" not in args:
+            tokens = self.acquire(self.slots - 1)
+            args = ["-jobs", str(tokens + 1)] + args
+        try:
+            yield command, args, kwargs
+        finally:
+            self.release(tokens)
+
+    def _launch(self, command, args, kwargs):
+        kwargs = dict(kwargs)
+        env = dict(kwargs.get("_env") or os.environ)
+        env["MAKEFLAGS"] = " ".join(
+            filter(None, [env.get("MAKEFLAGS"), self.makeflags]))
+        kwargs["_env"] = env
+        launcher = sh.Command("/bin/sh")
+        # the argument list of the command, as its path may contain spaces
+        args = (["-c", LAUNCHER, "kivy-ios-jobserver", self.fifo]
+                + command_argv(command, []) + args)
+        return launcher, args, kwargs
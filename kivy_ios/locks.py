@@ -0,0 +1,164 @@
+"""
+This module houses the locks coordinating several kivy-ios processes working
+on the same workspace.
+
+The locks are `flock` locks on files, released by the system if a process
+dies. Within a process, a lock is also a reentrant lock shared by all the
+threads, see `FileLock.get`. `SharedLock` coordinates the threads of a
+single process.
+"""
+import fcntl
+import os
+import threading
+from logging import getLogger
+from os.path import abspath, dirname
+
+
+logger = getLogger(__name__)
+
+
+class FileLock:
+    """Reader/writer lock on `path`. Use the lock itself as a context manager
+    to hold it exclusively, or `shared()` to only keep writers away.
+
+    A thread already holding the lock can take it again in any mode, the
+    first one is kept.
+    """
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, path, description=None):
+        self.path = path
+        self.description = description or path
+        self._lock = threading.RLock()
+        self._count = 0
+        self._fd = None
+
+    @classmethod
+    def get(cls, path, description=None):
+        """Return the lock of `path`, the same instance for the whole
+        process.
+        """
+        path = abspath(path)
+        with cls._registry_lock:
+            lock = cls._registry.get(path)
+            if lock is None:
+                lock = cls._registry[path] = cls(path, description)
+            return lock
+
+    def acquire(self, shared=False):
+        self._lock.acquire()
+        if self._count == 0:
+            try:
+                self._fd = self._lock_file(shared)
+            except BaseException:
+                self._lock.release()
+                raise
+        self._count += 1
+
+    def release(self):
+        self._count -= 1
+        if self._count == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+    def _lock_file(self, shared):
+        os.makedirs(dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info("Waiting for {} (locked by another process)".format(
+                    self.description))
+                fcntl.flock(fd, operation)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def shared(self):
+        return _SharedHold(self)
+
+
+class SharedLock:
+    """Reader/writer lock between the threads of the process. Use the lock
+    itself as a context manager to hold it exclusively, or `shared()` to
+    share it with other threads. A thread waiting to hold it exclusively
+    keeps the new ones from sharing it.
+
+    As for `FileLock`, a thread already holding the lock can take it again
+    in any mode, the first one is kept.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+        self._held = threading.local()
+
+    def acquire(self, shared=False):
+        depth = getattr(self._held, "depth", 0)
+        if depth:
+            self._held.depth = depth + 1
+            return
+        with self._condition:
+            if shared:
+                while self._exclusive or self._waiting:
+                    self._condition.wait()
+                self._shared += 1
+            else:
+                self._waiting += 1
+                try:
+                    while self._exclusive or self._shared:
+                        self._condition.wait()
+                finally:
+                    self._waiting -= 1
+                self._exclusive = True
+        self._held.depth = 1
+        self._held.shared = shared
+
+    def release(self):
+        self._held.depth -= 1
+        if self._held.depth:
+            return
+        with self._condition:
+            if self._held.shared:
+                self._shared -= 1
+            else:
+                self._exclusive = False
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def shared(self):
+        return _SharedHold(self)
+
+
+class _SharedHold:
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire(shared=True)
+        return self.lock
+
+    def __exit__(self, *args):
+        self.lock.release()
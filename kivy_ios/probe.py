@@ -0,0 +1,118 @@
+"""
+This module houses the probe of the host toolchain (Xcode SDKs, tools in the
+PATH, number of cores) done when creating a `Context`.
+
+The probe runs several commands, so its results are kept on disk and in
+memory, keyed by the selected Xcode, its modification time and the PATH. They
+are probed again when any of them changes, when a required tool was missing,
+or on demand with `refresh=True`.
+"""
+import json
+import os
+from logging import getLogger
+
+import sh
+
+from kivy_ios.cache import write_atomic
+
+
+logger = getLogger(__name__)
+
+# where xcode-select keeps the selected developer directory
+XCODE_SELECT_LINK = "/var/db/xcode_select_link"
+BASIC_TOOLS = ("pkg-config", "autoconf", "automake", "libtool")
+SDKS = ("iphoneos", "iphonesimulator", "macosx")
+# bumped when the results change, to ignore the older caches
+PROBE_VERSION = 3
+
+# results of the probes done by this process, by cache key
+_results = {}
+
+
+def get_probe_key():
+    """Return what the probe results depend on, without running any
+    command.
+    """
+    developer_dir = os.environ.get("DEVELOPER_DIR")
+    if not developer_dir:
+        try:
+            developer_dir = os.readlink(XCODE_SELECT_LINK)
+        except OSError:
+            developer_dir = None
+    mtime = None
+    if developer_dir:
+        try:
+            mtime = os.stat(developer_dir).st_mtime_ns
+        except OSError:
+            pass
+    return [PROBE_VERSION, developer_dir, mtime, os.environ.get("PATH", "")]
+
+
+def which(name):
+    path = sh.which(name)
+    return str(path) if path else None
+
+
+def sdk_path(sdk):
+    try:
+        return str(sh.xcrun("--sdk", sdk, "--show-sdk-path")).strip()
+    except sh.ErrorReturnCode:
+        return None
+
+
+def run_probe():
+    sdks = sh.xcodebuild("-showsdks").splitlines()
+    results = {
+        "sdks": [str(line) for line in sdks],
+        "xcode_path": str(sh.xcode_select("-print-path")).strip(),
+        "sdk_paths": {sdk: sdk_path(sdk) for sdk in SDKS},
+        "ccache": which("ccache"),
+        "cython": None,
+        "tools": {tool: which(tool) for tool in BASIC_TOOLS},
+        "pigz": which("pigz"),
+        "pbzip2": which("pbzip2"),
+        "xz": which("xz"),
+        "num_cores": None,
+    }
+    for cython_fn in ("cython-2.7", "cython"):
+        results["cython"] = which(cython_fn)
+        if results["cython"]:
+            break
+    try:
+        results["num_cores"] = int(sh.sysctl('-n', 'hw.ncpu'))
+    except Exception:
+        pass
+    return results
+
+
+def is_complete(results):
+    """True if nothing required was missing, so the results can be reused"""
+    sdks = " ".join(results["sdks"])
+    return bool(
+        "iphoneos" in sdks and "iphonesimulator" in sdks
+        and results["cython"] and all(results["tools"].values()))
+
+
+def probe_toolchain(cache_fn, refresh=False):
+    """Return the probe results, from the memory or the `cache_fn` cache
+    unless `refresh` is set.
+    """
+    key = get_probe_key()
+    memory_key = json.dumps(key)
+    if not refresh:
+        if memory_key in _results:
+            return _results[memory_key]
+        try:
+            with open(cache_fn) as fd:
+                cached = json.load(fd)
+            if cached.get("key") == key:
+                _results[memory_key] = cached["results"]
+                return cached["results"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+    logger.debug("Probing the toolchain")
+    results = run_probe()
+    if is_complete(results):
+        _results[memory_key] = results
+        write_atomic(cache_fn, json.dumps({"key": key, "results": results}))
+    return results
@@ -0,0 +1,190 @@
+"""
+This module houses the index of the recipes metadata.
+
+Commands that only need to know about the recipes (their version,
+dependencies, frameworks...) read them from this index instead of importing
+every recipe module. The index is built by parsing the recipe modules, only
+the class attributes with a literal value are indexed. It is saved as JSON
+and a recipe is parsed again when its module changes.
+"""
+import ast
+import json
+import os
+from logging import getLogger
+from os.path import exists, isdir, join
+
+from kivy_ios.cache import write_atomic
+
+
+logger = getLogger(__name__)
+
+# bumped when the content of the entries changes
+INDEX_VERSION = 1
+
+# base classes defined by the toolchain, whose attributes are the defaults
+KNOWN_BASES = ("Recipe", "PythonRecipe", "CythonRecipe")
+
+
+class NotIndexed(LookupError):
+    """The value is not known without importing the recipe"""
+
+
+def module_fn(recipe_dir):
+    return join(recipe_dir, "__init__.py")
+
+
+def parse_recipe(recipe_dir):
+    """Return the class attributes, methods and bases of the recipe
+    instantiated as `recipe` in the module of `recipe_dir`.
+    """
+    with open(module_fn(recipe_dir), "rb") as fd:
+        tree = ast.parse(fd.read())
+    classes = {}
+    recipe_class = None
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            classes[node.name] = node
+        elif (isinstance(node, ast.Assign) and len(node.targets) == 1
+              and isinstance(node.targets[0], ast.Name)
+              and node.targets[0].id == "recipe"
+              and isinstance(node.value, ast.Call)
+              and isinstance(node.value.func, ast.Name)):
+            recipe_class = node.value.func.id
+    if recipe_class not in classes:
+        return None
+
+    props = {}
+    dynamic = set()
+    methods = set()
+    bases = set()
+
+    def visit(cls):
+        # the bases first, so the subclass overrides their attributes
+        for base in cls.bases:
+            name = base.id if isinstance(base, ast.Name) else ast.dump(base)
+            if name in classes:
+                visit(classes[name])
+            else:
+                bases.add(name)
+        for node in cls.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                methods.add(node.name)
+                continue
+            if isinstance(node, ast.AnnAssign) and node.value is not None:
+                targets = [node.target]
+            elif isinstance(node, ast.Assign):
+                targets = node.targets
+            else:
+                continue
+            for target in targets:
+                if not isinstance(target, ast.Name):
+                    continue
+                try:
+                    props[target.id] = ast.literal_eval(node.value)
+                    dynamic.discard(target.id)
+                except ValueError:
+                    props.pop(target.id, None)
+                    dynamic.add(target.id)
+
+    visit(classes[recipe_class])
+    return {
+        "props": props,
+        "dynamic": sorted(dynamic),
+        "methods": sorted(methods),
+        "bases": sorted(bases),
+    }
+
+
+class RecipeInfo:
+    """Indexed metadata of a recipe. Attributes not set by the recipe have
+    the value of `defaults`; `NotIndexed` is raised if the value can only be
+    known by importing the recipe.
+    """
+
+    def __init__(self, name, entry, defaults):
+        self.name = name
+        self.recipe_dir = entry["dir"]
+        self.entry = entry
+        self.defaults = defaults
+
+    def __getattr__(self, prop):
+        entry = self.__dict__["entry"]
+        if prop in entry["props"]:
+            return entry["props"][prop]
+        if prop in entry["dynamic"] or not set(entry["bases"]) <= set(KNOWN_BASES):
+            raise NotIndexed("{}.{}".format(self.name, prop))
+        if prop in self.defaults:
+            return self.defaults[prop]
+        raise AttributeError(prop)
+
+    def overrides(self, method):
+        """True if the recipe defines `method`, or might do so"""
+        return (method in self.entry["methods"]
+                or not set(self.entry["bases"]) <= set(KNOWN_BASES))
+
+
+class RecipeIndex:
+    """Index of the recipes of `recipe_dirs` ({name: directory}), saved in
+    `filename`. Custom recipes indexed before stay in the index while their
+    directory exists.
+    """
+
+    def __init__(self, filename, recipe_dirs, defaults):
+        self.filename = filename
+        self.defaults = defaults
+        self.entries = {}
+        self._load()
+        changed = False
+        for name, recipe_dir in recipe_dirs.items():
+            changed |= self._refresh(name, recipe_dir)
+        for name, entry in list(self.entries.items()):
+            if name not in recipe_dirs and not isdir(entry["dir"]):
+                del self.entries[name]
+                changed = True
+        if changed:
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.filename) as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get("version") == INDEX_VERSION:
+            self.entries = data["recipes"]
+
+    def _save(self):
+        data = {"version": INDEX_VERSION, "recipes": self.entries}
+        try:
+            write_atomic(self.filename, json.dumps(data, indent=1, sort_keys=True))
+        except OSError as e:
+            logger.debug("Unable to save the recipe index: {}".format(e))
+
+    def _refresh(self, name, recipe_dir):
+        fn = module_fn(recipe_dir)
+        if not exists(fn):
+            return self.entries.pop(name, None) is not None
+        st = os.stat(fn)
+        stamp = [st.st_mtime_ns, st.st_size]
+        entry = self.entries.get(name)
+        if entry and entry["dir"] == recipe_dir and entry["stamp"] == stamp:
+            return False
+        try:
+            parsed = parse_recipe(recipe_dir)
+        except (SyntaxError, ValueError) as e:
+            logger.debug("Unable to index the recipe {}: {}".format(name, e))
+            parsed = None
+        if parsed is None:
+            # unknown layout, only usable by importing it
+            parsed = {"props": {}, "dynamic": [], "methods": [],
+                      "bases": ["?"]}
+        self.entries[name] = dict(parsed, dir=recipe_dir, stamp=stamp)
+        return True
+
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry is not None:
+            return RecipeInfo(name, entry, self.defaults)
+
+    def names(self):
+        return sorted(self.entries)
@@ -74,7 +74,7 @@ class FaissRecipe(PythonRecipe):
             command,
             "-C",
             "_build",
-            "-j",
+            self.ctx.concurrent_make,
             "faiss",
             # "faiss_avx2",
             _env=build_env)
@@ -116,7 +116,7 @@ class FaissRecipe(PythonRecipe):
             command,
             "-C",
             "_build_python",
-            "-j",
+            self.ctx.concurrent_make,
             "swigfaiss",
             # "swigfaiss_avx2",
             _env=build_env)
@@ -125,7 +125,7 @@ class FaissRecipe(PythonRecipe):
             command,
             "-C",
             "_build_python",
-            "-j",
+            self.ctx.concurrent_make,
             "swigfaiss",
             # "swigfaiss_avx2",
             _env=build_env)
@@ -135,22 +135,21 @@ class FaissRecipe(PythonRecipe):
 
         super(FaissRecipe, self).build_arch(arch)
 
-    def install(self):
-        arch = list(self.filtered_archs)[0]
-        build_dir = join(self.get_build_dir(arch.arch), "_build_python")
-        os.chdir(build_dir)
+    def install(self, job):
+        arch = job.arch
         hostpython = sh.Command(self.ctx.hostpython)
         build_env = arch.get_env()
         dest_dir = join(self.ctx.dist_dir, "root", "python3")
         build_env['PYTHONPATH'] = self.ctx.site_packages_dir
-        shprint(hostpython,
+        job.run(hostpython,
                 "setup.py",
                 "install",
                 "--single-version-externally-managed",
                 "--record=record.txt",
                 "--prefix",
                 dest_dir,
-                _env=build_env)
+                cwd="_build_python",
+                env=build_env)
 
         os.rename(
             join(self.ctx.dist_dir, "lib", "_swigfaiss.so"),
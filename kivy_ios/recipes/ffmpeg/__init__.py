@@ -1,5 +1,4 @@
-from kivy_ios.toolchain import Recipe, shprint
-from os.path import join
+from kivy_ios.toolchain import Recipe
 import sh
 
 
@@ -21,7 +20,7 @@ class FFMpegRecipe(Recipe):
     ]
     pbx_frameworks = ["VideoToolbox"]
 
-    def build_arch(self, arch):
+    def build_arch(self, arch, job):
         options = [
             "--disable-everything",
             "--enable-parsers",
@@ -59,8 +58,8 @@ class FFMpegRecipe(Recipe):
 
         build_env = arch.get_env()
         build_env["VERBOSE"] = "1"
-        configure = sh.Command(join(self.build_dir, "configure"))
-        shprint(configure,
+        configure = sh.Command(job.path("configure"))
+        job.run(configure,
                 "--target-os=darwin",
                 "--arch={}".format(arch.arch),
                 "--cc={}".format(build_env["CC"]),
@@ -70,7 +69,7 @@ class FFMpegRecipe(Recipe):
                 "--extra-ldflags={}".format(build_env["LDFLAGS"]),
                 "--disable-x86asm",
                 *options,
-                _env=build_env)
+                env=build_env)
         """
         shprint(sh.sed,
                 "-i.bak",
@@ -86,9 +85,9 @@ class FFMpegRecipe(Recipe):
                     "s/%define HAVE_CLOSESOCKET 1//g",
                     "config.asm")
         """
-        shprint(sh.make, "clean", _env=build_env)
-        shprint(sh.make, self.ctx.concurrent_make, _env=build_env)
-        shprint(sh.make, "install")
+        job.run(sh.make, "clean", env=build_env)
+        job.run(sh.make, self.ctx.concurrent_make, env=build_env)
+        job.run(sh.make, "install")
 
 
 recipe = FFMpegRecipe()
@@ -23,7 +23,7 @@ class LibffiRecipe(Recipe):
             self.build(arch)
 
         # since we don't run cache_execution, call this here for `status`
-        self.update_state("{}.build_all".format(self.name), True)
+        self.update_state("{}.build_all".format(self.name), self.fingerprint)
 
     def prebuild_arch(self, arch):
         if self.has_marker("patched"):
@@ -41,7 +41,7 @@ class Hostpython3Recipe(Recipe):
         return
 
     def get_build_env(self):
-        sdk_path = sh.xcrun("--sdk", "macosx", "--show-sdk-path").strip()
+        sdk_path = self.ctx.sdk_paths["macosx"]
 
         build_env = self.ctx.env.copy()
         ccache = (build_env["CCACHE"] + ' ') if 'CCACHE' in build_env else ''
@@ -29,9 +29,9 @@ class KivyRecipe(CythonRecipe):
             join(self.ctx.dist_dir, "include", "common", "sdl2_mixer")])
         return env
 
-    def build_arch(self, arch):
+    def build_arch(self, arch, job):
         self._patch_setup()
-        super().build_arch(arch)
+        super().build_arch(arch, job)
 
     def _patch_setup(self):
         # patch setup to remove some functionnalities
@@ -52,7 +52,7 @@ class LibZBarRecipe(Recipe):
             "--disable-shared",
             _env=build_env)
         shprint(sh.make, 'clean')
-        shprint(sh.make, _env=build_env)
+        shprint(sh.make, self.ctx.concurrent_make, _env=build_env)
 
 
 recipe = LibZBarRecipe()
@@ -14,7 +14,7 @@ class NumpyRecipe(CythonRecipe):
     hostpython_prerequisites = ["Cython"]
     cythonize = False
 
-    def prebuild_arch(self, arch):
+    def prebuild_arch(self, arch, job):
         if self.has_marker("patched"):
             return
         self.apply_patch("duplicated_symbols.patch")
@@ -31,8 +31,8 @@ class NumpyRecipe(CythonRecipe):
         env["NPY_LAPACK_ORDER"] = ""
         return env
 
-    def build_arch(self, arch):
-        super().build_arch(arch)
+    def build_arch(self, arch, job):
+        super().build_arch(arch, job)
         sh.cp(sh.glob(join(self.build_dir, "build", "temp.*", "libnpy*.a")),
               self.build_dir)
 
@@ -37,7 +37,7 @@ class OpenMPRecipe(Recipe):
                     _env=build_env)
 
             command = sh.Command("make")
-            shprint(command, _env=build_env)
+            shprint(command, self.ctx.concurrent_make, _env=build_env)
 
         super(OpenMPRecipe, self).build_arch(arch)
 
@@ -24,7 +24,7 @@ class Python3Recipe(Recipe):
         ctx.site_packages_dir = join(
             ctx.python_prefix, "lib", ctx.python_ver_dir, "site-packages")
 
-    def prebuild_arch(self, arch):
+    def prebuild_arch(self, arch, job):
         # common to all archs
         if self.has_marker("patched"):
             return
@@ -37,7 +37,7 @@ class Python3Recipe(Recipe):
         self.append_file("ModulesSetup.mobile", "Modules/Setup.local")
         self.set_marker("patched")
 
-    def postbuild_arch(self, arch):
+    def postbuild_arch(self, arch, job):
         # include _sqlite module to .a
         py_arch = arch.arch
         if py_arch == "arm64":
@@ -55,7 +55,7 @@ class Python3Recipe(Recipe):
             "statement.o",
             "util.o",
         ]:
-            shprint(sh.Command(build_env['AR']),
+            job.run(sh.Command(build_env['AR']),
                     "-r",
                     "{}/{}".format(self.build_dir, self.library),
                     "{}/build/{}/Modules/_sqlite/{}".format(self.build_dir, tmp_folder, o_file))
@@ -69,14 +69,14 @@ class Python3Recipe(Recipe):
         build_env["CFLAGS"] += " --sysroot={}".format(arch.sysroot)
         return build_env
 
-    def build_arch(self, arch):
+    def build_arch(self, arch, job):
         build_env = self.get_build_env(arch)
-        configure = sh.Command(join(self.build_dir, "configure"))
+        configure = sh.Command(job.path("configure"))
         py_arch = arch.arch
         if py_arch == "arm64":
             py_arch = "aarch64"
         prefix = join(self.ctx.dist_dir, "root", "python3")
-        shprint(configure,
+        job.run(configure,
                 "CC={}".format(build_env["CC"]),
                 "LD={}".format(build_env["LD"]),
                 "CFLAGS={}".format(build_env["CFLAGS"].replace("-fembed-bitcode", "")),
@@ -128,8 +128,8 @@ class Python3Recipe(Recipe):
                     PYTHONPATH=$(shell test -f pybuilddir.txt && echo $(abs_builddir)/`cat pybuilddir.txt`:)$(srcdir)/Lib\
                     _PYTHON_SYSCONFIGDATA_NAME=_sysconfigdata_$(ABIFLAGS)_$(MACHDEP)_$(MULTIARCH)\
                     {}".format(sh.Command(self.ctx.hostpython)),
-                _env=build_env)
-        shprint(sh.make, self.ctx.concurrent_make, "CFLAGS={}".format(build_env["CFLAGS"]))
+                env=build_env)
+        job.run(sh.make, self.ctx.concurrent_make, "CFLAGS={}".format(build_env["CFLAGS"]))
 
     def install(self):
         arch = list(self.filtered_archs)[0]
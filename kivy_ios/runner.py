@@ -0,0 +1,184 @@
+"""
+This module houses the execution engine used by `shprint` to run the build
+commands.
+
+The output of a command (stdout and stderr merged) is read in large chunks
+from a non-blocking pipe and written as is to a file. Only the last lines are
+kept in memory, for the error report. Forwarding the output elsewhere, e.g.
+to the console, is optional and done per chunk, not per line.
+"""
+import os
+import selectors
+import subprocess
+import sys
+import time
+from collections import deque
+from logging import getLogger
+
+import sh
+
+
+logger = getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+# Linux only, macOS pipes grow on their own
+F_SETPIPE_SZ = 1031
+PIPE_SIZE = 1024 * 1024
+
+
+class CommandResult:
+    """Exit code, duration and peak memory (`max_rss`, in bytes) of a
+    command. Also available as the `result` attribute of the exception
+    raised on failure.
+    """
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.exit_code = None
+        self.duration = None
+        self.max_rss = None
+
+
+def wait(process):
+    """Wait for `process`, return its exit code and its resource usage"""
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        exit_code = -os.WTERMSIG(status)
+    else:
+        exit_code = os.WEXITSTATUS(status)
+    # reaped here, Popen must not wait for it again
+    process.returncode = exit_code
+    return exit_code, rusage
+
+
+class CommandTimeout(sh.ErrorReturnCode):
+    """Raised when a command runs longer than its timeout"""
+    exit_code = -9
+
+
+def command_argv(command, args):
+    """Return the argument list of `command` (a sh.Command, possibly baked,
+    or a string) called with `args`.
+    """
+    if isinstance(command, sh.Command):
+        argv = [command._path] + list(command._partial_baked_args)
+    else:
+        argv = str(command).split(" ")
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            argv.extend(arg)
+        else:
+            argv.append(arg)
+    return [
+        arg.decode("utf-8") if isinstance(arg, bytes) else str(arg)
+        for arg in argv]
+
+
+class Tail:
+    """Last `lines` lines of an output, fed by chunks"""
+
+    def __init__(self, lines=200):
+        self.lines = deque(maxlen=lines)
+        self.partial = b""
+
+    def feed(self, data):
+        data = self.partial + data
+        lines = data.split(b"\n")
+        self.partial = lines.pop()
+        self.lines.extend(lines)
+
+    def get(self):
+        lines = list(self.lines)
+        if self.partial:
+            lines.append(self.partial)
+        return b"\n".join(lines[-self.lines.maxlen:]) + b"\n"
+
+
+class LineWriter:
+    """Split the chunks of an output into lines, passed as str to
+    `callback`.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.partial = b""
+
+    def __call__(self, data):
+        data = self.partial + data
+        lines = data.split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.callback(line.decode("utf-8", "replace").rstrip("\r"))
+
+    def flush(self):
+        if self.partial:
+            self.callback(self.partial.decode("utf-8", "replace").rstrip("\r"))
+            self.partial = b""
+
+
+def run_command(argv, env=None, cwd=None, timeout=None, output=None,
+                on_output=None, tail_lines=200):
+    """Run `argv`, writing its output to the binary file `output` and
+    passing the chunks to `on_output` if given. Raise the `sh` exception
+    matching the exit code on failure, with the tail of the output. Return
+    a `CommandResult`.
+    """
+    result = CommandResult(argv)
+    start = time.monotonic()
+    # the file descriptors opened by python are not inherited, so there is
+    # no need for close_fds, which lets subprocess use posix_spawn/vfork
+    process = subprocess.Popen(
+        argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, env=env, cwd=cwd, close_fds=False,
+        bufsize=0)
+    fd = process.stdout.fileno()
+    try:
+        import fcntl
+        fcntl.fcntl(fd, F_SETPIPE_SZ, PIPE_SIZE)
+    except (ImportError, OSError):
+        pass
+    os.set_blocking(fd, False)
+    tail = Tail(tail_lines)
+    deadline = time.monotonic() + timeout if timeout else None
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    process.kill()
+                    break
+            if not selector.select(remaining):
+                continue
+            try:
+                data = os.read(fd, CHUNK_SIZE)
+            except BlockingIOError:
+                continue
+            if not data:
+                break
+            if output is not None:
+                output.write(data)
+            tail.feed(data)
+            if on_output is not None:
+                on_output(data)
+    process.stdout.close()
+    exit_code, rusage = wait(process)
+    result.exit_code = exit_code
+    result.duration = time.monotonic() - start
+    # kilobytes on Linux, bytes on macOS. Linux keeps the peak across exec,
+    # so it is at least the size of this process
+    result.max_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    if timed_out:
+        exc = CommandTimeout
+    elif exit_code > 0:
+        exc = getattr(sh, "ErrorReturnCode_{}".format(exit_code))
+    elif exit_code < 0:
+        exc = getattr(sh, "SignalException_{}".format(-exit_code))
+    else:
+        return result
+    error = exc(" ".join(argv), tail.get(), b"", truncate=False)
+    error.result = result
+    raise error
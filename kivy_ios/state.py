@@ -0,0 +1,168 @@
+"""
+This module houses the store of the build state (`dist/state.db`).
+
+The state lives in an SQLite database in WAL mode: each write only touches
+its own row, a crash can not leave a half written file, and several writes
+can be grouped into a single atomic commit with `StateStore.transaction`.
+A `state.db` written by older versions (a JSON document) is imported on first
+use, and kept as `state.db.json`.
+"""
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager, suppress
+from logging import getLogger
+from os.path import dirname, exists
+
+
+logger = getLogger(__name__)
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+CREATE_TABLE = (
+    "CREATE TABLE IF NOT EXISTS state "
+    "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+
+class StateStore:
+    """Key/value store with a dict-like interface, values are serialized to
+    JSON.
+    """
+
+    def __init__(self, filename, timeout=60.):
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._depth = 0
+        legacy = self._read_legacy(filename)
+        if legacy is not None:
+            self._import_legacy(filename, legacy)
+        self._db = sqlite3.connect(
+            filename, timeout=timeout, isolation_level=None,
+            check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(CREATE_TABLE)
+
+    @staticmethod
+    def _read_legacy(filename):
+        """Return the content of a JSON state, None if there is none"""
+        if not exists(filename):
+            return
+        with open(filename, "rb") as fd:
+            if fd.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC:
+                return
+        try:
+            with open(filename, encoding="utf-8") as fd:
+                return json.load(fd)
+        except ValueError:
+            logger.warning("Unable to read the state.db, content will be replaced.")
+            return {}
+
+    @staticmethod
+    def _import_legacy(filename, legacy):
+        """Replace the JSON state by a database holding the `legacy` content.
+        The database is written aside in one transaction, then renamed over
+        the JSON state, which is never lost if the import fails.
+        """
+        logger.info("Import the JSON state from {}".format(filename))
+        shutil.copyfile(filename, "{}.json".format(filename))
+        fd, tmp_fn = tempfile.mkstemp(dir=dirname(filename), prefix=".state-")
+        os.close(fd)
+        try:
+            db = sqlite3.connect(tmp_fn, isolation_level=None)
+            try:
+                db.execute(CREATE_TABLE)
+                db.execute("BEGIN IMMEDIATE")
+                db.executemany(
+                    "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                    [(key, json.dumps(value, ensure_ascii=False))
+                     for key, value in legacy.items()])
+                db.execute("COMMIT")
+            finally:
+                db.close()
+            os.replace(tmp_fn, filename)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp_fn)
+            raise
+
+    @contextmanager
+    def transaction(self):
+        """Group the writes done in the block into one atomic commit. Other
+        threads wait for the commit before writing. Transactions can be nested,
+        the outermost one commits.
+        """
+        with self._lock:
+            if self._depth == 0:
+                self._db.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._db.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self._db.execute("COMMIT")
+
+    def _query(self, sql, *params):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def __getitem__(self, key):
+        rows = self._query("SELECT value FROM state WHERE key = ?", key)
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        with self.transaction():
+            self._db.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                (key, data))
+
+    def __delitem__(self, key):
+        with self.transaction():
+            cursor = self._db.execute("DELETE FROM state WHERE key = ?", (key, ))
+            deleted = cursor.rowcount
+        if not deleted:
+            raise KeyError(key)
+
+    def __contains__(self, item):
+        return bool(self._query("SELECT 1 FROM state WHERE key = ?", item))
+
+    def get(self, item, default=None):
+        try:
+            return self[item]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key, in self._query("SELECT key FROM state ORDER BY key")]
+
+    def items(self):
+        return [(key, json.loads(value)) for key, value in self._query(
+            "SELECT key, value FROM state ORDER BY key")]
+
+    def remove_all(self, prefix):
+        with self.transaction():
+            self._db.execute(
+                "DELETE FROM state WHERE substr(key, 1, ?) = ?",
+                (len(prefix), prefix))
+
+    def sync(self):
+        """Writes are committed as they happen, only checkpoint the WAL"""
+        with self._lock:
+            if self._depth == 0:
+                self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with suppress(sqlite3.Error):
+            self.sync()
+        self._db.close()
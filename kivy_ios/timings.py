@@ -0,0 +1,194 @@
+"""
+This module houses the database of the build timings (`.cache/timings.db`).
+
+Every `toolchain build` is a run, and each phase of a recipe executed during
+the run (download, extract, build of an arch, lipo, install...) is recorded
+with its monotonic start time and duration. The runs are kept, so the
+durations of a run can be compared with the previous ones.
+"""
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from logging import getLogger
+from statistics import median
+
+
+logger = getLogger(__name__)
+
+# runs kept in the database
+MAX_RUNS = 100
+
+
+def format_duration(seconds):
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(int(seconds // 3600), int(seconds % 3600 // 60))
+    if seconds >= 60:
+        return "{}m{:02d}s".format(int(seconds // 60), int(seconds % 60))
+    return "{:.1f}s".format(seconds)
+
+
+class Span:
+    """A phase being timed, its `status` can be changed while running"""
+
+    def __init__(self, recipe, phase, arch):
+        self.recipe = recipe
+        self.phase = phase
+        self.arch = arch
+        self.status = "ok"
+        self.start = None
+        self.duration = None
+
+
+class TimingStore:
+    """Durations of the recipe phases of the last runs, stored in the SQLite
+    database `filename`.
+    """
+
+    def __init__(self, filename, timeout=60.):
+        self.filename = filename
+        self.run_id = None
+        self._origin = None
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(
+            filename, timeout=timeout, isolation_level=None,
+            check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL NOT NULL, "
+            "recipes TEXT NOT NULL, archs TEXT NOT NULL, duration REAL, "
+            "status TEXT)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS phases ("
+            "run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE, "
+            "recipe TEXT NOT NULL, arch TEXT NOT NULL, phase TEXT NOT NULL, "
+            "start REAL NOT NULL, duration REAL NOT NULL, "
+            "status TEXT NOT NULL)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS phases_run ON phases (run)")
+
+    def _execute(self, sql, *params):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def start_run(self, recipes, archs):
+        """Start recording a new run, building `recipes` for `archs`"""
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO runs (started, recipes, archs) VALUES (?, ?, ?)",
+                (time.time(), json.dumps(recipes), json.dumps(archs)))
+            self.run_id = cursor.lastrowid
+            self._origin = time.monotonic()
+            self._db.execute(
+                "DELETE FROM phases WHERE run <= ?",
+                (self.run_id - MAX_RUNS, ))
+            self._db.execute(
+                "DELETE FROM runs WHERE id <= ?", (self.run_id - MAX_RUNS, ))
+
+    def end_run(self, status):
+        with self._lock:
+            if self.run_id is None:
+                return
+            self._db.execute(
+                "UPDATE runs SET duration = ?, status = ? WHERE id = ?",
+                (self.elapsed(), status, self.run_id))
+            self.run_id = None
+
+    def elapsed(self):
+        """Seconds since the start of the run"""
+        return time.monotonic() - self._origin
+
+    @contextmanager
+    def span(self, recipe, phase, arch=None):
+        """Time the block as the `phase` of `recipe`, recorded in the
+        current run if any.
+        """
+        span = Span(recipe, phase, arch)
+        start = time.monotonic()
+        try:
+            yield span
+        except BaseException:
+            span.status = "failed"
+            raise
+        finally:
+            span.duration = time.monotonic() - start
+            with self._lock:
+                if self.run_id is not None:
+                    span.start = start - self._origin
+                    self._execute(
+                        "INSERT INTO phases (run, recipe, arch, phase, start, "
+                        "duration, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        self.run_id, recipe, arch or "", phase, span.start,
+                        span.duration, span.status)
+
+    # queries
+    def runs(self, limit=MAX_RUNS):
+        """Return the last `limit` finished runs, the most recent first"""
+        rows = self._execute(
+            "SELECT id, started, recipes, archs, duration, status FROM runs "
+            "WHERE duration IS NOT NULL ORDER BY id DESC LIMIT ?", limit)
+        return [{
+            "id": run_id, "started": started, "recipes": json.loads(recipes),
+            "archs": json.loads(archs), "duration": duration, "status": status,
+        } for run_id, started, recipes, archs, duration, status in rows]
+
+    def phases(self, run_id, recipe=None):
+        """Return the phases recorded in the run `run_id`"""
+        sql = ("SELECT recipe, arch, phase, start, duration, status "
+               "FROM phases WHERE run = ?")
+        params = [run_id]
+        if recipe is not None:
+            sql += " AND recipe = ?"
+            params.append(recipe)
+        rows = self._execute(sql + " ORDER BY start", *params)
+        return [{
+            "recipe": recipe, "arch": arch or None, "phase": phase,
+            "start": start, "duration": duration, "status": status,
+        } for recipe, arch, phase, start, duration, status in rows]
+
+    def history(self, phase="execute", before=None, status="ok"):
+        """Return the durations of `phase` for each recipe and arch, the
+        most recent first, as {(recipe, arch): [duration, ...]}. Only the
+        runs before `before` are considered if set.
+        """
+        sql = ("SELECT recipe, arch, duration FROM phases "
+               "WHERE phase = ? AND status = ?")
+        params = [phase, status]
+        if before is not None:
+            sql += " AND run < ?"
+            params.append(before)
+        durations = {}
+        for recipe, arch, duration in self._execute(
+                sql + " ORDER BY run DESC", *params):
+            durations.setdefault((recipe, arch or None), []).append(duration)
+        return durations
+
+    def expected_durations(self, phase="execute", runs=5):
+        """Return the median of the last `runs` durations of `phase` per
+        recipe (all archs added)
+        """
+        durations = {}
+        for (recipe, arch), values in self.history(phase).items():
+            durations[recipe] = durations.get(recipe, 0) + median(values[:runs])
+        return durations
+
+    def compare(self, run_id, runs=5):
+        """Return the phases of the run `run_id`, each one with the median
+        duration of the same phase over the `runs` previous runs (None if it
+        never ran before) as "previous".
+        """
+        phases = self.phases(run_id)
+        histories = {}
+        for phase in phases:
+            name = phase["phase"]
+            if name not in histories:
+                histories[name] = self.history(name, before=run_id)
+            values = histories[name].get((phase["recipe"], phase["arch"]))
+            phase["previous"] = median(values[:runs]) if values else None
+        return phases
+
+    def close(self):
+        self._db.close()
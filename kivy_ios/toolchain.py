@@ -8,45 +8,151 @@ This tool intend to replace all the previous tools/ in shell script.
 
 import argparse
 import sys
-from sys import stdout
-from os.path import join, dirname, realpath, exists, isdir, basename
-from os import listdir, unlink, makedirs, environ, chdir, getcwd, walk
+from os.path import join, dirname, realpath, exists, isdir, islink, basename
+from os import listdir, unlink, makedirs, environ, chdir, chmod, getcwd, stat, walk
 import sh
-import zipfile
-import tarfile
 import importlib
-import io
+import inspect
+import itertools
+import functools
+import hashlib
 import json
 import shutil
 import fnmatch
 import tempfile
-import time
-from contextlib import suppress
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import suppress, contextmanager
 from datetime import datetime
 from pprint import pformat
+from statistics import median
 import logging
-from urllib.request import FancyURLopener, urlcleanup
-from pbxproj import XcodeProject
-from pbxproj.pbxextensions.ProjectFiles import FileOptions
+from kivy_ios.buildlog import (
+    DEFAULT_TAIL_LINES, BuildLogHandler, command_log_dir, current_log, open_log)
+from kivy_ios.cache import (
+    ArtifactCache, DownloadCache, diff_snapshots, open_remote, snapshot)
+from kivy_ios.extract import extract_archive
+from kivy_ios.jobserver import JobServer
+from kivy_ios.locks import FileLock, SharedLock
+from kivy_ios.probe import get_probe_key, probe_toolchain
+from kivy_ios.recipe_index import NotIndexed, RecipeIndex
+from kivy_ios.runner import LineWriter, command_argv, run_command
+from kivy_ios.state import StateStore
+from kivy_ios.timings import TimingStore, format_duration
+from kivy_ios.trace import TraceRecorder
 
 curdir = dirname(__file__)
 
 initial_working_directory = getcwd()
 
-# For more detailed logging, use something like
-# format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(funcName)s():%(lineno)d] %(message)s'
-logging.basicConfig(format='[%(levelname)-8s] %(message)s',
-                    datefmt='%Y-%m-%d:%H:%M:%S',
-                    level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
-# Quiet the loggers we don't care about
-sh_logging = logging.getLogger('sh')
-sh_logging.setLevel(logging.WARNING)
+# seconds, expected build duration of a recipe when nothing is known
+DEFAULT_RECIPE_DURATION = 60
 
-logger = logging.getLogger(__name__)
+# files of the dist directory that are not outputs of the recipes
+DIST_EXCLUDE = (
+    "state.db", "state.db-wal", "state.db-shm", "state.db.json", ".lock")
+
+# The current working directory is shared by the whole process, any step that
+# relies on it must hold this lock while running.
+cwd_lock = threading.RLock()
+
+# console handler installed by `setup_logging`
+console_handler = None
 
 
 def shprint(command, *args, **kwargs):
+    if TraceRecorder.instance is not None:
+        return _traced_shprint(command, args, kwargs)
+    return _jobserver_shprint(command, args, kwargs)
+
+
+def _traced_shprint(command, args, kwargs):
+    argv = command_argv(command, args)
+    with TraceRecorder.instance.span(
+            basename(argv[0]), "command", cmd=" ".join(argv)) as trace_args:
+        result = None
+        try:
+            result = _jobserver_shprint(command, args, kwargs)
+            trace_args["exit_code"] = 0
+        except sh.ErrorReturnCode as e:
+            result = getattr(e, "result", None)
+            trace_args["exit_code"] = e.exit_code
+            raise
+        finally:
+            if result is not None:
+                trace_args["max_rss"] = result.max_rss
+        return result
+
+
+@contextmanager
+def jobserver_token():
+    """Hold a token of the jobserver, if any, for the commands run in the
+    context to use as their implicit one.
+    """
+    if JobServer.instance is None:
+        yield
+        return
+    with JobServer.instance.reserve():
+        yield
+
+
+def _jobserver_shprint(command, args, kwargs):
+    if JobServer.instance is not None:
+        with JobServer.instance.command(command, args, kwargs) as adapted:
+            return _shprint(*adapted)
+    return _shprint(command, args, kwargs)
+
+
+# options of the commands that `run_command` supports, the others go through
+# the iteration of `sh`
+RUNNER_KWARGS = {"_env", "_cwd", "_timeout"}
+command_counter = itertools.count(1)
+
+
+def _shprint(command, args, kwargs):
+    if not set(kwargs) <= RUNNER_KWARGS or environ.get("KIVYIOS_SHPRINT") == "sh":
+        return _sh_shprint(command, args, kwargs)
+    logger.info("Running Shell: {} {} {}".format(str(command), args, kwargs))
+    argv = command_argv(command, args)
+    echo = None
+    if console_shows(logging.DEBUG):
+        echo = LineWriter(log_command_output)
+    options = dict(env=kwargs.get("_env"), cwd=kwargs.get("_cwd"),
+                   timeout=kwargs.get("_timeout"), on_output=echo)
+    try:
+        log = current_log()
+        if log is not None:
+            # the command output goes to the log of the running phase
+            log.write_line("$ {}".format(" ".join(argv)))
+            return run_command(argv, output=log, **options)
+        log_dir = command_log_dir(join(initial_working_directory, "build", "logs"))
+        log_fn = join(log_dir, "{:05d}-{}.log".format(
+            next(command_counter), basename(argv[0])))
+        try:
+            with open(log_fn, "wb") as output:
+                return run_command(argv, output=output, **options)
+        except sh.ErrorReturnCode:
+            logger.error("Command failed, full output in {}".format(log_fn))
+            raise
+    finally:
+        if echo is not None:
+            echo.flush()
+
+
+def console_shows(level):
+    """True if the messages of `level` are shown on the console"""
+    if console_handler is not None:
+        return console_handler.level <= level
+    return logger.isEnabledFor(level)
+
+
+def log_command_output(line):
+    logger.debug(line, extra={"command_output": True})
+
+
+def _sh_shprint(command, args, kwargs):
     kwargs["_iter"] = True
     kwargs["_out_bufsize"] = 1
     kwargs["_err_to_out"] = True
@@ -59,6 +165,7 @@ def shprint(command, *args, **kwargs):
 
 
 def cache_execution(f):
+    @functools.wraps(f)
     def _cache_execution(self, *args, **kwargs):
         state = self.ctx.state
         key = "{}.{}".format(self.name, f.__name__)
@@ -66,12 +173,25 @@ def cache_execution(f):
         if args:
             for arg in args:
                 key += ".{}".format(arg)
-        if key in state and not force:
+        # the result is stamped with the fingerprint of the recipe inputs, so
+        # it is outdated as soon as one of them changes
+        stamp = self.fingerprint
+        if state.get(key) == stamp and not force:
             logger.debug("Cached result: {} {}. Ignoring".format(f.__name__.capitalize(), self.name))
             return
-        logger.info("{} {}".format(f.__name__.capitalize(), self.name))
-        f(self, *args, **kwargs)
-        self.update_state(key, True)
+        # each phase gets its own log, the steps it runs share it
+        arch = args[0].arch if args and isinstance(args[0], Arch) else None
+        log = current_log()
+        if arch or log is None or log.recipe != self.name:
+            log_context = open_log(
+                join(self.ctx.build_dir, "logs"), self.name, f.__name__,
+                arch=arch, tail_lines=self.ctx.log_tail)
+        else:
+            log_context = suppress()
+        with log_context, self.phase(f.__name__, arch):
+            logger.info("{} {}".format(f.__name__.capitalize(), self.name))
+            f(self, *args, **kwargs)
+        self.update_state(key, stamp)
     return _cache_execution
 
 
@@ -85,65 +205,21 @@ def remove_junk(d):
                 unlink(join(root, fn))
 
 
-class ChromeDownloader(FancyURLopener):
-    version = (
-        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
-        '(KHTML, like Gecko) Chrome/28.0.1500.71 Safari/537.36')
-
-
-urlretrieve = ChromeDownloader().retrieve
-
-
-class JsonStore:
-    """Replacement of shelve using json, needed for support python 2 and 3.
-    """
-
-    def __init__(self, filename):
-        self.filename = filename
-        self.data = {}
-        if exists(filename):
-            try:
-                with io.open(filename, encoding='utf-8') as fd:
-                    self.data = json.load(fd)
-            except ValueError:
-                logger.warning("Unable to read the state.db, content will be replaced.")
-
-    def __getitem__(self, key):
-        return self.data[key]
-
-    def __setitem__(self, key, value):
-        self.data[key] = value
-        self.sync()
-
-    def __delitem__(self, key):
-        del self.data[key]
-        self.sync()
-
-    def __contains__(self, item):
-        return item in self.data
-
-    def get(self, item, default=None):
-        return self.data.get(item, default)
-
-    def keys(self):
-        return self.data.keys()
-
-    def remove_all(self, prefix):
-        for key in tuple(self.data.keys()):
-            if not key.startswith(prefix):
-                continue
-            del self.data[key]
-        self.sync()
-
-    def sync(self):
-        with open(self.filename, 'w') as fd:
-            json.dump(self.data, fd, ensure_ascii=False)
-
-
 class Arch:
+    # paths of the SDK tools, by (sdk, tool)
+    _tools = {}
+    _tools_lock = threading.Lock()
+
     def __init__(self, ctx):
         self.ctx = ctx
-        self._ccsh = None
+        # compiler wrapper scripts, kept open as they are removed on close
+        self._wrappers = []
+        self._env_cache = {}
+        self._env_lock = threading.RLock()
+
+    @property
+    def sysroot(self):
+        return self.ctx.sdk_paths[self.sdk]
 
     def __str__(self):
         return self.arch
@@ -156,7 +232,35 @@ class Arch:
                 d.format(arch=self))
             for d in self.ctx.include_dirs]
 
+    def find_tool(self, name):
+        """Return the path of the SDK tool `name`, looked up once"""
+        key = (self.sdk, name)
+        with Arch._tools_lock:
+            path = Arch._tools.get(key)
+            if path is None:
+                path = Arch._tools[key] = sh.xcrun(
+                    "-find", "-sdk", self.sdk, name).strip()
+            return path
+
     def get_env(self):
+        """Return the compiler environment of the arch. The environment is
+        built once per include directories and ccache setting, each call
+        returns a copy that can be changed freely.
+        """
+        key = (tuple(self.ctx.include_dirs),
+               environ.get("USE_CCACHE", "1"), self.ctx.ccache)
+        with self._env_lock:
+            env = self._env_cache.get(key)
+            if env is None:
+                env = self._env_cache[key] = self._build_env()
+        return dict(env)
+
+    def invalidate_env(self):
+        """Forget the environments built by `get_env`"""
+        with self._env_lock:
+            self._env_cache.clear()
+
+    def _build_env(self):
         include_dirs = [
             "-I{}/{}".format(
                 self.ctx.include_dir,
@@ -166,8 +270,8 @@ class Arch:
             join(self.ctx.dist_dir, "include", self.arch))]
 
         env = {}
-        cc = sh.xcrun("-find", "-sdk", self.sdk, "clang").strip()
-        cxx = sh.xcrun("-find", "-sdk", self.sdk, "clang++").strip()
+        cc = self.find_tool("clang")
+        cxx = self.find_tool("clang++")
 
         # we put the flags in CC / CXX as sometimes the ./configure test
         # with the preprocessor (aka CC -E) without CFLAGS, which fails for
@@ -183,7 +287,7 @@ class Arch:
         use_ccache = environ.get("USE_CCACHE", "1")
         ccache = None
         if use_ccache == "1":
-            ccache = sh.which('ccache')
+            ccache = self.ctx.ccache
         if ccache:
             ccache = ccache.strip()
             env["USE_CCACHE"] = "1"
@@ -196,32 +300,32 @@ class Arch:
                 ('file_macro,time_macros,'
                  'include_file_mtime,include_file_ctime,file_stat_matches'))
 
-        if not self._ccsh:
-            self._ccsh = tempfile.NamedTemporaryFile()
-            self._cxxsh = tempfile.NamedTemporaryFile()
-            sh.chmod("+x", self._ccsh.name)
-            sh.chmod("+x", self._cxxsh.name)
-            self._ccsh.write(b'#!/bin/sh\n')
-            self._cxxsh.write(b'#!/bin/sh\n')
-            if ccache:
-                logger.info("CC and CXX will use ccache")
-                self._ccsh.write(
-                    (ccache + ' ' + cc + ' "$@"\n').encode("utf8"))
-                self._cxxsh.write(
-                    (ccache + ' ' + cxx + ' "$@"\n').encode("utf8"))
-            else:
-                logger.info("CC and CXX will not use ccache")
-                self._ccsh.write(
-                    (cc + ' "$@"\n').encode("utf8"))
-                self._cxxsh.write(
-                    (cxx + ' "$@"\n').encode("utf8"))
-            self._ccsh.flush()
-            self._cxxsh.flush()
-
-        env["CC"] = self._ccsh.name
-        env["CXX"] = self._cxxsh.name
-        env["AR"] = sh.xcrun("-find", "-sdk", self.sdk, "ar").strip()
-        env["LD"] = sh.xcrun("-find", "-sdk", self.sdk, "ld").strip()
+        ccsh = tempfile.NamedTemporaryFile()
+        cxxsh = tempfile.NamedTemporaryFile()
+        self._wrappers += [ccsh, cxxsh]
+        chmod(ccsh.name, 0o755)
+        chmod(cxxsh.name, 0o755)
+        ccsh.write(b'#!/bin/sh\n')
+        cxxsh.write(b'#!/bin/sh\n')
+        if ccache:
+            logger.info("CC and CXX will use ccache")
+            ccsh.write(
+                (ccache + ' ' + cc + ' "$@"\n').encode("utf8"))
+            cxxsh.write(
+                (ccache + ' ' + cxx + ' "$@"\n').encode("utf8"))
+        else:
+            logger.info("CC and CXX will not use ccache")
+            ccsh.write(
+                (cc + ' "$@"\n').encode("utf8"))
+            cxxsh.write(
+                (cxx + ' "$@"\n').encode("utf8"))
+        ccsh.flush()
+        cxxsh.flush()
+
+        env["CC"] = ccsh.name
+        env["CXX"] = cxxsh.name
+        env["AR"] = self.find_tool("ar")
+        env["LD"] = self.find_tool("ld")
         env["OTHER_CFLAGS"] = " ".join(include_dirs)
         env["OTHER_LDFLAGS"] = " ".join([
             "-L{}/{}".format(self.ctx.dist_dir, "lib"),
@@ -247,7 +351,6 @@ class Arch64Simulator(Arch):
     arch = "x86_64"
     triple = "x86_64-apple-darwin13"
     version_min = "-miphoneos-version-min=9.0"
-    sysroot = sh.xcrun("--sdk", "iphonesimulator", "--show-sdk-path").strip()
 
 
 class Arch64IOS(Arch):
@@ -255,7 +358,6 @@ class Arch64IOS(Arch):
     arch = "arm64"
     triple = "aarch64-apple-darwin13"
     version_min = "-miphoneos-version-min=9.0"
-    sysroot = sh.xcrun("--sdk", "iphoneos", "--show-sdk-path").strip()
 
 
 class Graph:
@@ -279,10 +381,12 @@ class Graph:
         if dependent in self.graph and dependency in self.graph:
             self.add(dependent, dependency)
 
-    def find_order(self):
+    def find_order(self, priorities=None):
         """Do a topological sort on a dependency graph
 
         :Parameters:
+            `priorities`: dict, optional
+                items with a higher priority come first when possible
             :Returns:
                 iterator, sorted items form first to last
         """
@@ -293,7 +397,7 @@ class Graph:
             if not leftmost:
                 raise ValueError('Dependency cycle detected! %s' % graph)
             # If there is more than one, sort them for predictable order
-            leftmost.sort()
+            sort_ready(leftmost, priorities)
             for result in leftmost:
                 # Yield and remove them from the graph
                 yield result
@@ -301,6 +405,74 @@ class Graph:
                 for bset in graph.values():
                     bset.discard(result)
 
+    def dependents(self):
+        """Return the reverse graph, mapping each package to the set of
+        packages depending on it.
+        """
+        dependents = {name: set() for name in self.graph}
+        for name, deps in self.graph.items():
+            for dep in deps:
+                dependents[dep].add(name)
+        return dependents
+
+    def critical_paths(self, durations):
+        """Return the duration of the longest chain of packages starting
+        with each package, `durations` being the duration of each package.
+        """
+        dependents = self.dependents()
+        paths = {}
+        # the dependents of a package come after it in the order
+        for name in reversed(list(self.find_order())):
+            paths[name] = durations[name] + max(
+                (paths[dependent] for dependent in dependents[name]), default=0)
+        return paths
+
+    def critical_chain(self, durations):
+        """Return the longest chain of packages, first to build first"""
+        paths = self.critical_paths(durations)
+        dependents = self.dependents()
+        chain = []
+        candidates = [name for name, deps in self.graph.items() if not deps]
+        while candidates:
+            name = max(candidates, key=lambda name: (paths[name], name))
+            chain.append(name)
+            candidates = dependents[name]
+        return chain
+
+    def simulate(self, durations, jobs, priorities=None):
+        """Simulate a build of the graph by `jobs` workers, return the start
+        time of each package and the total duration.
+        """
+        pending = dict((k, set(v)) for k, v in self.graph.items())
+        dependents = self.dependents()
+        running = []
+        starts = {}
+        now = 0.
+        while pending or running:
+            ready = [name for name, deps in pending.items() if not deps]
+            sort_ready(ready, priorities)
+            for name in ready[:jobs - len(running)]:
+                pending.pop(name)
+                starts[name] = now
+                running.append((now + durations[name], name))
+            if not running:
+                raise ValueError('Dependency cycle detected! %s' % pending)
+            running.sort()
+            now, name = running.pop(0)
+            for dependent in dependents[name]:
+                pending[dependent].discard(name)
+        return starts, now
+
+
+def sort_ready(names, priorities=None):
+    """Sort the packages ready to build, the ones with the highest priority
+    first, then by name.
+    """
+    if priorities is None:
+        names.sort()
+    else:
+        names.sort(key=lambda name: (-priorities.get(name, 0), name))
+
 
 class Context:
     env = environ.copy()
@@ -314,13 +486,30 @@ class Context:
     sdkver = None
     sdksimver = None
     so_suffix = None  # set by one of the hostpython
+    parallel_archs = False
+    prefetcher = None
+    verify_downloads = False
+    _downloader = None
+    # minimum free disk space to keep while prefetching sources
+    prefetch_min_free = 2 * 1024 ** 3
+    # probe the toolchain again instead of using the cached results
+    refresh_probe = False
+    # lines of the log shown when a phase fails
+    log_tail = DEFAULT_TAIL_LINES
 
     def __init__(self):
         self.include_dirs = []
+        self._thread_state = threading.local()
 
         ok = True
 
-        sdks = sh.xcodebuild("-showsdks").splitlines()
+        self.cache_dir = "{}/.cache".format(initial_working_directory)
+        probe = probe_toolchain(
+            join(self.cache_dir, "toolchain-probe.json"),
+            refresh=self.refresh_probe)
+        # once per process, the other contexts reuse the new results
+        Context.refresh_probe = False
+        sdks = probe["sdks"]
 
         # get the latest iphoneos
         iphoneos = [x for x in sdks if "iphoneos" in x]
@@ -342,7 +531,8 @@ class Context:
 
         # get the path for Developer
         self.devroot = "{}/Platforms/iPhoneOS.platform/Developer".format(
-            sh.xcode_select("-print-path").strip())
+            probe["xcode_path"])
+        self.sdk_paths = probe["sdk_paths"]
 
         # path to the iOS SDK
         self.iossdkroot = "{}/SDKs/iPhoneOS{}.sdk".format(
@@ -351,7 +541,6 @@ class Context:
         # root of the toolchain
         self.root_dir = realpath(dirname(__file__))
         self.build_dir = "{}/build".format(initial_working_directory)
-        self.cache_dir = "{}/.cache".format(initial_working_directory)
         self.dist_dir = "{}/dist".format(initial_working_directory)
         self.install_dir = "{}/dist/root".format(initial_working_directory)
         self.include_dir = "{}/dist/include".format(initial_working_directory)
@@ -360,32 +549,26 @@ class Context:
             Arch64IOS(self))
 
         # path to some tools
-        self.ccache = sh.which("ccache")
-        for cython_fn in ("cython-2.7", "cython"):
-            cython = sh.which(cython_fn)
-            if cython:
-                self.cython = cython
-                break
+        self.ccache = probe["ccache"]
+        self.cython = probe["cython"]
         if not self.cython:
             ok = False
             logger.error("Missing requirement: cython is not installed")
 
         # check the basic tools
-        for tool in ("pkg-config", "autoconf", "automake", "libtool"):
-            if not sh.which(tool):
+        for tool, path in probe["tools"].items():
+            if not path:
                 logger.error("Missing requirement: {} is not installed".format(
                     tool))
 
         if not ok:
             sys.exit(1)
 
-        self.use_pigz = sh.which('pigz')
-        self.use_pbzip2 = sh.which('pbzip2')
+        self.use_pigz = probe["pigz"]
+        self.use_pbzip2 = probe["pbzip2"]
+        self.use_xz = probe["xz"]
 
-        try:
-            num_cores = int(sh.sysctl('-n', 'hw.ncpu'))
-        except Exception:
-            num_cores = None
+        num_cores = probe["num_cores"]
         self.num_cores = num_cores if num_cores else 4  # default to 4 if we can't detect
 
         self.custom_recipes_paths = []
@@ -393,6 +576,19 @@ class Context:
         ensure_dir(self.build_dir)
         ensure_dir(self.cache_dir)
         ensure_dir(self.dist_dir)
+        # can be shared between workspaces
+        shared_cache_dir = environ.get("KIVYIOS_CACHE_DIR") or self.cache_dir
+        self.download_cache = DownloadCache(shared_cache_dir)
+        remote_cache = environ.get("KIVYIOS_REMOTE_CACHE")
+        self.artifact_cache = ArtifactCache(
+            join(shared_cache_dir, "artifacts"),
+            remote=open_remote(remote_cache) if remote_cache else None)
+        # held while a recipe installs its outputs into dist_dir, shared by
+        # the commands only reading it
+        self.dist_lock = FileLock.get(join(self.dist_dir, ".lock"), "dist/")
+        # shared by the recipe steps of this process, which can write into
+        # dist_dir too, held by a recipe while its artifact is captured
+        self.dist_writers = SharedLock()
         ensure_dir(join(self.dist_dir, "frameworks"))
         ensure_dir(self.install_dir)
         ensure_dir(self.include_dir)
@@ -406,15 +602,212 @@ class Context:
         self.env.pop("LDFLAGS", None)
 
         # set the state
-        self.state = JsonStore(join(self.dist_dir, "state.db"))
+        self.state = StateStore(join(self.dist_dir, "state.db"))
+
+    @property
+    def recipe_index(self):
+        """Metadata of the recipes, read without importing them"""
+        key = tuple(self.custom_recipes_paths)
+        if getattr(self, "_recipe_index_key", None) != key:
+            recipe_dirs = {
+                name: join(self.root_dir, "recipes", name)
+                for name in Recipe.list_recipes()}
+            for path in self.custom_recipes_paths:
+                recipe_dirs[basename(path.rstrip("/"))] = path
+            self._recipe_index = RecipeIndex(
+                join(self.cache_dir, "recipes-index.json"), recipe_dirs,
+                Recipe.props)
+            self._recipe_index_key = key
+        return self._recipe_index
+
+    @property
+    def timings(self):
+        """Durations of the recipe phases, recorded over the builds"""
+        if getattr(self, "_timings", None) is None:
+            makedirs(self.cache_dir, exist_ok=True)
+            self._timings = TimingStore(join(self.cache_dir, "timings.db"))
+        return self._timings
+
+    @property
+    def downloader(self):
+        if self._downloader is None:
+            from kivy_ios.download import Downloader
+            self._downloader = Downloader()
+        return self._downloader
+
+    def recipe_lock(self, name):
+        """Lock held while the recipe `name` is built"""
+        return FileLock.get(
+            join(self.build_dir, "locks", "{}.lock".format(name)),
+            "the build of {}".format(name))
+
+    @property
+    def cores(self):
+        """Number of cores available to the current thread, see
+        `limit_cores`.
+        """
+        return getattr(self._thread_state, "num_cores", self.num_cores)
+
+    @contextmanager
+    def limit_cores(self, num_cores):
+        """Restrict the number of cores used by the builds of the current
+        thread for the duration of the context.
+        """
+        previous = getattr(self._thread_state, "num_cores", None)
+        self._thread_state.num_cores = num_cores
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self._thread_state.num_cores
+            else:
+                self._thread_state.num_cores = previous
 
     @property
     def concurrent_make(self):
-        return "-j{}".format(self.num_cores)
+        return "-j{}".format(self.cores)
 
     @property
     def concurrent_xcodebuild(self):
-        return "IDEBuildOperationMaxNumberOfConcurrentCompileTasks={}".format(self.num_cores)
+        return "IDEBuildOperationMaxNumberOfConcurrentCompileTasks={}".format(self.cores)
+
+
+def accepts_job(step):
+    """Return True if the recipe `step` takes a `job` argument, meaning it
+    does not rely on the current working directory.
+    """
+    return "job" in inspect.signature(step).parameters
+
+
+def diff_inputs(before, after):
+    """Describe the differences between two `Recipe.get_fingerprint_inputs`
+    results.
+    """
+    reasons = []
+    for name in sorted(set(before) | set(after)):
+        old, new = before.get(name), after.get(name)
+        if old == new:
+            continue
+        if name == "depends":
+            old, new = old or {}, new or {}
+            for depend in sorted(set(old) | set(new)):
+                if depend not in old:
+                    reasons.append("new dependency {}".format(depend))
+                elif depend not in new:
+                    reasons.append("dependency {} removed".format(depend))
+                elif old[depend] != new[depend]:
+                    reasons.append("dependency {} changed".format(depend))
+        elif name == "recipe":
+            reasons.append("recipe files changed")
+        else:
+            reasons.append("{} changed ({} -> {})".format(name, old, new))
+    return reasons
+
+
+def hash_tree(directory):
+    """Return a digest of the names and content of the files in
+    `directory`, python caches excluded.
+    """
+    digest = hashlib.sha256()
+    for root, dirnames, filenames in walk(directory):
+        dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+        for fn in sorted(filenames):
+            if fn.endswith(".pyc"):
+                continue
+            path = join(root, fn)
+            digest.update(path[len(directory):].encode("utf-8") + b"\0")
+            with open(path, "rb") as fd:
+                digest.update(hashlib.sha256(fd.read()).digest())
+    return digest.hexdigest()
+
+
+def add_include_dir(recipe, ctx):
+    """Add the include directory of `recipe` (a Recipe or a RecipeInfo) to
+    the context.
+    """
+    include_dir = None
+    if recipe.include_dir:
+        include_name = recipe.include_name or recipe.name
+        if recipe.include_per_arch:
+            include_dir = join("{arch.arch}", include_name)
+        else:
+            include_dir = join("common", include_name)
+    if include_dir:
+        logger.info("Include dir added: {}".format(include_dir))
+        ctx.include_dirs.append(include_dir)
+
+
+def get_dist_libraries(recipe, ctx):
+    """Return the static libraries `recipe` (a Recipe or a RecipeInfo)
+    installs into the dist directory.
+    """
+    libraries = []
+    name = recipe.name
+    if not name.startswith("lib"):
+        name = "lib{}".format(name)
+    if recipe.library:
+        static_fn = join(ctx.dist_dir, "lib", "{}.a".format(name))
+        libraries.append(static_fn)
+    for library in recipe.libraries:
+        static_fn = join(ctx.dist_dir, "lib", basename(library))
+        libraries.append(static_fn)
+    return libraries
+
+
+def stat_tree(directory):
+    """Return a digest of the names, sizes and modification times of the
+    files in `directory`: a cheap change detector for `hash_tree`.
+    """
+    digest = hashlib.sha256()
+    for root, dirnames, filenames in walk(directory):
+        dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+        for fn in sorted(filenames):
+            if fn.endswith(".pyc"):
+                continue
+            path = join(root, fn)
+            st = stat(path)
+            digest.update("{}\0{}\0{}\0".format(
+                path[len(directory):], st.st_size, st.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class BuildJob:
+    """Execution context given to the recipe steps accepting a `job`
+    argument (`prebuild_arch`, `build_arch`, `postbuild_arch` and `install`).
+
+    It carries the build directory of the arch and its environment, and runs
+    commands with an explicit working directory. Steps using it must not rely
+    on the process working directory, so they can run concurrently in the
+    same process.
+    """
+
+    def __init__(self, recipe, arch, build_dir):
+        self.recipe = recipe
+        self.ctx = recipe.ctx
+        self.arch = arch
+        self.build_dir = build_dir
+        self._env = None
+
+    @property
+    def env(self):
+        """Environment of the recipe for this arch, computed on first use
+        """
+        if self._env is None:
+            self._env = self.recipe.get_recipe_env(self.arch)
+        return self._env
+
+    def path(self, *args):
+        """Return a path relative to the build directory"""
+        return join(self.build_dir, *args)
+
+    def run(self, command, *args, cwd=None, env=None, **kwargs):
+        """Run `command` via `shprint` from `cwd`, either absolute or
+        relative to the build directory (the default).
+        """
+        kwargs["_cwd"] = join(self.build_dir, cwd) if cwd else self.build_dir
+        if env is not None:
+            kwargs["_env"] = env
+        shprint(command, *args, **kwargs)
 
 
 class Recipe:
@@ -422,6 +815,7 @@ class Recipe:
         "is_alias": False,
         "version": None,
         "url": None,
+        "sha256": None,
         "archs": [],
         "depends": [],
         "optional_depends": [],
@@ -442,7 +836,51 @@ class Recipe:
         for prop, value in cls.props.items():
             if not hasattr(cls, prop):
                 setattr(cls, prop, value)
-        return super().__new__(cls)
+        instance = super().__new__(cls)
+        instance._thread_state = threading.local()
+        instance._build_dir = None
+        instance._fingerprint = None
+        instance._fingerprint_inputs = None
+        instance.resolved_depends = None
+        return instance
+
+    @property
+    def build_dir(self):
+        """Build directory of the arch currently built by this thread, as
+        archs of a recipe can be built at the same time.
+        """
+        return getattr(self._thread_state, "build_dir", self._build_dir)
+
+    @build_dir.setter
+    def build_dir(self, value):
+        self._thread_state.build_dir = value
+        self._build_dir = value
+
+    @property
+    def job(self):
+        """The `BuildJob` of the step currently run by this thread"""
+        return getattr(self._thread_state, "job", None)
+
+    def run_step(self, step, *args, job, cwd=None):
+        """Run a recipe `step` within the execution context `job`.
+
+        Steps accepting a `job` argument get it and run freely. The others are
+        considered to rely on the working directory: they are run one at a
+        time, from `cwd` if set. Either way, the step holds a jobserver token
+        while it runs, and `dist_writers` shared.
+        """
+        previous = self.job
+        self._thread_state.job = job
+        try:
+            if accepts_job(step):
+                with self.ctx.dist_writers.shared(), jobserver_token():
+                    return step(*args, job=job)
+            with self.ctx.dist_writers.shared(), jobserver_token(), cwd_lock:
+                if cwd:
+                    chdir(cwd)
+                return step(*args)
+        finally:
+            self._thread_state.job = previous
 
     # API available for recipes
     def download_file(self, url, filename, cwd=None):
@@ -452,39 +890,13 @@ class Recipe:
         if not url:
             return
 
-        def report_hook(index, blksize, size):
-            if size <= 0:
-                progression = '{0} bytes'.format(index * blksize)
-            else:
-                progression = '{0:.2f}%'.format(
-                        index * blksize * 100. / float(size))
-            stdout.write('- Download {}\r'.format(progression))
-            stdout.flush()
-
         if cwd:
             filename = join(cwd, filename)
         with suppress(FileNotFoundError):
             unlink(filename)
 
-        # Clean up temporary files just in case before downloading.
-        urlcleanup()
-
         logger.info('Downloading {0}'.format(url))
-        attempts = 0
-        while True:
-            try:
-                urlretrieve(url, filename, report_hook)
-            except OSError:
-                attempts += 1
-                if attempts >= 5:
-                    logger.error('Max download attempts reached: {}'.format(attempts))
-                    raise
-                logger.warning('Download failed. Retrying in 1 second...')
-                time.sleep(1)
-                continue
-            break
-
-        return filename
+        return self.ctx.downloader.download(url, filename)
 
     def extract_file(self, filename, cwd):
         """
@@ -493,29 +905,13 @@ class Recipe:
         if not filename:
             return
         logger.info("Extract {} into {}".format(filename, cwd))
-        if filename.endswith((".tgz", ".tar.gz", ".tar.xz")):
-            if self.ctx.use_pigz:
-                comp = '--use-compress-program={}'.format(self.ctx.use_pigz)
-            else:
-                comp = '-z'
-            shprint(sh.tar, "-C", cwd, "-xv", comp, "-f", filename)
-
-        elif filename.endswith((".tbz2", ".tar.bz2")):
-            if self.ctx.use_pbzip2:
-                comp = '--use-compress-program={}'.format(self.ctx.use_pbzip2)
-            else:
-                comp = '-j'
-            shprint(sh.tar, "-C", cwd, "-xv", comp, "-f", filename)
-
-        elif filename.endswith(".zip"):
-            shprint(sh.unzip, "-d", cwd, filename)
-
-        else:
-            logger.error("Cannot extract, unrecognized extension for {}".format(
-                filename))
-            raise Exception()
+        programs = {"gz": self.ctx.use_pigz, "bz2": self.ctx.use_pbzip2,
+                    "xz": self.ctx.use_xz}
+        extract_archive(filename, cwd, programs, jobs=self.ctx.num_cores)
 
     def get_archive_rootdir(self, filename):
+        import tarfile
+        import zipfile
         if filename.endswith((".tgz", ".tar.gz", "tar.xz", ".tbz2", ".tar.bz2")):
             try:
                 archive = tarfile.open(filename)
@@ -601,6 +997,15 @@ class Recipe:
 
     @property
     def archive_fn(self):
+        url = self.url.format(version=self.version)
+        fn = self.ctx.download_cache.lookup(url, self.sha256)
+        if fn:
+            return fn
+        return self.legacy_archive_fn
+
+    @property
+    def legacy_archive_fn(self):
+        """Location of the archives downloaded before the shared cache"""
         bfn = basename(self.url.format(version=self.version))
         fn = "{}/{}-{}".format(
             self.ctx.cache_dir,
@@ -617,17 +1022,7 @@ class Recipe:
 
     @property
     def dist_libraries(self):
-        libraries = []
-        name = self.name
-        if not name.startswith("lib"):
-            name = "lib{}".format(name)
-        if self.library:
-            static_fn = join(self.ctx.dist_dir, "lib", "{}.a".format(name))
-            libraries.append(static_fn)
-        for library in self.libraries:
-            static_fn = join(self.ctx.dist_dir, "lib", basename(library))
-            libraries.append(static_fn)
-        return libraries
+        return get_dist_libraries(self, self.ctx)
 
     def get_build_dir(self, arch):
         return join(self.ctx.build_dir, self.name, arch, self.archive_root)
@@ -636,16 +1031,7 @@ class Recipe:
 
     def init_with_ctx(self, ctx):
         self.ctx = ctx
-        include_dir = None
-        if self.include_dir:
-            include_name = self.include_name or self.name
-            if self.include_per_arch:
-                include_dir = join("{arch.arch}", include_name)
-            else:
-                include_dir = join("common", include_name)
-        if include_dir:
-            logger.info("Include dir added: {}".format(include_dir))
-            self.ctx.include_dirs.append(include_dir)
+        add_include_dir(self, ctx)
 
     def get_recipe_env(self, arch=None):
         """Return the env specialized for the recipe
@@ -694,13 +1080,189 @@ class Recipe:
                 self.ctx.state[key] = value
         return value
 
+    @property
+    def fingerprint_depends(self):
+        """Dependencies of the recipe in the build graph, or its mandatory and
+        already built optional dependencies.
+        """
+        if self.resolved_depends is not None:
+            return self.resolved_depends
+        depends = list(self.depends)
+        for depend in self.optional_depends:
+            if "{}.build_all".format(depend) in self.ctx.state:
+                depends.append(depend)
+        return sorted(set(depends) - {self.name})
+
+    def get_fingerprint_inputs(self):
+        """Return everything the outputs of the recipe are built from"""
+        ctx = self.ctx
+        depends = {
+            name: Recipe.get_recipe(name, ctx).fingerprint
+            for name in self.fingerprint_depends}
+        if self.is_alias:
+            return {"depends": depends}
+        archs = self.filtered_archs
+        return {
+            "name": self.name,
+            "version": str(self.version),
+            "url": str(self.url),
+            "sha256": str(self.sha256),
+            "recipe": hash_tree(self.recipe_dir),
+            "archs": " ".join(arch.arch for arch in archs),
+            "toolchain": " ".join(
+                [str(ctx.sdkver), str(ctx.sdksimver), ctx.devroot]
+                + [arch.version_min for arch in archs]),
+            "depends": depends,
+        }
+
+    @property
+    def fingerprint_inputs(self):
+        if self._fingerprint_inputs is None:
+            self._fingerprint_inputs = self.get_fingerprint_inputs()
+        return self._fingerprint_inputs
+
+    @property
+    def fingerprint(self):
+        """Digest of the inputs of the recipe, see `get_fingerprint_inputs`
+        """
+        if self._fingerprint is None:
+            data = json.dumps(self.fingerprint_inputs, sort_keys=True)
+            self._fingerprint = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        return self._fingerprint
+
+    def record_inputs(self):
+        """Remember the inputs the recipe has been built from"""
+        self.ctx.state["{}.inputs".format(self.name)] = self.fingerprint_inputs
+
+    def get_rebuild_reasons(self):
+        """Return why the recipe has to be built, or an empty list if it is up
+        to date.
+        """
+        state = self.ctx.state
+        value = state.get("{}.build_all".format(self.name))
+        if value is None:
+            return ["not built"]
+        if value is True or value == self.fingerprint:
+            return []
+        previous = state.get("{}.inputs".format(self.name))
+        if not previous:
+            return ["inputs unknown"]
+        return diff_inputs(previous, self.fingerprint_inputs) or ["inputs changed"]
+
+    def invalidate(self):
+        """Forget the build of the recipe if any of its inputs changed since.
+        Return the reasons to build it, see `get_rebuild_reasons`.
+        """
+        state = self.ctx.state
+        key = "{}.build_all".format(self.name)
+        if state.get(key) is True:
+            # built before the inputs were tracked, consider it up to date
+            with state.transaction():
+                self.update_state(key, self.fingerprint)
+                self.record_inputs()
+            return []
+        reasons = self.get_rebuild_reasons()
+        if reasons and key in state:
+            logger.info("Rebuild {}: {}".format(self.name, ", ".join(reasons)))
+            shutil.rmtree(join(self.ctx.build_dir, self.name), ignore_errors=True)
+            state.remove_all("{}.".format(self.name))
+        return reasons
+
+    @property
+    def cacheable(self):
+        """True if the outputs of the recipe can go in the artifact cache"""
+        return bool(self.ctx.artifact_cache) and not self.custom_dir
+
+    @property
+    def has_artifact(self):
+        """True if the recipe is not built and can be restored from the
+        artifact cache.
+        """
+        if not self.cacheable or not self.get_rebuild_reasons():
+            return False
+        return bool(self.ctx.artifact_cache.lookup(self.name, self.fingerprint))
+
+    def restore_artifact(self):
+        """Restore the outputs of the recipe from the artifact cache, return
+        True on success.
+        """
+        if not self.has_artifact:
+            return False
+        cache = self.ctx.artifact_cache
+        logger.info("Restore {} from the artifact cache".format(self.name))
+        # the state is committed with the dist lock held, so other processes
+        # never see the recipe built before its files are in place
+        with self.ctx.dist_lock:
+            try:
+                manifest = cache.restore(self.name, self.fingerprint, self.ctx.dist_dir)
+            except (OSError, ValueError) as e:
+                logger.warning("Unable to restore {} from the artifact cache, "
+                               "building it: {}".format(self.name, e))
+                return False
+            with self.ctx.state.transaction():
+                if manifest.get("archive_root"):
+                    self.ctx.state["{}.archive_root".format(self.name)] = manifest["archive_root"]
+                for step in ("download", "extract", "install_hostpython_prerequisites",
+                             "build_all"):
+                    self.update_state("{}.{}".format(self.name, step), self.fingerprint)
+                self.record_inputs()
+        return True
+
+    def store_artifact(self, changed, removed):
+        """Store the `changed` and `removed` paths of dist_dir, as installed
+        by the recipe, in the artifact cache.
+        """
+        metadata = {
+            "archive_root": self.ctx.state.get("{}.archive_root".format(self.name)),
+        }
+        try:
+            self.ctx.artifact_cache.store(
+                self.name, self.fingerprint, self.ctx.dist_dir,
+                changed, removed, metadata)
+        except OSError as e:
+            logger.warning("Unable to store {} in the artifact cache: {}".format(
+                self.name, e))
+
     def execute(self):
-        if self.custom_dir:
-            self.ctx.state.remove_all(self.name)
-        self.download()
-        self.extract()
-        self.install_hostpython_prerequisites()
-        self.build_all()
+        # another process building the same recipe is awaited, its cached
+        # steps are then skipped
+        with self.phase("execute") as span, self.ctx.recipe_lock(self.name):
+            if self.custom_dir:
+                self.ctx.state.remove_all(self.name)
+            elif self.restore_artifact():
+                span.status = "restored"
+                return
+            elif self.ctx.prefetcher:
+                self.ctx.prefetcher.wait(self)
+            if self.ctx.state.get("{}.build_all".format(self.name)) == self.fingerprint:
+                span.status = "cached"
+            self.download()
+            self.extract()
+            self.install_hostpython_prerequisites()
+            self.build_all()
+            self.record_inputs()
+
+    @contextmanager
+    def phase(self, name, arch=None):
+        """Time the block as the phase `name` of the recipe, for `arch` if
+        set.
+        """
+        tracer = TraceRecorder.instance
+        if tracer is None:
+            with self.ctx.timings.span(self.name, name, arch) as span:
+                yield span
+            return
+        title = "{} {}".format(self.name, name)
+        if arch:
+            title = "{} ({})".format(title, arch)
+        with tracer.span(title, "phase", recipe=self.name, phase=name,
+                         arch=arch) as trace_args:
+            span = None
+            try:
+                with self.ctx.timings.span(self.name, name, arch) as span:
+                    yield span
+            finally:
+                trace_args["status"] = span.status if span else "failed"
 
     @property
     def custom_dir(self):
@@ -731,10 +1293,14 @@ class Recipe:
             if exists(src_dir):
                 self.ctx.state[key] = basename(src_dir)
                 return
-            fn = self.archive_fn
-            if not exists(fn):
-                self.download_file(self.url.format(version=self.version), fn)
-            status = self.get_archive_rootdir(self.archive_fn)
+            url = self.url.format(version=self.version)
+            cache = self.ctx.download_cache
+            legacy_fn = self.legacy_archive_fn
+            if exists(legacy_fn) and not cache.lookup(url, self.sha256):
+                logger.info("Move {} to the download cache".format(legacy_fn))
+                cache.add(legacy_fn, url, self.sha256)
+            fn = cache.fetch(url, self.download_file, self.sha256)
+            status = self.get_archive_rootdir(fn)
             if status is not None:
                 self.ctx.state[key] = status
 
@@ -782,13 +1348,16 @@ class Recipe:
 
         self.set_marker("building")
 
-        chdir(self.build_dir)
+        job = BuildJob(self, arch, self.build_dir)
         logger.info("Prebuild {} for {}".format(self.name, arch.arch))
-        self.prebuild_arch(arch)
+        with self.phase("prebuild_arch", arch.arch):
+            self.run_step(self.prebuild_arch, arch, job=job, cwd=job.build_dir)
         logger.info("Build {} for {}".format(self.name, arch.arch))
-        self.build_arch(arch)
+        with self.phase("build_arch", arch.arch):
+            self.run_step(self.build_arch, arch, job=job, cwd=job.build_dir)
         logger.info("Postbuild {} for {}".format(self.name, arch.arch))
-        self.postbuild_arch(arch)
+        with self.phase("postbuild_arch", arch.arch):
+            self.run_step(self.postbuild_arch, arch, job=job, cwd=job.build_dir)
         self.delete_marker("building")
         self.set_marker("build_done")
 
@@ -798,9 +1367,27 @@ class Recipe:
         logger.info("Build {} for {} (filtered)".format(
             self.name,
             ", ".join([x.arch for x in filtered_archs])))
-        for arch in self.filtered_archs:
-            self.build(arch)
+        if self.ctx.parallel_archs and len(filtered_archs) > 1:
+            self.build_archs_concurrently(filtered_archs)
+        else:
+            for arch in filtered_archs:
+                self.build(arch)
 
+        if not self.cacheable:
+            with self.ctx.dist_lock:
+                self.install_all()
+            return
+        # the steps of the other recipes wait, for the snapshots to only
+        # differ by what this recipe installs
+        with self.ctx.dist_writers, self.ctx.dist_lock:
+            before = snapshot(self.ctx.dist_dir, exclude=DIST_EXCLUDE)
+            self.install_all()
+            after = snapshot(self.ctx.dist_dir, exclude=DIST_EXCLUDE)
+            self.store_artifact(*diff_snapshots(before, after))
+
+    def install_all(self):
+        """Install the outputs of the recipe into the dist directory"""
+        filtered_archs = self.filtered_archs
         name = self.name
         if self.library:
             logger.info("Create lipo library for {}".format(name))
@@ -826,25 +1413,50 @@ class Recipe:
         logger.info("Install python deps for {}".format(self.name))
         self.install_python_deps()
         logger.info("Install {}".format(self.name))
-        self.install()
+        arch = filtered_archs[0]
+        job = BuildJob(self, arch, self.get_build_dir(arch.arch))
+        self.run_step(self.install, job=job, cwd=self.build_dir)
+
+    def build_archs_concurrently(self, archs):
+        """Build all the `archs` at the same time, each one in its own
+        thread and with an equal share of the available cores.
+        """
+        num_cores = max(1, self.ctx.cores // len(archs))
+        logger.info("Build {} for {} concurrently, {} cores each".format(
+            self.name, ", ".join([x.arch for x in archs]), num_cores))
 
-    def prebuild_arch(self, arch):
+        def build(arch):
+            try:
+                with self.ctx.limit_cores(num_cores):
+                    self.build(arch)
+            finally:
+                with suppress(AttributeError):
+                    del self._thread_state.build_dir
+
+        with ThreadPoolExecutor(max_workers=len(archs)) as executor:
+            futures = [executor.submit(build, arch) for arch in archs]
+        for future in futures:
+            future.result()
+        # as after a sequential build, keep the last arch as build_dir
+        self.build_dir = self.get_build_dir(archs[-1].arch)
+
+    def prebuild_arch(self, arch, job=None):
         prebuild = "prebuild_{}".format(arch.arch)
         logger.debug("Invoking {}".format(prebuild))
         if hasattr(self, prebuild):
-            getattr(self, prebuild)()
+            self.run_step(getattr(self, prebuild), job=job, cwd=self.build_dir)
 
-    def build_arch(self, arch):
+    def build_arch(self, arch, job=None):
         build = "build_{}".format(arch.arch)
         logger.debug("Invoking {}".format(build))
         if hasattr(self, build):
-            getattr(self, build)()
+            self.run_step(getattr(self, build), job=job, cwd=self.build_dir)
 
-    def postbuild_arch(self, arch):
+    def postbuild_arch(self, arch, job=None):
         postbuild = "postbuild_{}".format(arch.arch)
         logger.debug("Invoking {}".format(postbuild))
         if hasattr(self, postbuild):
-            getattr(self, postbuild)()
+            self.run_step(getattr(self, postbuild), job=job, cwd=self.build_dir)
         remove_junk(self.build_dir)
 
     def update_state(self, key, value):
@@ -854,9 +1466,10 @@ class Recipe:
         but it needs to be done manually in recipes.
         """
         key_time = "{}.at".format(key)
-        self.ctx.state[key] = value
         now_str = str(datetime.utcnow())
-        self.ctx.state[key_time] = now_str
+        with self.ctx.state.transaction():
+            self.ctx.state[key] = value
+            self.ctx.state[key_time] = now_str
         logger.debug("New State: {} at {}".format(key, now_str))
 
     @cache_execution
@@ -947,7 +1560,7 @@ class Recipe:
             _pip(["install", dep])
 
     @cache_execution
-    def install(self):
+    def install(self, job=None):
         pass
 
     @classmethod
@@ -990,9 +1603,18 @@ class Recipe:
                         break
                 else:
                     raise
+            # a custom recipe module is executed on each load, keep its
+            # instance so its state (e.g. the fingerprint) is shared
+            cls.recipes[name] = recipe
+        if getattr(recipe, "ctx", None) is not ctx:
+            recipe.ctx = ctx
             recipe.init_after_import(ctx)
 
         if version:
+            if recipe.sha256 and version != recipe.version:
+                logger.info("Not checking the sha256 of {} for version {}".format(
+                    name, version))
+                recipe.sha256 = None
             recipe.version = version
 
         return recipe
@@ -1000,7 +1622,7 @@ class Recipe:
 
 class PythonRecipe(Recipe):
     @cache_execution
-    def install(self):
+    def install(self, job=None):
         self.install_python_package()
         self.reduce_python_package()
         remove_junk(self.ctx.site_packages_dir)
@@ -1018,7 +1640,6 @@ class PythonRecipe(Recipe):
             env = self.get_recipe_env(arch)
         logger.info("Install {} into the site-packages".format(name))
         build_dir = self.get_build_dir(arch.arch)
-        chdir(build_dir)
         hostpython = sh.Command(self.ctx.hostpython)
 
         shprint(
@@ -1029,6 +1650,7 @@ class PythonRecipe(Recipe):
             "--root", self.ctx.python_prefix,
             "--prefix", "",
             _env=env,
+            _cwd=build_dir,
         )
 
     def reduce_python_package(self):
@@ -1050,7 +1672,7 @@ class CythonRecipe(PythonRecipe):
         # doesn't (yet) have the executable bit hence we explicitly call it
         # with the Python interpreter
         cythonize_script = join(self.ctx.root_dir, "tools", "cythonize.py")
-        shprint(sh.python, cythonize_script, filename)
+        shprint(sh.python, cythonize_script, filename, _cwd=self.build_dir)
 
     def cythonize_build(self):
         if not self.cythonize:
@@ -1066,7 +1688,8 @@ class CythonRecipe(PythonRecipe):
             if fnmatch.filter(filenames, "*.so.libs"):
                 dirs.append(root)
         cmd = sh.Command(join(self.ctx.root_dir, "tools", "biglink"))
-        shprint(cmd, join(self.build_dir, "lib{}.a".format(self.name)), *dirs)
+        shprint(cmd, join(self.build_dir, "lib{}.a".format(self.name)), *dirs,
+                _cwd=self.build_dir)
 
     def get_recipe_env(self, arch):
         env = super().get_recipe_env(arch)
@@ -1078,24 +1701,230 @@ class CythonRecipe(PythonRecipe):
         env["ARCH"] = arch.arch
         return env
 
-    def build_arch(self, arch):
+    def build_arch(self, arch, job=None):
         build_env = self.get_recipe_env(arch)
         hostpython = sh.Command(self.ctx.hostpython)
         if self.pre_build_ext:
             with suppress(Exception):
                 shprint(hostpython, "setup.py", "build_ext", "-g",
-                        _env=build_env)
+                        _env=build_env, _cwd=self.build_dir)
         self.cythonize_build()
         shprint(hostpython, "setup.py", "build_ext", "-g",
-                _env=build_env)
+                _env=build_env, _cwd=self.build_dir)
         self.biglink()
 
 
-def build_recipes(names, ctx):
-    # gather all the dependencies
-    logger.info("Want to build {}".format(names))
+def execute_recipes(recipes, graph, jobs, priorities=None):
+    """Execute the `recipes` following the dependencies of the `graph`,
+    running up to `jobs` recipes at the same time.
+
+    A recipe is started as soon as all its own dependencies are built, so
+    independent branches of the graph are built concurrently. When several
+    recipes are ready, the ones with the highest `priorities` start first. On
+    failure, no new recipe is started, the running ones are awaited and the
+    first error is raised again.
+    """
+    recipes = {recipe.name: recipe for recipe in recipes}
+    pending = dict((k, set(v)) for k, v in graph.graph.items())
+    running = {}
+    # other nodes of the recipes started, done along with them
+    followers = {}
+    built = set()
+    error = None
+
+    def mark_done(name):
+        for deps in pending.values():
+            deps.discard(name)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            while error is None and len(running) < jobs:
+                ready = [name for name, deps in pending.items() if not deps]
+                sort_ready(ready, priorities)
+                if not ready:
+                    break
+                name = ready[0]
+                pending.pop(name)
+                # the nodes are the names asked for, version pins included
+                recipe = recipes.get(name.split("==")[0])
+                if recipe is None:
+                    # aliases have nothing to build
+                    mark_done(name)
+                    continue
+                if recipe.name in built:
+                    mark_done(name)
+                    continue
+                if recipe.name in followers:
+                    # asked for with and without a version pin
+                    followers[recipe.name].append(name)
+                    continue
+                followers[recipe.name] = []
+                logger.info("Start {} ({} running)".format(
+                    recipe.name, len(running) + 1))
+                running[executor.submit(recipe.execute)] = name
+            if not running:
+                if pending and error is None:
+                    raise ValueError('Dependency cycle detected! %s' % pending)
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as e:
+                    logger.error("Failed to build {}".format(name))
+                    if error is None:
+                        error = e
+                    continue
+                recipe_name = name.split("==")[0]
+                logger.info("Done {}".format(recipe_name))
+                built.add(recipe_name)
+                mark_done(name)
+                for follower in followers.pop(recipe_name):
+                    mark_done(follower)
+    if error is not None:
+        raise error
+
+
+class Prefetcher:
+    """Download and extract the sources of the `recipes` in the background,
+    in build order, with up to `jobs` recipes at the same time.
+
+    Builders only have to wait for the sources of the recipe they reach. A
+    recipe is not prefetched when the free disk space goes below
+    `Context.prefetch_min_free`: it will be fetched by its builder instead.
+    Nor when it can be restored from the artifact cache, which the workers
+    check, as it may ask the remote cache.
+    """
+
+    def __init__(self, ctx, recipes, jobs):
+        self.ctx = ctx
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.futures = {}
+        for recipe in recipes:
+            if recipe.custom_dir:
+                continue
+            self.futures[recipe.name] = self.executor.submit(
+                self.fetch, recipe)
+
+    def has_space(self):
+        ensure_dir(self.ctx.build_dir)
+        free = shutil.disk_usage(self.ctx.build_dir).free
+        return free >= self.ctx.prefetch_min_free
+
+    def fetch(self, recipe):
+        if recipe.has_artifact:
+            return
+        if not self.has_space():
+            logger.warning("Low disk space, not prefetching {}".format(
+                recipe.name))
+            return
+        logger.info("Prefetch {}".format(recipe.name))
+        recipe.download()
+        recipe.extract()
+
+    def wait(self, recipe):
+        """Wait for the sources of `recipe` to be ready. On failure, the
+        builder will download and extract them again by itself.
+        """
+        future = self.futures.get(recipe.name)
+        if future is None:
+            return
+        if not future.done():
+            logger.info("Waiting for the sources of {}".format(recipe.name))
+        try:
+            future.result()
+        except Exception as e:
+            logger.warning("Prefetch of {} failed: {}".format(recipe.name, e))
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+
+def verify_downloads(recipes, ctx):
+    """Check the cached archives of the `recipes` in parallel. The corrupted
+    ones are removed, and will be downloaded again.
+    """
+    archives = {}
+    for recipe in recipes:
+        if not recipe.url or recipe.custom_dir:
+            continue
+        url = recipe.url.format(version=recipe.version)
+        fn = ctx.download_cache.lookup(url, recipe.sha256)
+        if fn:
+            archives[fn] = recipe
+    logger.info("Verify {} cached archives".format(len(archives)))
+    for fn in ctx.download_cache.verify(list(archives), jobs=ctx.num_cores):
+        key = "{}.download".format(archives[fn].name)
+        if key in ctx.state:
+            del ctx.state[key]
+
+
+def get_build_stamp_key(names, archs, custom_recipes_paths):
+    """Key of the build stamp of a `toolchain build` invocation"""
+    data = json.dumps([sorted(names), archs, custom_recipes_paths])
+    return "build_stamp.{}".format(
+        hashlib.sha256(data.encode("utf-8")).hexdigest()[:16])
+
+
+def save_build_stamp(ctx, key, recipes, graph):
+    """Remember what the recipes of a successful build were built from, see
+    `is_build_up_to_date`.
+    """
+    if any(recipe.custom_dir for recipe in recipes):
+        return
+    absent = set()
+    for recipe in recipes:
+        absent.update(depend for depend in recipe.optional_depends
+                      if depend not in graph.graph)
+    st = stat(__file__)
+    ctx.state[key] = {
+        "toolchain": [st.st_size, st.st_mtime_ns],
+        "probe": get_probe_key(),
+        "recipes": {recipe.name: recipe.fingerprint for recipe in recipes},
+        "dirs": {recipe.name: [recipe.recipe_dir, stat_tree(recipe.recipe_dir)]
+                 for recipe in recipes},
+        "absent": sorted(absent),
+    }
+
+
+def is_build_up_to_date(key):
+    """Tell if nothing changed since the build stamped with `key`, without
+    probing the toolchain nor importing any recipe. A change of timestamp is
+    enough to answer no, the full check then decides from the content.
+    """
+    state_fn = join(initial_working_directory, "dist", "state.db")
+    if not exists(state_fn):
+        return False
+    state = StateStore(state_fn)
+    try:
+        stamp = state.get(key)
+        if not stamp:
+            return False
+        st = stat(__file__)
+        if stamp["toolchain"] != [st.st_size, st.st_mtime_ns]:
+            return False
+        if stamp["probe"] != get_probe_key():
+            return False
+        for name, fingerprint in stamp["recipes"].items():
+            if environ.get("{}_DIR".format(name.upper())):
+                return False
+            if state.get("{}.build_all".format(name)) != fingerprint:
+                return False
+        for name, (recipe_dir, digest) in stamp["dirs"].items():
+            if not isdir(recipe_dir) or stat_tree(recipe_dir) != digest:
+                return False
+        return not any("{}.build_all".format(name) in state
+                       for name in stamp["absent"])
+    finally:
+        state.close()
+
+
+def get_recipes_graph(names, ctx):
+    """Return the graph of the recipes `names` and of their dependencies"""
     graph = Graph()
-    ctx.wanted_recipes = names[:]
     recipe_to_load = names
     recipe_loaded = []
     while names:
@@ -1123,40 +1952,308 @@ def build_recipes(names, ctx):
             else:
                 graph.add_optional(name, depend)
         recipe_loaded.append(name)
+    return graph
+
+
+def get_expected_durations(ctx, graph):
+    """Return the expected build duration of each recipe of the `graph`,
+    from the previous builds. The recipes never built are expected to last
+    as long as the median recipe.
+    """
+    history = ctx.timings.expected_durations()
+    known = [history[name] for name in graph.graph if name in history]
+    default = median(known) if known else DEFAULT_RECIPE_DURATION
+    durations = {}
+    for name in graph.graph:
+        if Recipe.get_recipe(name, ctx).is_alias:
+            durations[name] = 0
+        else:
+            durations[name] = history.get(name, default)
+    return durations
+
 
-    build_order = list(graph.find_order())
+def resolve_recipes(names, ctx):
+    """Return the graph of the recipes `names` and of their dependencies, the
+    priorities of its recipes (see `Graph.critical_paths`) and the recipes to
+    build, aliases excluded, in build order.
+    """
+    logger.info("Want to build {}".format(names))
+    ctx.wanted_recipes = names[:]
+    graph = get_recipes_graph(names, ctx)
+    # start the recipes heading the longest chains first
+    priorities = graph.critical_paths(get_expected_durations(ctx, graph))
+    build_order = list(graph.find_order(priorities))
     logger.info("Build order is {}".format(build_order))
+    for name in build_order:
+        recipe = Recipe.get_recipe(name, ctx)
+        recipe.resolved_depends = sorted(graph.graph[name] - {name})
     recipes = [Recipe.get_recipe(name, ctx) for name in build_order]
     recipes = [recipe for recipe in recipes if not recipe.is_alias]
+    logger.info("Recipe order is {}".format([recipe.name for recipe in recipes]))
+    return graph, priorities, recipes
+
+
+def plan_recipe(recipe, histories):
+    """Return what building `recipe` would do, without changing the state,
+    the build directory or the caches:
+
+    - action: "build", "restore" or "up to date"
+    - reasons: why the recipe is built, see `get_rebuild_reasons`
+    - steps: the steps run, as {"step", "arch", "reason", "duration"}
+    - duration: the expected duration, from `histories` (the durations of
+      each phase, see `TimingStore.history`), None if never timed
+    """
+    ctx = recipe.ctx
+    state = ctx.state
+    name = recipe.name
+    plan = {"recipe": name, "action": "up to date", "reasons": [],
+            "steps": [], "duration": 0}
+
+    def expected(phase, arch=None):
+        values = histories[phase].get((name, arch))
+        return median(values[:5]) if values else None
+
+    if recipe.custom_dir:
+        plan["reasons"] = ["custom source directory"]
+    else:
+        plan["reasons"] = recipe.get_rebuild_reasons()
+    if not plan["reasons"]:
+        return plan
+    if recipe.cacheable:
+        location = ctx.artifact_cache.locate(name, recipe.fingerprint)
+        if location:
+            plan["action"] = "restore"
+            plan["steps"] = [{
+                "step": "restore", "arch": None, "duration": expected("restored"),
+                "reason": "in the {} artifact cache".format(location)}]
+            plan["duration"] = plan["steps"][0]["duration"]
+            return plan
+
+    # the state of an outdated recipe and its build directory are removed
+    # before building, see `invalidate`
+    plan["action"] = "build"
+    restart = bool(recipe.custom_dir) or "{}.build_all".format(name) in state
+
+    def step_reason(step):
+        if restart:
+            return "rebuild"
+        value = state.get("{}.{}".format(name, step))
+        if value == recipe.fingerprint:
+            return None
+        return "outdated" if value is not None else "not done"
+
+    def add_step(step, reason, arch=None, duration=None):
+        if duration is None:
+            duration = expected(step, arch)
+        plan["steps"].append({
+            "step": step, "arch": arch, "reason": reason, "duration": duration})
+
+    if step_reason("download"):
+        url = recipe.url.format(version=recipe.version)
+        if recipe.custom_dir:
+            reason = "copy {}".format(recipe.custom_dir)
+        elif exists(join(recipe.recipe_dir, recipe.url)):
+            reason = "source in the recipe"
+        elif (ctx.download_cache.lookup(url, recipe.sha256)
+              or exists(recipe.legacy_archive_fn)):
+            reason = "archive in the download cache"
+        else:
+            reason = "fetch {}".format(url)
+        add_step("download", reason)
+    for step in ("extract", "install_hostpython_prerequisites"):
+        if step == "install_hostpython_prerequisites" and not recipe.hostpython_prerequisites:
+            continue
+        reason = step_reason(step)
+        if reason:
+            add_step(step, reason)
+    archive_root = state.get("{}.archive_root".format(name))
+    for arch in recipe.filtered_archs:
+        reason = step_reason("build.{}".format(arch.arch))
+        if not reason:
+            continue
+        duration = None
+        if not restart and archive_root:
+            build_dir = join(ctx.build_dir, name, arch.arch, archive_root)
+            if exists(join(build_dir, ".building")):
+                reason = "incomplete build, restarted"
+            elif exists(join(build_dir, ".build_done")):
+                reason = "already built (build_done marker)"
+                duration = 0
+        add_step("build", reason, arch.arch, duration)
+    add_step("build_all", ", ".join(plan["reasons"]))
+
+    # build_all is timed with the builds of the archs, remove the ones it
+    # will not run
+    durations = [step["duration"] for step in plan["steps"] if step["step"] != "build"]
+    if None in durations:
+        plan["duration"] = None
+    else:
+        built = {step["arch"] for step in plan["steps"]
+                 if step["step"] == "build" and step["duration"] != 0}
+        skipped = [expected("build", arch.arch) or 0
+                   for arch in recipe.filtered_archs if arch.arch not in built]
+        plan["duration"] = max(0, sum(durations) - sum(skipped))
+    return plan
+
+
+def plan_build(names, ctx, jobs=1):
+    """Return what `build_recipes` would do, see `plan_recipe`, without doing
+    it. The recipes never timed are expected to last as long as a full build
+    of the median recipe.
+    """
+    graph, priorities, recipes = resolve_recipes(names, ctx)
+    timings = ctx.timings
+    histories = {phase: timings.history(phase) for phase in (
+        "download", "extract", "install_hostpython_prerequisites", "build",
+        "build_all")}
+    histories["restored"] = timings.history("execute", status="restored")
+    expected = get_expected_durations(ctx, graph)
+    plans = {recipe.name: plan_recipe(recipe, histories) for recipe in recipes}
+    # the nodes of the graph are the names given, version pins included
+    durations = {}
+    for node in graph.graph:
+        plan = plans.get(node.split("==")[0])
+        if plan is None:
+            durations[node] = 0
+            continue
+        if "guessed" not in plan:
+            plan["guessed"] = plan["duration"] is None
+            if plan["guessed"]:
+                plan["duration"] = expected[node] if plan["action"] == "build" else 0
+        durations[node] = plan["duration"]
+    makespan = graph.simulate(durations, jobs, priorities)[1]
+    plans = list(plans.values())
+    return {
+        "recipes": plans,
+        "archs": [arch.arch for arch in ctx.archs],
+        "jobs": jobs,
+        "duration": makespan,
+        "up_to_date": all(plan["action"] == "up to date" for plan in plans),
+    }
+
+
+def print_build_plan(plan):
+    """Print the result of `plan_build`"""
+    def duration(value, guessed=False):
+        if value is None:
+            return "?"
+        return "{}{}".format(format_duration(value), "*" if guessed else "")
+
+    counts = {}
+    for recipe in plan["recipes"]:
+        counts[recipe["action"]] = counts.get(recipe["action"], 0) + 1
+    print("Dry run for {}: {} to build, {} to restore, {} up to date".format(
+        " ".join(plan["archs"]), counts.get("build", 0),
+        counts.get("restore", 0), counts.get("up to date", 0)))
+    if plan["up_to_date"]:
+        print("Nothing to do")
+        return
+    print("Expected duration: {} with {} job(s)\n".format(
+        duration(plan["duration"]), plan["jobs"]))
+    for recipe in plan["recipes"]:
+        if recipe["action"] == "up to date":
+            print("  {:<24} up to date".format(recipe["recipe"]))
+            continue
+        print("  {:<24} {:<8} {:>9}  {}".format(
+            recipe["recipe"], recipe["action"],
+            duration(recipe["duration"], recipe["guessed"]),
+            ", ".join(recipe["reasons"])))
+        for step in recipe["steps"]:
+            name = step["step"]
+            if step["arch"]:
+                name = "{} ({})".format(name, step["arch"])
+            print("    {:<31} {:>9}  {}".format(
+                name, duration(step["duration"]), step["reason"]))
+    if any(recipe["guessed"] for recipe in plan["recipes"]):
+        print("\n* never built, guessed from the other recipes")
+
+
+def build_recipes(names, ctx, jobs=1, prefetch=0, explain=False,
+                  stamp_key=None):
+    # gather all the dependencies
+    graph, priorities, recipes = resolve_recipes(names, ctx)
     recipes_order = [recipe.name for recipe in recipes]
-    logger.info("Recipe order is {}".format(recipes_order))
     for recipe in recipes:
         recipe.init_with_ctx(ctx)
     for recipe in recipes:
-        recipe.execute()
+        if recipe.custom_dir:
+            reasons = ["custom source directory"]
+        else:
+            reasons = recipe.invalidate()
+        if explain:
+            logger.info("{}: {}".format(
+                recipe.name, ", ".join(reasons) if reasons else "up to date"))
+    if ctx.verify_downloads:
+        verify_downloads(recipes, ctx)
+    if prefetch > 0:
+        ctx.prefetcher = Prefetcher(ctx, recipes, prefetch)
+    ctx.timings.start_run(recipes_order, [arch.arch for arch in ctx.archs])
+    status = "failed"
+    try:
+        if jobs > 1:
+            execute_recipes(recipes, graph, jobs, priorities)
+        else:
+            for recipe in recipes:
+                recipe.execute()
+        if stamp_key is not None:
+            save_build_stamp(ctx, stamp_key, recipes, graph)
+        status = "ok"
+    finally:
+        ctx.timings.end_run(status)
+        if ctx.prefetcher:
+            ctx.prefetcher.shutdown()
+            ctx.prefetcher = None
 
 
 def ensure_dir(filename):
     makedirs(filename, exist_ok=True)
 
 
-def ensure_recipes_loaded(ctx):
-    for recipe in Recipe.list_recipes():
-        key = "{}.build_all".format(recipe)
+def get_built_recipes(ctx, props):
+    """Yield the built recipes, as RecipeInfo when `props` can be read from
+    the recipe index, or as Recipe when the recipe has to be imported.
+    """
+    index = ctx.recipe_index
+    for name in index.names():
+        key = "{}.build_all".format(name)
         if key not in ctx.state:
             continue
-        recipe = Recipe.get_recipe(recipe, ctx)
+        info = index.get(name)
+        try:
+            if not info.overrides("init_with_ctx"):
+                for prop in props:
+                    getattr(info, prop)
+                yield info
+                continue
+        except NotIndexed:
+            pass
+        # a custom recipe is imported from where it was indexed, its path is
+        # not given again after its build
+        if (info.recipe_dir not in ctx.custom_recipes_paths
+                and not isdir(join(ctx.root_dir, "recipes", name))):
+            ctx.custom_recipes_paths.append(info.recipe_dir)
+        try:
+            recipe = Recipe.get_recipe(name, ctx)
+        except Exception as e:
+            logger.warning("Unable to load the built recipe {}: {}".format(name, e))
+            continue
         recipe.init_with_ctx(ctx)
+        yield recipe
+
+
+def ensure_recipes_loaded(ctx):
+    """Initialize the context for all the built recipes, only importing the
+    ones that customize it.
+    """
+    props = ("include_dir", "include_per_arch", "include_name")
+    for recipe in get_built_recipes(ctx, props):
+        if not isinstance(recipe, Recipe):
+            add_include_dir(recipe, ctx)
 
 
 def _pip(args):
     ctx = Context()
-    for recipe in Recipe.list_recipes():
-        key = "{}.build_all".format(recipe)
-        if key not in ctx.state:
-            continue
-        recipe = Recipe.get_recipe(recipe, ctx)
-        recipe.init_with_ctx(ctx)
+    ensure_recipes_loaded(ctx)
     if not hasattr(ctx, "site_packages_dir"):
         logger.error("python must be compiled before using pip")
         sys.exit(1)
@@ -1177,7 +2274,8 @@ def _pip(args):
 
     logger.info("Executing pip with: {}".format(args))
     pip_cmd = sh.Command(pip_path)
-    shprint(pip_cmd, *args, _env=pip_env)
+    with ctx.dist_writers.shared(), ctx.dist_lock:
+        shprint(pip_cmd, *args, _env=pip_env)
 
 
 def _hostpython_pip(args):
@@ -1185,27 +2283,32 @@ def _hostpython_pip(args):
     pip_path = join(ctx.dist_dir, 'hostpython3', 'bin', 'pip3')
     logger.info("Executing pip for hostpython with: {}".format(args))
     pip_cmd = sh.Command(pip_path)
-    shprint(pip_cmd, *args)
+    with ctx.dist_writers.shared(), ctx.dist_lock:
+        shprint(pip_cmd, *args)
 
 
 def update_pbxproj(filename, pbx_frameworks=None):
-    # list all the compiled recipes
     ctx = Context()
+    with ctx.dist_lock.shared():
+        _update_pbxproj(ctx, filename, pbx_frameworks)
+
+
+def _update_pbxproj(ctx, filename, pbx_frameworks):
+    from pbxproj import XcodeProject
+    from pbxproj.pbxextensions.ProjectFiles import FileOptions
+    # list all the compiled recipes
     pbx_libraries = []
     if pbx_frameworks is None:
         pbx_frameworks = []
     frameworks = []
     libraries = []
     sources = []
-    for recipe in Recipe.list_recipes():
-        key = "{}.build_all".format(recipe)
-        if key not in ctx.state:
-            continue
-        recipe = Recipe.get_recipe(recipe, ctx)
-        recipe.init_with_ctx(ctx)
+    props = ("pbx_frameworks", "pbx_libraries", "library", "libraries",
+             "frameworks", "sources")
+    for recipe in get_built_recipes(ctx, props):
         pbx_frameworks.extend(recipe.pbx_frameworks)
         pbx_libraries.extend(recipe.pbx_libraries)
-        libraries.extend(recipe.dist_libraries)
+        libraries.extend(get_dist_libraries(recipe, ctx))
         frameworks.extend(recipe.frameworks)
         if recipe.sources:
             sources.append(recipe.name)
@@ -1226,7 +2329,7 @@ def update_pbxproj(filename, pbx_frameworks=None):
     logger.info("Analysis of {}".format(filename))
 
     project = XcodeProject.load(filename)
-    sysroot = sh.xcrun("--sdk", "iphonesimulator", "--show-sdk-path").strip()
+    sysroot = ctx.sdk_paths["iphonesimulator"]
 
     group = project.get_or_create_group("Frameworks")
     g_classes = project.get_or_create_group("Classes")
@@ -1275,6 +2378,8 @@ clean         Clean the build of the specified recipe
 distclean     Clean the build and the result
 recipes       List all the available recipes
 status        List all the recipes and their build status
+timings       Show where the time of the last builds was spent
+plan          Show the build order and the expected duration of a build
 build_info    Display the current build context and Architecture info
 
 Xcode:
@@ -1283,8 +2388,26 @@ update        Update an existing xcode project (frameworks, libraries..)
 launchimage   Create Launch images for your xcode project
 icon          Create Icons for your xcode project
 pip           Install a pip dependency into the distribution
-""")
+
+Options:
+--refresh-probe  Probe Xcode and the tools again instead of using the
+                 cached results
+--log-level LEVEL
+                 Level of the messages shown on the console (default INFO),
+                 the logs in build/logs/ get everything
+--log-tail N     Number of lines of the log shown when a phase fails
+                 (default {})
+""".format(DEFAULT_TAIL_LINES))
         parser.add_argument("command", help="Command to run")
+        if "--refresh-probe" in sys.argv:
+            sys.argv.remove("--refresh-probe")
+            Context.refresh_probe = True
+        level = self.pop_option("--log-level")
+        if level is not None:
+            set_console_level(level.upper())
+        log_tail = self.pop_option("--log-tail")
+        if log_tail is not None:
+            Context.log_tail = int(log_tail)
         args = parser.parse_args(sys.argv[1:2])
         if not hasattr(self, args.command):
             print('Unrecognized command')
@@ -1292,6 +2415,21 @@ pip           Install a pip dependency into the distribution
             exit(1)
         getattr(self, args.command)()
 
+    @staticmethod
+    def pop_option(name):
+        """Remove the option `name` and its value from the arguments, return
+        the value.
+        """
+        if name not in sys.argv:
+            return None
+        index = sys.argv.index(name)
+        if index + 1 >= len(sys.argv):
+            print("Missing value for {}".format(name))
+            exit(1)
+        value = sys.argv[index + 1]
+        del sys.argv[index:index + 2]
+        return value
+
     @staticmethod
     def find_xcodeproj(filename):
         if not filename.endswith(".xcodeproj"):
@@ -1305,22 +2443,66 @@ pip           Install a pip dependency into the distribution
         return filename
 
     def build(self):
-        ctx = Context()
         parser = argparse.ArgumentParser(
                 description="Build the toolchain")
         parser.add_argument("recipe", nargs="+", help="Recipe to compile")
         parser.add_argument("--arch", action="append",
                             help="Restrict compilation to this arch")
-        parser.add_argument("--concurrency", type=int, default=ctx.num_cores,
+        parser.add_argument("--concurrency", type=int,
                             help="number of concurrent build processes (where supported)")
-        parser.add_argument("--no-pigz", action="store_true", default=not bool(ctx.use_pigz),
+        parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="number of recipes built at the same time, "
+                                 "bounded by --concurrency. The recipe steps "
+                                 "without a `job` argument still run one at "
+                                 "a time")
+        parser.add_argument("--parallel-archs", action="store_true",
+                            help="build all the architectures of a recipe at "
+                                 "the same time, sharing --concurrency")
+        parser.add_argument("--prefetch", type=int, default=2,
+                            help="number of recipes downloaded and extracted "
+                                 "ahead of the builds, 0 to disable")
+        parser.add_argument("--verify-downloads", action="store_true",
+                            help="check the checksum of the cached archives "
+                                 "before building")
+        parser.add_argument("--explain", action="store_true",
+                            help="tell why each recipe is built or up to date")
+        parser.add_argument("--no-artifact-cache", action="store_true",
+                            help="always build the recipes instead of "
+                                 "restoring their cached outputs")
+        parser.add_argument("--remote-cache", metavar="LOCATION",
+                            help="url or directory of a remote artifact cache, "
+                                 "defaults to $KIVYIOS_REMOTE_CACHE")
+        parser.add_argument("--no-remote-push", action="store_true",
+                            help="only pull from the remote artifact cache")
+        parser.add_argument("--no-jobserver", action="store_true",
+                            help="do not share --concurrency between all the "
+                                 "make processes through a jobserver")
+        parser.add_argument("--no-pigz", action="store_true",
                             help="do not use pigz for gzip decompression")
-        parser.add_argument("--no-pbzip2", action="store_true", default=not bool(ctx.use_pbzip2),
+        parser.add_argument("--no-pbzip2", action="store_true",
                             help="do not use pbzip2 for bzip2 decompression")
+        parser.add_argument("--no-xz", action="store_true",
+                            help="do not use xz for xz decompression")
         parser.add_argument("--add-custom-recipe", action="append", default=[],
                             help="Path to custom recipe")
+        parser.add_argument("--trace", metavar="FILENAME",
+                            help="Save a timeline of the build, for "
+                                 "chrome://tracing or ui.perfetto.dev")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="show the steps the build would run and "
+                                 "why, without running them")
+        parser.add_argument("--json", action="store_true",
+                            help="with --dry-run, print the steps as JSON")
         args = parser.parse_args(sys.argv[2:])
 
+        stamp_key = get_build_stamp_key(
+            args.recipe, args.arch, args.add_custom_recipe)
+        if (not (args.explain or args.verify_downloads or args.dry_run)
+                and is_build_up_to_date(stamp_key)):
+            logger.info("Everything is up to date")
+            return
+
+        ctx = Context()
         if args.arch:
             if len(args.arch) == 1:
                 archs = args.arch[0].split()
@@ -1334,24 +2516,55 @@ pip           Install a pip dependency into the distribution
                     continue
             ctx.archs = [arch for arch in ctx.archs if arch.arch in archs]
             logger.info("Architectures restricted to: {}".format(archs))
-        ctx.num_cores = args.concurrency
+        if args.concurrency:
+            ctx.num_cores = args.concurrency
+        jobs = max(1, min(args.jobs, ctx.num_cores))
+        ctx.parallel_archs = args.parallel_archs
+        ctx.verify_downloads = args.verify_downloads
+        if args.no_artifact_cache:
+            ctx.artifact_cache = None
+        else:
+            if args.remote_cache:
+                ctx.artifact_cache.remote = open_remote(args.remote_cache)
+            ctx.artifact_cache.push = not args.no_remote_push
         if args.no_pigz:
             ctx.use_pigz = False
         if args.no_pbzip2:
             ctx.use_pbzip2 = False
-        ctx.use_pigz = ctx.use_pbzip2
+        if args.no_xz:
+            ctx.use_xz = False
         logger.info("Building with {} processes, where supported".format(ctx.num_cores))
+        if jobs > 1:
+            logger.info("Building up to {} recipes at the same time".format(jobs))
         if ctx.use_pigz:
             logger.info("Using pigz to decompress gzip data")
         if ctx.use_pbzip2:
             logger.info("Using pbzip2 to decompress bzip2 data")
+        if ctx.use_xz:
+            logger.info("Using xz to decompress xz data")
         for custom_recipe_path in args.add_custom_recipe:
             if exists(custom_recipe_path):
                 logger.info(f"Adding {custom_recipe_path} to custom recipes paths")
                 ctx.custom_recipes_paths.append(custom_recipe_path)
             else:
                 logger.error(f"{custom_recipe_path} isn't a valid path")
-        build_recipes(args.recipe, ctx)
+        if args.dry_run:
+            plan = plan_build(args.recipe, ctx, jobs)
+            if args.json:
+                print(json.dumps(plan, indent=1))
+            else:
+                print_build_plan(plan)
+            return
+        if not args.no_jobserver:
+            JobServer.start(ctx.num_cores)
+        if args.trace:
+            TraceRecorder.start(args.trace)
+        try:
+            build_recipes(args.recipe, ctx, jobs=jobs, prefetch=args.prefetch,
+                          explain=args.explain, stamp_key=stamp_key)
+        finally:
+            JobServer.stop()
+            TraceRecorder.stop()
 
     def recipes(self):
         parser = argparse.ArgumentParser(
@@ -1365,18 +2578,32 @@ pip           Install a pip dependency into the distribution
             print(" ".join(list(Recipe.list_recipes())))
         else:
             ctx = Context()
+            index = ctx.recipe_index
             for name in Recipe.list_recipes():
                 with suppress(Exception):
-                    recipe = Recipe.get_recipe(name, ctx)
+                    try:
+                        recipe = index.get(name)
+                        recipe.version
+                    except NotIndexed:
+                        recipe = Recipe.get_recipe(name, ctx)
                     print("{recipe.name:<12} {recipe.version:<8}".format(recipe=recipe))
 
     def clean(self):
         def clean_cache(recipe, ctx):
-            """ Remove download artifacts for this build. """
+            """ Forget the download artifacts for this build. The archives
+            in the shared download cache are kept. """
             recipe_inst = Recipe.get_recipe(recipe, ctx)
             recipe_inst.ctx = ctx
-            if exists(recipe_inst.archive_fn):
-                unlink(recipe_inst.archive_fn)
+            if not recipe_inst.url:
+                return
+            try:
+                with suppress(FileNotFoundError):
+                    unlink(recipe_inst.legacy_archive_fn)
+                ctx.download_cache.forget(
+                    recipe_inst.url.format(version=recipe_inst.version))
+            except OSError as e:
+                logger.warning("Unable to clean the download of {}: {}".format(
+                    recipe, e))
 
         parser = argparse.ArgumentParser(
                 description="Clean the build")
@@ -1386,17 +2613,29 @@ pip           Install a pip dependency into the distribution
         if args.recipe:
             for recipe in args.recipe:
                 logger.info("Cleaning {} build".format(recipe))
-                ctx.state.remove_all("{}.".format(recipe))
-                build_dir = join(ctx.build_dir, recipe)
-                shutil.rmtree(build_dir, ignore_errors=True)
-                clean_cache(recipe, ctx)
+                with ctx.recipe_lock(recipe):
+                    ctx.state.remove_all("{}.".format(recipe))
+                    build_dir = join(ctx.build_dir, recipe)
+                    shutil.rmtree(build_dir, ignore_errors=True)
+                    clean_cache(recipe, ctx)
         else:
             logger.info("Delete build directory")
             shutil.rmtree(ctx.build_dir, ignore_errors=True)
 
     def distclean(self):
         ctx = Context()
-        shutil.rmtree(ctx.build_dir, ignore_errors=True)
+        lock_fn = basename(ctx.dist_lock.path)
+        with ctx.dist_lock:
+            shutil.rmtree(ctx.build_dir, ignore_errors=True)
+            for fn in listdir(ctx.dist_dir):
+                path = join(ctx.dist_dir, fn)
+                if fn == lock_fn:
+                    continue
+                if isdir(path) and not islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    unlink(path)
+        # the lock file is only removed once released
         shutil.rmtree(ctx.dist_dir, ignore_errors=True)
         shutil.rmtree(ctx.cache_dir, ignore_errors=True)
 
@@ -1413,6 +2652,126 @@ pip           Install a pip dependency into the distribution
             print("{:<12} - {}".format(
                 recipe, status))
 
+    def timings(self):
+        parser = argparse.ArgumentParser(
+                description="Show where the time of the last build was spent, "
+                            "compared to the previous builds")
+        parser.add_argument("recipe", nargs="?",
+                            help="Show the phases of this recipe only")
+        parser.add_argument("--top", type=int, default=10,
+                            help="Number of recipes shown (default 10)")
+        parser.add_argument("--history", type=int, default=5,
+                            help="Number of previous builds compared (default 5)")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="Slowdown reported as a regression (default 0.2 for 20%%)")
+        args = parser.parse_args(sys.argv[2:])
+
+        # read without a Context, nothing has to be probed
+        timings_fn = join(initial_working_directory, ".cache", "timings.db")
+        store = TimingStore(timings_fn) if exists(timings_fn) else None
+        runs = store.runs(1) if store else []
+        if not runs:
+            print("No build timings recorded yet")
+            return
+        run = runs[0]
+        phases = store.compare(run["id"], args.history)
+        print("Last build: {} for {} in {} ({}, {})".format(
+            " ".join(run["recipes"]), " ".join(run["archs"]),
+            format_duration(run["duration"]), run["status"],
+            datetime.fromtimestamp(run["started"]).strftime("%Y-%m-%d %H:%M")))
+
+        def delta(phase):
+            if phase["previous"] is None:
+                return ""
+            diff = phase["duration"] - phase["previous"]
+            return "{}{} vs {}".format(
+                "+" if diff >= 0 else "-", format_duration(abs(diff)),
+                format_duration(phase["previous"]))
+
+        recipes = sorted(
+            (phase for phase in phases if phase["phase"] == "execute"
+             and (args.recipe is None or phase["recipe"] == args.recipe)),
+            key=lambda phase: phase["duration"], reverse=True)[:args.top]
+        print("\nSlowest recipes:")
+        for phase in recipes:
+            print("  {:<20} {:>8} {:<9} {}".format(
+                phase["recipe"], format_duration(phase["duration"]),
+                phase["status"], delta(phase)).rstrip())
+
+        # the phases nest (build_all > build > build_arch), show the innermost
+        print("\nPhases:")
+        for recipe in recipes:
+            print("  {}".format(recipe["recipe"]))
+            for phase in phases:
+                if (phase["recipe"] != recipe["recipe"]
+                        or phase["phase"] in ("execute", "build", "build_all")):
+                    continue
+                name = phase["phase"]
+                if phase["arch"]:
+                    name = "{} ({})".format(name, phase["arch"])
+                print("    {:<32} {:>8} {}".format(
+                    name, format_duration(phase["duration"]), delta(phase)).rstrip())
+
+        regressions = [
+            phase for phase in phases
+            if phase["status"] == "ok" and phase["previous"] is not None
+            and phase["phase"] not in ("execute", "build", "build_all")
+            and (args.recipe is None or phase["recipe"] == args.recipe)
+            and phase["duration"] - phase["previous"] > max(
+                args.threshold * phase["previous"], 1.)]
+        print("\nRegressions:" if regressions else "\nNo regressions")
+        for phase in sorted(regressions, key=lambda phase: phase[
+                "previous"] - phase["duration"]):
+            print("  {:<40} {:>8} {}".format(
+                "{} {} {}".format(
+                    phase["recipe"], phase["phase"], phase["arch"] or "").strip(),
+                format_duration(phase["duration"]), delta(phase)))
+
+    def plan(self):
+        parser = argparse.ArgumentParser(
+                description="Show the order and the expected duration of a "
+                            "build, from the durations of the previous builds")
+        parser.add_argument("recipe", nargs="+", help="Recipe to compile")
+        parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="Number of recipes built at the same time")
+        parser.add_argument("--critical-path", action="store_true",
+                            help="Show the longest chain of dependencies, "
+                                 "which bounds the duration of the build")
+        parser.add_argument("--add-custom-recipe", action="append", default=[],
+                            help="Path to custom recipe")
+        args = parser.parse_args(sys.argv[2:])
+
+        ctx = Context()
+        ctx.custom_recipes_paths.extend(
+            path for path in args.add_custom_recipe if exists(path))
+        graph = get_recipes_graph(args.recipe, ctx)
+        durations = get_expected_durations(ctx, graph)
+        history = ctx.timings.expected_durations()
+        priorities = graph.critical_paths(durations)
+        starts, makespan = graph.simulate(durations, args.jobs, priorities)
+
+        def describe(name):
+            if durations[name] == 0:
+                return "alias"
+            return "{:>8}{}".format(
+                format_duration(durations[name]),
+                "" if name in history else " (never built, guessed)")
+
+        print("Expected duration: {} with {} job(s), {} for one job".format(
+            format_duration(makespan), args.jobs,
+            format_duration(sum(durations.values()))))
+        if args.critical_path:
+            chain = graph.critical_chain(durations)
+            print("\nCritical path ({}):".format(
+                format_duration(sum(durations[name] for name in chain))))
+            for name in chain:
+                print("  {:<20} {}".format(name, describe(name)))
+        else:
+            print("\nOrder:")
+            for name in sorted(starts, key=lambda name: (starts[name], name)):
+                print("  {:>8}  {:<20} {}".format(
+                    format_duration(starts[name]), name, describe(name)))
+
     def create(self):
         parser = argparse.ArgumentParser(
                 description="Create a new xcode project")
@@ -1532,7 +2891,34 @@ pip           Install a pip dependency into the distribution
         command(images_xcassets, args.image)
 
 
+def setup_logging(level=logging.INFO):
+    """Show the messages of `level` on the console. The build logs get all
+    the messages of kivy-ios, whatever the level.
+    """
+    global console_handler
+    formatter = logging.Formatter('[%(levelname)-8s] %(message)s')
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    build_log_handler = BuildLogHandler()
+    build_log_handler.setFormatter(formatter)
+    root = logging.getLogger()
+    root.addHandler(console_handler)
+    root.addHandler(build_log_handler)
+    logging.getLogger("kivy_ios").setLevel(logging.DEBUG)
+    set_console_level(level)
+
+    # Quiet the loggers we don't care about
+    sh_logging = logging.getLogger('sh')
+    sh_logging.setLevel(logging.WARNING)
+
+
+def set_console_level(level):
+    console_handler.setLevel(level)
+    logging.getLogger().setLevel(level)
+
+
 def main():
+    setup_logging()
     ToolchainCL()
 
 
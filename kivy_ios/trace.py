@@ -0,0 +1,79 @@
+"""
+This module houses the timeline of a build (`toolchain build --trace`), saved
+in the Trace Event format read by chrome://tracing and https://ui.perfetto.dev.
+
+Each recipe phase and each command run by `shprint` is a span on the thread
+that ran it, so idle cores and serialization points show up at a glance.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from logging import getLogger
+
+from kivy_ios.cache import write_atomic
+
+
+logger = getLogger(__name__)
+
+
+class TraceRecorder:
+    """Spans of the build, saved to `filename` by `stop`"""
+
+    #: recorder used by the recipes phases and `shprint`, see `start`
+    instance = None
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.pid = os.getpid()
+        self.events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._origin = time.monotonic()
+
+    @classmethod
+    def start(cls, filename):
+        if cls.instance is None:
+            cls.instance = cls(filename)
+        return cls.instance
+
+    @classmethod
+    def stop(cls):
+        if cls.instance is not None:
+            cls.instance.save()
+            cls.instance = None
+
+    def _tid(self):
+        """Small and stable id of the current thread, named in the trace"""
+        thread = threading.current_thread()
+        tid = self._threads.get(thread.ident)
+        if tid is None:
+            tid = self._threads[thread.ident] = len(self._threads) + 1
+            self.events.append({
+                "name": "thread_name", "ph": "M", "pid": self.pid,
+                "tid": tid, "args": {"name": thread.name}})
+        return tid
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Record the block as a span, the yielded `args` can be completed
+        while running.
+        """
+        start = time.monotonic()
+        try:
+            yield args
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                self.events.append({
+                    "name": name, "cat": category, "ph": "X",
+                    "ts": round((start - self._origin) * 1e6),
+                    "dur": round((end - start) * 1e6),
+                    "pid": self.pid, "tid": self._tid(), "args": args})
+
+    def save(self):
+        with self._lock:
+            data = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+            write_atomic(self.filename, json.dumps(data))
+        logger.info("Build trace saved to {}".format(self.filename))
@@ -0,0 +1,115 @@
+import tarfile
+import threading
+import unittest
+from os.path import exists, join
+
+from workspace import WorkspaceTestCase, synthetic
+from kivy_ios import toolchain
+from kivy_ios.cache import ArtifactCache
+
+# install takes a while, the other recipe builds meanwhile
+SLOW_INSTALL = synthetic.BUILD_ARCH + '''
+
+    def install(self, job):
+        self.ctx.installing.set()
+        time.sleep(0.3)'''
+
+# build_arch also writes into dist_dir, while the other recipe installs
+DIST_BUILD_ARCH = '''    def download(self):
+        self.ctx.installing.wait(10)
+        super().download()
+
+    def build_arch(self, arch, job):
+        job.run(sh.Command("clang"), "-c", "{name}.c", "-o", "lib{name}.a")
+        with open(join(self.ctx.dist_dir, "{name}.txt"), "w") as fd:
+            fd.write(arch.arch)'''
+
+
+class BuildRecipesTest(WorkspaceTestCase):
+
+    graph = {"synth000": [], "synth001": ["synth000"]}
+
+    def build(self, names, jobs):
+        ctx = self.new_context(self.graph)
+        executed = []
+        execute = toolchain.Recipe.execute
+
+        def record(recipe):
+            executed.append(recipe.name)
+            return execute(recipe)
+
+        self.set_attr(toolchain.Recipe, "execute", record)
+        toolchain.build_recipes(names, ctx, jobs=jobs, prefetch=0)
+        return ctx, executed
+
+    def test_pinned_target(self):
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                toolchain.Recipe.recipes.clear()
+                ctx, executed = self.build(["synth001==2.0"], jobs)
+                for name in self.graph:
+                    self.assertIn("{}.build_all".format(name), ctx.state)
+                self.assertEqual(executed, ["synth000", "synth001"])
+
+    def test_pinned_dependency_with_jobs(self):
+        # synth000 is asked for with a pin, and by synth001 without
+        ctx, executed = self.build(["synth000==1.0", "synth001"], 2)
+        for name in self.graph:
+            self.assertIn("{}.build_all".format(name), ctx.state)
+        self.assertEqual(sorted(executed), ["synth000", "synth001"])
+
+    def test_legacy_steps_with_jobs(self):
+        # synth001 has a legacy build_arch, run from the build directory
+        self.graph = {"synth000": [], "synth001": [], "synth002": ["synth001"]}
+        ctx, executed = self.build(list(self.graph), 2)
+        for name in self.graph:
+            self.assertTrue(exists(join(ctx.dist_dir, "lib", "lib{}.a".format(name))))
+
+
+class ArtifactCaptureTest(WorkspaceTestCase):
+
+    def test_other_recipe_writing_dist(self):
+        graph = {"synth000": [], "synth001": []}
+        ctx = self.new_context(graph)
+        for name, steps in (("synth000", SLOW_INSTALL),
+                            ("synth001", DIST_BUILD_ARCH)):
+            with open(join(self.workspace, "recipes", name, "__init__.py"), "w") as fd:
+                fd.write("import time\nfrom os.path import join\n" +
+                         synthetic.RECIPE_TEMPLATE.format(
+                             name=name, depends=[], frameworks=[],
+                             build_arch=steps.format(name=name)))
+        ctx.artifact_cache = ArtifactCache(join(self.workspace, "artifacts"))
+        ctx.installing = threading.Event()
+        toolchain.build_recipes(list(graph), ctx, jobs=2, prefetch=0)
+        self.assertTrue(exists(join(ctx.dist_dir, "synth001.txt")))
+        recipe = toolchain.Recipe.get_recipe("synth000", ctx)
+        entry_fn = ctx.artifact_cache.entry_fn("synth000", recipe.fingerprint)
+        with tarfile.open(entry_fn) as tar:
+            self.assertEqual(tar.getnames(),
+                             ["manifest.json", "files/lib/libsynth000.a"])
+
+
+class PrefetcherTest(WorkspaceTestCase):
+
+    def test_artifact_checked_by_workers(self):
+        ctx = self.new_context({"synth000": [], "synth001": []})
+        recipes = [toolchain.Recipe.get_recipe(name, ctx)
+                   for name in ("synth000", "synth001")]
+        threads = []
+
+        def has_artifact(recipe):
+            # may ask the remote cache, must not delay the builders
+            threads.append(threading.current_thread())
+            return True
+
+        self.set_attr(toolchain.Recipe, "has_artifact", property(has_artifact))
+        prefetcher = toolchain.Prefetcher(ctx, recipes, 2)
+        for recipe in recipes:
+            prefetcher.wait(recipe)
+        prefetcher.shutdown()
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from workspace import ROOT_DIR  # noqa: F401, puts kivy_ios in the path
+from kivy_ios import buildlog
+
+
+class CommandLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp(prefix="kivy-ios-test-")
+        self.addCleanup(shutil.rmtree, self.log_dir, True)
+        self.commands_dir = join(self.log_dir, "commands")
+
+    def test_run_dir(self):
+        run_dir = buildlog.command_log_dir(self.log_dir)
+        self.assertEqual(os.path.dirname(run_dir), self.commands_dir)
+        self.assertTrue(run_dir.endswith("-{}".format(os.getpid())))
+        # the same for all the commands of the process
+        self.assertEqual(buildlog.command_log_dir(self.log_dir), run_dir)
+
+    def test_prune(self):
+        os.makedirs(self.commands_dir)
+        runs = ["20260101-0000{:02d}-1".format(index) for index in range(5)]
+        for name in runs:
+            os.makedirs(join(self.commands_dir, name))
+        run_dir = buildlog.command_log_dir(self.log_dir, keep=3)
+        self.assertEqual(
+            sorted(os.listdir(self.commands_dir)),
+            runs[3:] + [os.path.basename(run_dir)])
+
+
+class FailingFile(io.BytesIO):
+
+    def write(self, data):
+        raise OSError("No space left on device")
+
+
+class LogWriterTest(unittest.TestCase):
+
+    def test_write_error(self):
+        writer = buildlog.LogWriter()
+        writer.start()
+        failing, fd = FailingFile(), io.BytesIO()
+        with self.assertLogs("kivy_ios.buildlog", "WARNING") as logs:
+            for data in (b"a", b"b"):
+                writer.write(failing, data)
+                writer.write(fd, data)
+            self.assertTrue(writer.flush())
+        # reported once, the other file is still written
+        self.assertEqual(len(logs.output), 1)
+        self.assertEqual(fd.getvalue(), b"ab")
+        writer.close(failing)
+        self.assertTrue(writer.flush())
+        self.assertTrue(failing.closed)
+
+    def test_flush_stopped(self):
+        # e.g. the thread died, flush must not wait forever
+        writer = buildlog.LogWriter()
+        self.assertFalse(writer.flush(poll_interval=0.01))
+
+
+if __name__ == "__main__":
+    unittest.main()
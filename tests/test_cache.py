@@ -0,0 +1,291 @@
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import exists, islink, join
+from socketserver import ThreadingMixIn
+
+from workspace import ROOT_DIR  # noqa: F401, puts kivy_ios in the path
+from kivy_ios.cache import (
+    ArtifactCache, DirectoryRemote, DownloadCache, HTTPRemote, RemoteError,
+    open_remote, sha256sum)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RemoteCacheHandler(BaseHTTPRequestHandler):
+    """Remote cache keeping the entries in `server.entries`, by path"""
+
+    def do_GET(self, body=True):
+        data = self.server.entries.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_PUT(self):
+        if self.server.read_only:
+            self.send_error(403)
+            return
+        size = int(self.headers["Content-Length"])
+        self.server.entries[self.path] = self.rfile.read(size)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="kivy-ios-test-")
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.cache = DownloadCache(join(self.tmp_dir, "cache"))
+        self.url = "https://example.com/foo-1.0.tar.gz"
+        filename = join(self.tmp_dir, "foo-1.0.tar.gz")
+        with open(filename, "w") as fd:
+            fd.write("foo")
+        self.sha256 = sha256sum(filename)
+        self.object_fn = self.cache.add(filename, self.url, self.sha256.upper())
+
+    def test_lookup(self):
+        self.assertEqual(self.cache.lookup(self.url), self.object_fn)
+        self.assertEqual(self.cache.lookup(self.url, self.sha256), self.object_fn)
+        self.assertEqual(self.cache.lookup(self.url, self.sha256.upper()),
+                         self.object_fn)
+
+    def test_forget(self):
+        self.cache.forget(self.url)
+        self.cache.forget(self.url)
+        self.assertIsNone(self.cache.lookup(self.url))
+        # still there for the recipes knowing its digest
+        self.assertEqual(self.cache.lookup(self.url, self.sha256), self.object_fn)
+
+    def test_concurrent_fetch(self):
+        url = "https://example.com/bar-1.0.tar.gz"
+        downloads = []
+
+        def download(url, filename):
+            downloads.append(url)
+            # the other fetch would append to the same file meanwhile
+            with open(filename + ".part", "ab") as fd:
+                for _ in range(10):
+                    fd.write(b"bar")
+                    fd.flush()
+                    time.sleep(0.01)
+            os.replace(filename + ".part", filename)
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.fetch(url, download)))
+            for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(downloads, [url])
+        self.assertEqual(results[0], results[1])
+        with open(results[0], "rb") as fd:
+            self.assertEqual(fd.read(), b"bar" * 10)
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="kivy-ios-test-")
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.cache = ArtifactCache(join(self.tmp_dir, "cache"))
+        self.dist_dir = join(self.tmp_dir, "dist")
+        self.outside_dir = join(self.tmp_dir, "outside")
+        os.makedirs(self.dist_dir)
+        os.makedirs(self.outside_dir)
+
+    def write_entry(self, members):
+        """Write the entry "lib/1" holding the `members`, as (TarInfo,
+        content) tuples.
+        """
+        filename = self.cache.entry_fn("lib", "1")
+        os.makedirs(os.path.dirname(filename))
+        with tarfile.open(filename, "w:gz") as tar:
+            data = json.dumps({"removed": []}).encode("utf-8")
+            info = tarfile.TarInfo("manifest.json")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            for info, content in members:
+                if content is None:
+                    tar.addfile(info)
+                else:
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+
+    def link(self, name, linkname, type=tarfile.SYMTYPE):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.linkname = linkname
+        return info, None
+
+    def test_store_restore(self):
+        src_dir = join(self.tmp_dir, "src")
+        os.makedirs(join(src_dir, "lib"))
+        with open(join(src_dir, "lib", "libfoo.a"), "w") as fd:
+            fd.write("foo")
+        os.symlink("libfoo.a", join(src_dir, "lib", "libbar.a"))
+        os.link(join(src_dir, "lib", "libfoo.a"), join(src_dir, "lib", "libbaz.a"))
+        self.cache.store("lib", "1", src_dir,
+                         ["lib", "lib/libfoo.a", "lib/libbar.a", "lib/libbaz.a"],
+                         [], {})
+        self.cache.restore("lib", "1", self.dist_dir)
+        self.assertTrue(islink(join(self.dist_dir, "lib", "libbar.a")))
+        for fn in ("libfoo.a", "libbar.a", "libbaz.a"):
+            with open(join(self.dist_dir, "lib", fn)) as fd:
+                self.assertEqual(fd.read(), "foo")
+
+    def test_symlink_outside(self):
+        info = tarfile.TarInfo("files/lib/evil")
+        self.write_entry([self.link("files/lib", self.outside_dir),
+                          (info, b"evil")])
+        with self.assertRaises(ValueError):
+            self.cache.restore("lib", "1", self.dist_dir)
+        self.assertFalse(exists(join(self.outside_dir, "evil")))
+
+    def test_relative_symlink_outside(self):
+        info = tarfile.TarInfo("files/lib/evil")
+        self.write_entry([self.link("files/lib", "../outside"), (info, b"evil")])
+        with self.assertRaises(ValueError):
+            self.cache.restore("lib", "1", self.dist_dir)
+        self.assertFalse(exists(join(self.outside_dir, "evil")))
+
+    def test_symlink_already_outside(self):
+        # a link left in the dist directory is not followed either
+        os.symlink(self.outside_dir, join(self.dist_dir, "lib"))
+        info = tarfile.TarInfo("files/lib/evil")
+        self.write_entry([(info, b"evil")])
+        with self.assertRaises(ValueError):
+            self.cache.restore("lib", "1", self.dist_dir)
+        self.assertFalse(exists(join(self.outside_dir, "evil")))
+
+    def test_hardlink_outside(self):
+        secret_fn = join(self.outside_dir, "secret")
+        with open(secret_fn, "w") as fd:
+            fd.write("secret")
+        self.write_entry([self.link("files/secret", "files/../outside/secret",
+                                    tarfile.LNKTYPE)])
+        with self.assertRaises(ValueError):
+            self.cache.restore("lib", "1", self.dist_dir)
+        self.assertFalse(exists(join(self.dist_dir, "secret")))
+
+
+class RemoteCacheTest(unittest.TestCase):
+    """Push and pull of the artifact cache entries, through each kind of
+    remote cache.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="kivy-ios-test-")
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.src_dir = join(self.tmp_dir, "src")
+        os.makedirs(join(self.src_dir, "lib"))
+        with open(join(self.src_dir, "lib", "libfoo.a"), "w") as fd:
+            fd.write("foo")
+
+    def start_server(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), RemoteCacheHandler)
+        server.entries = {}
+        server.read_only = False
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, "http://127.0.0.1:{}/cache/".format(server.server_address[1])
+
+    def new_cache(self, remote, name):
+        return ArtifactCache(join(self.tmp_dir, name), remote=remote)
+
+    def check_push_pull(self, remote):
+        self.new_cache(remote, "local1").store(
+            "foo", "abc", self.src_dir, ["lib/libfoo.a"], [], {})
+        cache = self.new_cache(remote, "local2")
+        self.assertEqual(cache.locate("foo", "abc"), "remote")
+        self.assertIsNotNone(cache.lookup("foo", "abc"))
+        self.assertEqual(cache.locate("foo", "abc"), "local")
+        dist_dir = join(self.tmp_dir, "dist")
+        os.makedirs(dist_dir)
+        cache.restore("foo", "abc", dist_dir)
+        with open(join(dist_dir, "lib", "libfoo.a")) as fd:
+            self.assertEqual(fd.read(), "foo")
+
+    def check_miss(self, remote):
+        cache = self.new_cache(remote, "local")
+        self.assertIsNone(cache.locate("foo", "abc"))
+        self.assertIsNone(cache.lookup("foo", "abc"))
+        self.assertFalse(exists(cache.entry_fn("foo", "abc")))
+        # no temporary file left behind
+        self.assertEqual(os.listdir(join(self.tmp_dir, "local", "foo")), [])
+        return cache
+
+    def test_http(self):
+        server, url = self.start_server()
+        remote = open_remote(url)
+        self.assertIsInstance(remote, HTTPRemote)
+        self.check_push_pull(remote)
+        self.assertEqual(list(server.entries), ["/cache/foo/abc.tar.gz"])
+
+    def test_http_miss(self):
+        server, url = self.start_server()
+        cache = self.check_miss(open_remote(url))
+        # the misses are remembered for the build, not asked again
+        server.entries["/cache/foo/abc.tar.gz"] = b""
+        self.assertIsNone(cache.lookup("foo", "abc"))
+
+    def test_http_push_refused(self):
+        server, url = self.start_server()
+        server.read_only = True
+        cache = self.new_cache(open_remote(url), "local")
+        with self.assertLogs("kivy_ios.cache", "WARNING"):
+            filename = cache.store("foo", "abc", self.src_dir,
+                                   ["lib/libfoo.a"], [], {})
+        # kept locally anyway
+        self.assertTrue(exists(filename))
+        self.assertEqual(server.entries, {})
+
+    def test_http_unreachable(self):
+        server, url = self.start_server()
+        server.shutdown()
+        server.server_close()
+        remote = HTTPRemote(url, timeout=5.)
+        with self.assertRaises(RemoteError):
+            remote.exists("foo/abc.tar.gz")
+        cache = self.new_cache(remote, "local")
+        with self.assertLogs("kivy_ios.cache", "WARNING"):
+            self.assertIsNone(cache.lookup("foo", "abc"))
+
+    def test_directory(self):
+        remote_dir = join(self.tmp_dir, "remote")
+        remote = open_remote("file://" + remote_dir)
+        self.assertIsInstance(remote, DirectoryRemote)
+        self.check_push_pull(remote)
+        self.assertEqual(os.listdir(join(remote_dir, "foo")), ["abc.tar.gz"])
+
+    def test_directory_miss(self):
+        self.check_miss(open_remote(join(self.tmp_dir, "remote")))
+
+
+if __name__ == "__main__":
+    unittest.main()
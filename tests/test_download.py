@@ -0,0 +1,109 @@
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import exists, join
+from socketserver import ThreadingMixIn
+
+from workspace import ROOT_DIR  # noqa: F401, puts kivy_ios in the path
+from kivy_ios.download import Downloader
+
+DATA = os.urandom(256 * 1024)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Serve `server.data`, with Range requests, the first response
+    truncated after `server.drop_after` bytes if set.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        data = server.data
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes="):-1])
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        if server.content_encoding:
+            self.send_header("Content-Encoding", server.content_encoding)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        if server.drop_after is not None:
+            self.wfile.write(data[start:server.drop_after])
+            server.drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="kivy-ios-test-")
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+        self.server.data = DATA
+        self.server.drop_after = None
+        self.server.content_encoding = None
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{}/archive.tar.gz".format(
+            self.server.server_address[1])
+        self.filename = join(self.tmp_dir, "archive.tar.gz")
+        self.downloader = Downloader(backoff=0.)
+
+    def read(self):
+        with open(self.filename, "rb") as fd:
+            return fd.read()
+
+    def test_download(self):
+        self.downloader.download(self.url, self.filename)
+        self.assertEqual(self.read(), DATA)
+        self.assertFalse(exists(self.filename + ".part"))
+        self.assertEqual(self.server.requests[0]["Accept-Encoding"], "identity")
+
+    def test_retry_resumes(self):
+        self.server.drop_after = len(DATA) // 3
+        with self.assertLogs("kivy_ios.download", "INFO") as logs:
+            self.downloader.download(self.url, self.filename)
+        self.assertEqual(self.read(), DATA)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1]["Range"],
+                         "bytes={}-".format(len(DATA) // 3))
+        self.assertTrue(any("Resuming" in line for line in logs.output))
+
+    def test_resume_partial_file(self):
+        with open(self.filename + ".part", "wb") as fd:
+            fd.write(DATA[:1000])
+        self.downloader.download(self.url, self.filename)
+        self.assertEqual(self.read(), DATA)
+        self.assertEqual(self.server.requests[0]["Range"], "bytes=1000-")
+
+    def test_content_encoding_kept(self):
+        # a .tar.gz served as gzip encoded is stored as sent, not inflated
+        self.server.data = gzip.compress(DATA)
+        self.server.content_encoding = "gzip"
+        self.server.drop_after = len(self.server.data) // 2
+        self.downloader.download(self.url, self.filename)
+        self.assertEqual(self.read(), self.server.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
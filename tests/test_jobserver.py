@@ -0,0 +1,117 @@
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+from os.path import join
+
+import sh
+
+from workspace import WorkspaceTestCase, synthetic
+from kivy_ios import toolchain
+from kivy_ios.jobserver import JobServer
+
+# build_arch takes a job and its token, then runs the legacy build_<arch>
+NESTED_STEPS = '''    def build_arch(self, arch, job):
+        self.ctx.token_taken.set()
+        time.sleep(0.2)
+        super().build_arch(arch, job)
+
+    def build_x86_64(self):
+        shprint(sh.Command("clang"), "-c", "{name}.c", "-o", "lib{name}.a")
+
+    build_arm64 = build_x86_64'''
+
+# legacy steps only, started while the other recipe holds the token
+LEGACY_STEPS = '''    def download(self):
+        self.ctx.token_taken.wait(10)
+        super().download()
+
+    def prebuild_arch(self, arch):
+        pass
+
+    def build_arch(self, arch):
+        shprint(sh.Command("clang"), "-c", "{name}.c", "-o", "lib{name}.a")'''
+
+
+class JobServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="kivy-ios-test-")
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.jobserver = JobServer(4)
+        self.addCleanup(self.jobserver.close)
+
+    def test_path_with_spaces(self):
+        bin_dir = join(self.tmp_dir, "Xcode tools")
+        os.makedirs(bin_dir)
+        make = join(bin_dir, "make")
+        with open(make, "w") as fd:
+            fd.write('#!/bin/sh\necho "$MAKEFLAGS" "$@"\n')
+        os.chmod(make, stat.S_IRWXU)
+        with self.jobserver.command(sh.Command(make), ["-j8", "all"], {}) as (
+                command, args, kwargs):
+            self.assertIn(make, args)
+            output = str(command(*args, **kwargs))
+        self.assertIn("--jobserver-auth=3,4", output)
+        self.assertTrue(output.strip().endswith(" all"))
+        self.assertNotIn("-j8", output)
+
+    def test_reserve(self):
+        with self.jobserver.reserve():
+            # reentrant for the thread
+            with self.jobserver.reserve():
+                tokens = self.jobserver.acquire(4)
+        self.assertEqual(tokens, 3)
+        self.jobserver.release(tokens)
+        self.assertEqual(self.jobserver.acquire(8), 4)
+        self.jobserver.release(4)
+
+    def test_reserve_waits(self):
+        tokens = self.jobserver.acquire(4)
+        reserved = threading.Event()
+
+        def step():
+            with self.jobserver.reserve():
+                reserved.set()
+
+        thread = threading.Thread(target=step, daemon=True)
+        thread.start()
+        self.assertFalse(reserved.wait(0.1))
+        self.jobserver.release(tokens)
+        thread.join(5)
+        self.assertTrue(reserved.is_set())
+
+
+class JobServerBuildTest(WorkspaceTestCase):
+
+    def test_legacy_and_nested_steps(self):
+        graph = {"synth000": [], "synth001": []}
+        ctx = self.new_context(graph)
+        for name, steps in (("synth000", NESTED_STEPS),
+                            ("synth001", LEGACY_STEPS)):
+            with open(join(self.workspace, "recipes", name, "__init__.py"), "w") as fd:
+                fd.write("import time\n" + synthetic.RECIPE_TEMPLATE.format(
+                    name=name, depends=[], frameworks=[],
+                    build_arch=steps.format(name=name)))
+        ctx.token_taken = threading.Event()
+        JobServer.start(1)
+        self.addCleanup(JobServer.stop)
+        thread = threading.Thread(
+            target=toolchain.build_recipes, args=(list(graph), ctx),
+            kwargs=dict(jobs=2, prefetch=0), daemon=True)
+        thread.start()
+        thread.join(10)
+        deadlocked = thread.is_alive()
+        if deadlocked:
+            # give a token to the waiting step, for the build to end
+            JobServer.instance.release(2)
+            thread.join()
+        self.assertFalse(deadlocked, "deadlock between the steps")
+        for name in graph:
+            self.assertIn("{}.build_all".format(name), ctx.state)
+
+
+if __name__ == "__main__":
+    unittest.main()
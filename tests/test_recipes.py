@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+from os.path import exists, join
+
+from workspace import WorkspaceTestCase
+from kivy_ios import toolchain
+
+CUSTOM_RECIPE = '''from kivy_ios.toolchain import Recipe
+
+
+class MyLibRecipe(Recipe):
+    version = "1.0"
+    url = "src"
+
+    def init_with_ctx(self, ctx):
+        super().init_with_ctx(ctx)
+        ctx.mylib_loaded = True
+
+
+recipe = MyLibRecipe()
+'''
+
+
+class BuiltRecipesTest(WorkspaceTestCase):
+
+    def write_recipe(self, name, content):
+        recipe_dir = join(self.workspace, "recipes", name)
+        os.makedirs(join(recipe_dir, "src"))
+        with open(join(recipe_dir, "__init__.py"), "w") as fd:
+            fd.write(content)
+        return recipe_dir
+
+    def test_custom_recipe_loaded_after_build(self):
+        ctx = self.new_context()
+        ctx.custom_recipes_paths.append(self.write_recipe("mylib", CUSTOM_RECIPE))
+        ctx.recipe_index
+        ctx.state["mylib.build_all"] = True
+        # a later command, e.g. update or pip, does not give the path again
+        toolchain.Recipe.recipes.clear()
+        ctx = self.new_context()
+        toolchain.ensure_recipes_loaded(ctx)
+        self.assertTrue(ctx.mylib_loaded)
+
+    def test_broken_custom_recipe_skipped(self):
+        ctx = self.new_context()
+        ctx.custom_recipes_paths.append(self.write_recipe(
+            "broken", CUSTOM_RECIPE.replace("mylib_loaded", "broken_loaded")
+            + "import not_a_module\n"))
+        ctx.recipe_index
+        ctx.state["broken.build_all"] = True
+        toolchain.Recipe.recipes.clear()
+        ctx = self.new_context()
+        with self.assertLogs("kivy_ios.toolchain", "WARNING"):
+            toolchain.ensure_recipes_loaded(ctx)
+        self.assertFalse(hasattr(ctx, "broken_loaded"))
+
+
+class CleanTest(WorkspaceTestCase):
+
+    def test_clean_keeps_shared_archive(self):
+        ctx = self.new_context({"synth000": []})
+        recipe = toolchain.Recipe.get_recipe("synth000", ctx)
+        archive_fn = join(self.workspace, "archive")
+        with open(archive_fn, "w") as fd:
+            fd.write("archive")
+        archive_fn = ctx.download_cache.add(archive_fn, recipe.url)
+        with open(recipe.legacy_archive_fn, "w") as fd:
+            fd.write("archive")
+        self.set_attr(sys, "argv", ["toolchain", "clean", "synth000"])
+        toolchain.ToolchainCL()
+        self.assertTrue(exists(archive_fn))
+        self.assertFalse(exists(recipe.legacy_archive_fn))
+        self.assertIsNone(ctx.download_cache.lookup(recipe.url))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+
+from workspace import ROOT_DIR  # noqa: F401, puts kivy_ios in the path
+from kivy_ios import state
+from kivy_ios.state import StateStore
+
+LEGACY = {"python3.build_all": "abc", "python3.archive_root": "Python-3.9"}
+
+
+class LegacyStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="kivy-ios-test-")
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.filename = join(self.tmp_dir, "state.db")
+        with open(self.filename, "w") as fd:
+            json.dump(LEGACY, fd)
+
+    def test_import(self):
+        store = StateStore(self.filename)
+        self.addCleanup(store.close)
+        self.assertEqual(dict(store.items()), LEGACY)
+        with open(self.filename + ".json") as fd:
+            self.assertEqual(json.load(fd), LEGACY)
+        store.close()
+        # imported only once
+        store = StateStore(self.filename)
+        self.assertEqual(dict(store.items()), LEGACY)
+
+    def test_failed_import(self):
+        with mock.patch.object(state.os, "replace", side_effect=OSError("full")):
+            with self.assertRaises(OSError):
+                StateStore(self.filename)
+        # the JSON state is left as it was, without temporary database
+        with open(self.filename) as fd:
+            self.assertEqual(json.load(fd), LEGACY)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ["state.db", "state.db.json"])
+        store = StateStore(self.filename)
+        self.addCleanup(store.close)
+        self.assertEqual(dict(store.items()), LEGACY)
+
+
+if __name__ == "__main__":
+    unittest.main()
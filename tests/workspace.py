@@ -0,0 +1,74 @@
+"""
+Temporary workspaces for the unit tests: the toolchain runs there with the
+fake Xcode tools and the synthetic recipes of the benchmarks, on any POSIX
+system.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from os.path import abspath, dirname, join
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, join(ROOT_DIR, "benchmarks"))
+
+import shims
+import synthetic
+from kivy_ios import toolchain
+
+
+class WorkspaceTestCase(unittest.TestCase):
+    """Run each test from a new workspace, with the fake Xcode tools first
+    in the PATH and no shared or remote cache.
+    """
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix="kivy-ios-test-")
+        self.addCleanup(shutil.rmtree, self.workspace, True)
+        bin_dir = join(self.workspace, "bin")
+        shims.install_shims(bin_dir)
+        self.set_env("PATH", os.pathsep.join([bin_dir, os.environ.get("PATH", "")]))
+        self.set_env("KIVYIOS_CACHE_DIR", join(self.workspace, "shared-cache"))
+        self.set_env("KIVYIOS_REMOTE_CACHE", None)
+        self.set_attr(toolchain, "initial_working_directory", self.workspace)
+        self.set_attr(toolchain.Recipe, "recipes", {})
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workspace)
+
+    def set_env(self, name, value):
+        """Set the environment variable `name` for the test, unset if
+        `value` is None.
+        """
+        previous = os.environ.get(name)
+        self.addCleanup(self._restore_env, name, previous)
+        self._restore_env(name, value)
+
+    @staticmethod
+    def _restore_env(name, value):
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    def set_attr(self, obj, name, value):
+        """Set the attribute `name` of `obj` for the test"""
+        missing = object()
+        previous = getattr(obj, name, missing)
+        if previous is missing:
+            self.addCleanup(delattr, obj, name)
+        else:
+            self.addCleanup(setattr, obj, name, previous)
+        setattr(obj, name, value)
+
+    def new_context(self, graph=None):
+        """Return a Context for the workspace, knowing the synthetic recipes
+        of `graph` (see `synthetic.make_graph`), without artifact cache.
+        """
+        ctx = toolchain.Context()
+        ctx.artifact_cache = None
+        if graph:
+            ctx.custom_recipes_paths.extend(synthetic.write_recipes(
+                join(self.workspace, "recipes"), graph))
+        return ctx